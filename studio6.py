@@ -1,5 +1,14 @@
 # /mnt/data/studio4.py
+import operator
 import re
+import sys
+from collections import OrderedDict, deque
+
+from studio6_arrays import (
+    IntArray, Range, Vector, Rope, View, concat_arrays, concat_strings, slice_view, BUILTINS as ARRAY_BUILTINS,
+)
+from studio6_maps import map_key, map_get, BUILTINS as MAP_BUILTINS
+from studio6_limits import METERS
 
 # Added STRING, LBRACK, RBRACK tokens as requested by Part A
 SPEC = [
@@ -7,6 +16,7 @@ SPEC = [
     ("STRING", r'"([^"\\]|\\.)*"'),   # double-quoted string (supports simple backslash escapes)
     ("IF", r"\bif\b"),
     ("WHILE", r"\bwhile\b"),
+    ("FOR", r"\bfor\b"), ("IN", r"\bin\b"),
     ("ELSE", r"\belse\b"),
     ("TRY", r"\btry\b"),
     ("CATCH", r"\bcatch\b"),
@@ -23,6 +33,7 @@ SPEC = [
     ("ASSIGN", r"="),
     ("SEMI", r";"),
     ("COMMA", r","),
+    ("COLON", r":"),                        # slices a[lo:hi]
     ("LPAREN", r"\("), ("RPAREN", r"\)"),
     ("LBRACE", r"\{"), ("RBRACE", r"\}"),
     ("LBRACK", r"\["), ("RBRACK", r"\]"),  # array indexing / literals
@@ -48,6 +59,40 @@ def lex(code):                             # step 1. Converts the raw code into
     tokens.append(("EOF",""))
     return tokens
 
+# Fast lexer mode: one finditer pass, keywords looked up in a table instead of regex alternation.
+# Keywords are the \bword\b patterns listed before ID in SPEC. Whitespace and comments are folded
+# into the match in front of each token, so every finditer step yields a real token; the MISMATCH
+# group makes sure no character is ever skipped silently.
+KEYWORDS = {pattern[2:-2]: name for name, pattern in SPEC[:[n for n, _ in SPEC].index("ID")]
+            if pattern.startswith(r"\b")}
+fast_regex = "|".join(f"(?P<{name}>{pattern})" for name, pattern in SPEC
+                      if name not in ("WS", "COMMENT") and not (pattern.startswith(r"\b") and pattern.endswith(r"\b")))
+find_tokens = re.compile(r"(?:[ \t\r\n]+|#.*)*(?:" + fast_regex + r"|(?P<MISMATCH>[\s\S])|(?P<END>\Z))").finditer
+
+def tokenize(code):                        # Lazy version of lex(): yields (kind, value, line, column)
+    line, line_start, last = 1, 0, 0
+    keywords, count = KEYWORDS, code.count
+    for match in find_tokens(code):
+        kind = match.lastgroup
+        start = match.start(kind)
+        if count("\n", last, start):       # newlines since the previous token started
+            line += count("\n", last, start)
+            line_start = code.rindex("\n", last, start) + 1
+        last = start
+        if kind == "ID":
+            value = match.group(kind)
+            kind = keywords.get(value, "ID")
+            # `\bif\b` cannot match straight after a digit, so "2if" lexes as NUM, ID like lex() does
+            if kind != "ID" and start and code[start - 1].isdigit(): kind = "ID"
+            yield (kind, value, line, start - line_start + 1)
+        elif kind == "END":
+            yield ("EOF", "", line, start - line_start + 1)
+            return
+        elif kind == "MISMATCH":
+            raise SyntaxError(f"Unexpected character {code[start]!r} at position {start}")
+        else:
+            yield (kind, match.group(kind), line, start - line_start + 1)
+
 
 class Number:
     def __init__(self, value): self.value = int(value)
@@ -62,10 +107,57 @@ class String:
 class ArrayLiteral:
     def __init__(self, elements): self.elements = elements  # list of AST expressions
 
+class MapLiteral:
+    def __init__(self, keys, values): self.keys, self.values = keys, values    # parallel lists of AST expressions
+
 class BinOp:
+    # Quickening state used by Interpreter.evaluate: once a site sees operand types listed in
+    # QUICK_BINOPS it stores the matching operation and the types it guards on
+    quick = left_type = right_type = None
+    deopts = 0
     def __init__(self, left, op, right):
         self.left, self.op, self.right = left, op, right
 
+def _int_divide(left, right):
+    if right == 0: raise ZeroDivisionError("division by zero")
+    return left // right
+
+def concat_views(left, right):
+    # `+` with a slice on either side: views are copied out, then added like arrays or strings
+    if isinstance(left, View): left = left.materialize()
+    if isinstance(right, View): right = right.materialize()
+    if isinstance(left, STRINGS) and isinstance(right, STRINGS):
+        return concat_strings(left, right)
+    if isinstance(left, LISTS) and isinstance(right, LISTS):
+        return concat_arrays(left, right)
+    raise TypeError("Unsupported operand types for +")
+
+def iterate(value):
+    # The iterator a for loop runs on: the elements of an array or range, the characters of a string,
+    # or the keys a map had when the loop started
+    if isinstance(value, SEQUENCES): return iter(value)
+    if value.__class__ is dict: return iter(list(value))
+    raise TypeError("for loop expects an array, string, map or range")
+
+# (operator, left type, right type) -> operation with the same result as the generic BinOp path
+QUICK_BINOPS = {
+    **{(op, int, int): fn for op, fn in (("PLUS", operator.add), ("MINUS", operator.sub), ("STAR", operator.mul),
+                                         ("SLASH", _int_divide), ("EQ", operator.eq), ("LT", operator.lt),
+                                         ("GT", operator.gt))},
+    **{(op, str, str): fn for op, fn in (("EQ", operator.eq), ("LT", operator.lt), ("GT", operator.gt))},
+    **{("PLUS", l, r): concat_strings for l in (str, Rope) for r in (str, Rope)},
+    **{("PLUS", l, r): concat_arrays for l in (list, Vector) for r in (list, Vector)},
+    ("EQ", list, list): operator.eq,
+}
+# Values that support indexing, and the mutable ones among them that index assignment may target
+SEQUENCES = (list, str, IntArray, Range, Vector, Rope, View)
+ARRAYS = (list, IntArray, Range, Vector, View)       # a View of a string refuses writes itself
+LISTS = (list, Vector, IntArray, Range)       # arrays that + concatenates (into a Vector once long)
+STRINGS = (str, Rope)                         # strings that + concatenates (into a Rope once long)
+
+QUICKEN_LIMIT = 4           # a site that deoptimizes this often stays generic
+QUICKEN_STATS = {"specialized": 0, "deoptimized": 0}
+
 class Bool:
     def __init__(self, value):
         self.value = bool(value) if not isinstance(value, str) else value.lower() in ("true","1")
@@ -74,32 +166,57 @@ class UnaryOp:
     def __init__(self, op, operand): self.op, self.operand = op, operand
 
 class FunctionDef:
-    def __init__(self, name, params, body): self.name, self.params, self.body = name, params, body
+    line = None             # source line of `def`, when the parser had token positions
+    purity = False          # set by function_purity(): None, or what the body depends on besides its params
+    def __init__(self, name, params, body, memo=False):
+        self.name, self.params, self.body = name, params, body
+        self.memo = memo    # `memo def`: results are cached without function_purity() proving it safe
 
 class Call:
     def __init__(self, func_expr, args): self.func_expr, self.args = func_expr, args
 
 class FunctionValue:
+    memo = None             # the Memo caching its results, and
+    purity = None           # function_purity() of a top-level definition; see attach_memo()
+    name = line = None      # of its def, set by the tree-walker for Interpreter.stack
     def __init__(self, params, body, env): self.params, self.body, self.env = params, body, env
 
 class BuiltinFunction:
-    def __init__(self, fn, arity=None):
+    def __init__(self, fn, arity=None, pure=False):
         self.fn = fn
         self.arity = arity
+        self.pure = pure    # no effects besides its result, so memoized functions may call it
 
 class Environment:
+    version = 0             # bumped on every define/set/assign here; validates inline caches of Var sites
+    memo_limit = 1024       # results kept per memoized function; set on the global Environment, 0 disables
+    memoize = False         # memoize pure functions automatically (global Environment); `memo def` always is
     def __init__(self, parent=None):
         self.vars = {}
         self.parent = parent
-    def define(self, name, value): self.vars[name] = value
+    def define(self, name, value):
+        self.vars[name] = value
+        self.version += 1
     def get(self, name):
         if name in self.vars: return self.vars[name]
         elif self.parent: return self.parent.get(name)
         else: raise NameError(f"Undefined variable '{name}'")
     def set(self, name, value):
-        if name in self.vars: self.vars[name] = value
+        if name in self.vars:
+            self.vars[name] = value
+            self.version += 1
         elif self.parent: self.parent.set(name, value)
         else: raise NameError(f"Undefined variable '{name}'")
+    def assign(self, name, value):      # Assign semantics in one walk: update where bound, else define here
+        env = self
+        while env is not None:
+            if name in env.vars:
+                env.vars[name] = value
+                env.version += 1
+                return
+            env = env.parent
+        self.vars[name] = value
+        self.version += 1
 
 class Assign:
     def __init__(self, name, value): self.name, self.value = name, value
@@ -112,19 +229,34 @@ class AssignIndex:
         self.name, self.indices, self.value = name, indices, value
 
 class Var:
+    # global_site: set by mark_global_sites() when no enclosing function or catch scope can bind the
+    # name, so it always lives in the global Environment. cache: (global env, its version, value).
+    global_site = False
+    cache = None
     def __init__(self, name): self.name = name
 
 class Index:
     def __init__(self, collection, index): self.collection, self.index = collection, index
 
+class Slice:
+    def __init__(self, collection, lo, hi): self.collection, self.lo, self.hi = collection, lo, hi
+
+SLICE_END = 2 ** 63 - 1         # hi of a[lo:], past the end of any array or string
+
 class IfExpression:
     def __init__(self, condition, then_branch, else_branch):
         self.condition, self.then_branch, self.else_branch = condition, then_branch, else_branch
 
 class WhileLoop:
+    line = None
     def __init__(self, condition, body): self.condition, self.body = condition, body
 
+class ForLoop:
+    line = None
+    def __init__(self, name, iterable, body): self.name, self.iterable, self.body = name, iterable, body
+
 class Return:
+    tail_call = False       # set by mark_tail_calls() for `return f(...)` that may reuse the caller's frame
     def __init__(self, value):
         self.value = value
 
@@ -132,6 +264,10 @@ class ReturnException(Exception):
     def __init__(self, value):
         self.value = value
 
+class TailCallException(Exception):     # `return f(...)`: the enclosing Call runs f in place of the current body
+    def __init__(self, func, env):
+        self.func, self.env = func, env
+
 class Reference:
     def __init__(self, env, name):
         self.env = env
@@ -159,11 +295,22 @@ class ThrownException(Exception):
 
 
 class Interpreter:                  
-    def __init__(self):
+    def __init__(self, memo_limit=None, memoize=False):
         self.env = Environment()
         # Register builtin `len` as requested in Part B
-        self.env.define("len", BuiltinFunction(self._builtin_len, arity=1))
+        self.env.define("len", BuiltinFunction(self._builtin_len, arity=1, pure=True))
         self.env.define("print", BuiltinFunction(self._builtin_print))
+        for name, fn in ARRAY_BUILTINS.items():     # typed int arrays and their bulk operations
+            self.env.define(name, BuiltinFunction(fn, pure=True))
+        for name, fn in MAP_BUILTINS.items():       # has, keys, values, delete
+            self.env.define(name, BuiltinFunction(fn, pure=name != "delete"))
+        if memo_limit is not None: self.env.memo_limit = memo_limit
+        if memoize: self.env.memoize = True
+        self.builtins = dict(self.env.vars)
+        # Functions and loops evaluate() is running, innermost last. Maintained by the Call, WhileLoop
+        # and ForLoop branches (and by closure-engine code through Meter.stack while a Sampler runs),
+        # and read by studio6_profile.Sampler from another thread.
+        self.stack = []
 
     def _builtin_print(self, args):
         # Convert each arg to string (Studio spec)
@@ -174,9 +321,108 @@ class Interpreter:
         if len(args) != 1:
             raise TypeError("len expects 1 argument")
         coll = args[0]
-        if isinstance(coll, (list, str)):
+        if isinstance(coll, SEQUENCES) or coll.__class__ is dict:
             return len(coll)
-        raise TypeError("len expects array or string")
+        raise TypeError("len expects array, string or map")
+
+    def reset(self):
+        # Fresh globals holding only the builtins, so this interpreter can run another program as if new
+        env = Environment()
+        env.vars.update(self.builtins)
+        env.memo_limit, env.memoize = self.env.memo_limit, self.env.memoize
+        self.env, self.stack = env, []
+
+    def memo_stats(self):
+        # Cache statistics of the memoized functions bound to global names
+        return {name: {"hits": value.memo.hits, "misses": value.memo.misses, "size": len(value.memo.results)}
+                for name, value in self.env.vars.items()
+                if isinstance(value, FunctionValue) and value.memo is not None}
+
+    def prepare(self, tree, engine="closure"):
+        # One callable per top-level statement, each taking the env to run in
+        return self.bind(compile_program(tree, engine), engine)
+
+    def bind(self, program, engine="closure"):
+        # Turns the output of compile_program into per-statement callables for this interpreter
+        if engine == "closure":
+            return program
+        if engine == "tree":
+            return [lambda env, node=node: self.evaluate(node, env) for node in program]
+        if engine == "vm":
+            from studio6_vm import VM
+            vm = VM()
+            return [lambda env, code=code: vm.execute(code, env) for code in program]
+        if engine == "flat":
+            from studio6_flat import FlatEvaluator
+            evaluator = FlatEvaluator(program)
+            return [lambda env, index=index: evaluator.evaluate(index, env) for index in program.statements()]
+        raise ValueError(f"Unknown engine {engine!r}")
+
+    def call_env(self, func, arg_nodes, env):
+        # Checks a call to a studio6 function and binds its arguments in a new environment
+        if not isinstance(func, FunctionValue):
+            raise TypeError("Attempted to call a non-function")
+
+        # Prepare arguments
+        if len(arg_nodes) != len(func.params):  # If the arguments entered are too many or too few characters
+            raise TypeError("Argument count mismatch")
+
+        local_env = Environment(func.env)   # Builds the function it's own environment
+
+        for (is_ref, param_name), arg_node in zip(func.params, arg_nodes):  # Had to use AI for this part
+            if is_ref:
+                # ref parameter must be a variable
+                if not isinstance(arg_node, Var):
+                    raise TypeError(f"ref parameter '{param_name}' must be a variable")
+                # Bind a Reference into the callee's environment that points to the caller's env variable.
+                local_env.define(param_name, Reference(env, arg_node.name))
+            else:
+                # by-value: evaluate now
+                val = self.evaluate(arg_node, env)
+                local_env.define(param_name, val)
+        return local_env
+
+    def binary(self, node, left, right):
+        # Arithmetic/comparison on evaluated operands. Operand types listed in QUICK_BINOPS quicken the
+        # site, so its next evaluation takes the guarded path at the top of the BinOp branch.
+        op = node.op[0]
+        if node.deopts < QUICKEN_LIMIT:
+            quick = QUICK_BINOPS.get((op, left.__class__, right.__class__))
+            if quick is not None:
+                node.quick, node.left_type, node.right_type = quick, left.__class__, right.__class__
+                QUICKEN_STATS["specialized"] += 1
+        if isinstance(left, Reference): left = left.get()   # If it's calling another function
+        if isinstance(right, Reference): right = right.get()
+
+        if op == "PLUS":
+            # support number+number, string+string, list+list concatenation
+            if isinstance(left, (int)) and isinstance(right, (int)):
+                return left + right
+            if isinstance(left, STRINGS) and isinstance(right, STRINGS):
+                return concat_strings(left, right)
+            if isinstance(left, LISTS) and isinstance(right, LISTS): 
+                return concat_arrays(left, right)        # This is essentially safeguarding someone trying to add two incompatible variables.
+            if isinstance(left, View) or isinstance(right, View):
+                return concat_views(left, right)
+            raise TypeError("Unsupported operand types for +")
+        if op == "MINUS":
+            if isinstance(left, int) and isinstance(right, int):
+                return left - right
+            raise TypeError("Unsupported operand types for -")
+        if op == "STAR":
+            if isinstance(left, int) and isinstance(right, int):
+                return left * right
+            raise TypeError("Unsupported operand types for *")
+        if op == "SLASH":
+            if isinstance(left, int) and isinstance(right, int):
+                if right == 0:
+                    raise ZeroDivisionError("division by zero")     # AI recommended I throw this in so I did
+                # keep integer division semantics consistent with earlier spec decisions
+                return left // right
+            raise TypeError("Unsupported operand types for /")
+        if op == "EQ": return left == right
+        if op == "LT": return left < right
+        if op == "GT": return left > right
 
     def evaluate(self, node, env=None):         # Since this gets called for every node in the tree, every node will run through this. 
         if env is None: env = self.env
@@ -194,7 +440,23 @@ class Interpreter:
             # Evaluate each element expression and return a *mutable* Python list
             return [self.evaluate(e, env) for e in node.elements]        # Used AI for this 
 
+        elif isinstance(node, MapLiteral):
+            # A dict; each key is evaluated before its value
+            return {map_key(self.evaluate(k, env)): self.evaluate(v, env) for k, v in zip(node.keys, node.values)}
+
         elif isinstance(node, BinOp):       # BinOp = binary operation. This is for PEMDAS and AND/OR
+            quick = node.quick
+            if quick is not None:
+                # Quickened site: one type guard instead of the checks below; deoptimize if it fails
+                left = self.evaluate(node.left, env)
+                right = self.evaluate(node.right, env)
+                if left.__class__ is node.left_type and right.__class__ is node.right_type:
+                    return quick(left, right)
+                node.quick = None
+                node.deopts += 1
+                QUICKEN_STATS["deoptimized"] += 1
+                return self.binary(node, left, right)
+
             # Arithmetic/comparison/logic. Basic type-checking for clarity.
             op = node.op[0]
             # For logical operators, implement short-circuit semantics
@@ -217,36 +479,7 @@ class Interpreter:
 
             left = self.evaluate(node.left, env)
             right = self.evaluate(node.right, env)
-            if isinstance(left, Reference): left = left.get()   # If it's calling another function
-            if isinstance(right, Reference): right = right.get()
-
-            if op == "PLUS":
-                # support number+number, string+string, list+list concatenation
-                if isinstance(left, (int)) and isinstance(right, (int)):
-                    return left + right
-                if isinstance(left, str) and isinstance(right, str):
-                    return left + right
-                if isinstance(left, list) and isinstance(right, list): 
-                    return left + right        # This is essentially safeguarding someone trying to add two incompatible variables.
-                raise TypeError("Unsupported operand types for +")
-            if op == "MINUS":
-                if isinstance(left, int) and isinstance(right, int):
-                    return left - right
-                raise TypeError("Unsupported operand types for -")
-            if op == "STAR":
-                if isinstance(left, int) and isinstance(right, int):
-                    return left * right
-                raise TypeError("Unsupported operand types for *")
-            if op == "SLASH":
-                if isinstance(left, int) and isinstance(right, int):
-                    if right == 0:
-                        raise ZeroDivisionError("division by zero")     # AI recommended I throw this in so I did
-                    # keep integer division semantics consistent with earlier spec decisions
-                    return left // right
-                raise TypeError("Unsupported operand types for /")
-            if op == "EQ": return left == right
-            if op == "LT": return left < right
-            if op == "GT": return left > right
+            return self.binary(node, left, right)
 
         elif isinstance(node, UnaryOp):         # AI recommended this. This is basically if we're dealing with a negative variable
             val = self.evaluate(node.operand, env)
@@ -257,10 +490,7 @@ class Interpreter:
 
         elif isinstance(node, Assign):
             val = self.evaluate(node.value, env)
-            try:
-                env.set(node.name, val)         # If x exists
-            except NameError:
-                env.define(node.name, val)      # If x doesn't exist yet
+            env.assign(node.name, val)          # Sets x if it exists, defines it here if it doesn't
             return val
 
         elif isinstance(node, AssignIndex):     # Had to use AI for this one - pretty complex for me
@@ -274,21 +504,27 @@ class Interpreter:
             # Walk indices to the penultimate container
             if not node.indices:
                 raise SyntaxError("Missing index for indexed assignment")
-            cur = container
+            cur = container.get() if isinstance(container, Reference) else container
             for idx_ast in node.indices[:-1]:
                 idx = self.evaluate(idx_ast, env)
                 if isinstance(idx, Reference): idx = idx.get()
+                if cur.__class__ is dict:
+                    cur = map_get(cur, idx)
+                    continue
                 if not isinstance(idx, int):
                     raise TypeError("Index must be an integer")
-                if not isinstance(cur, list):
+                if not isinstance(cur, ARRAYS):
                     raise TypeError("Indexed assignment only allowed on arrays (intermediate element not array)")
                 cur = cur[idx]
             # now cur is the container whose element we will set
             final_idx = self.evaluate(node.indices[-1], env)
             if isinstance(final_idx, Reference): final_idx = final_idx.get()
+            if cur.__class__ is dict:
+                cur[map_key(final_idx)] = val
+                return val
             if not isinstance(final_idx, int):
                 raise TypeError("Index must be an integer")
-            if not isinstance(cur, list):
+            if not isinstance(cur, ARRAYS):
                 # explicit TypeError per assignment spec: only arrays are mutable/index-assignable
                 raise TypeError("Indexed assignment only allowed on arrays")
             # MUTABILITY NOTE:
@@ -299,7 +535,16 @@ class Interpreter:
             return val
 
         elif isinstance(node, Var):
-            val = env.get(node.name)            # Fetches a variable
+            if node.global_site:
+                # Inline cache: reuse the value this site last read from the globals until they change
+                genv, cache = self.env, node.cache
+                if cache is not None and cache[0] is genv and cache[1] == genv.version:
+                    val = cache[2]
+                else:
+                    val = genv.get(node.name)
+                    node.cache = (genv, genv.version, val)
+            else:
+                val = env.get(node.name)        # Fetches a variable
             if isinstance(val, Reference):
                 return val.get()
             return val
@@ -312,16 +557,28 @@ class Interpreter:
             idx = self.evaluate(node.index, env)
             if isinstance(idx, Reference):
                 idx = idx.get()
+            if coll.__class__ is dict:
+                return map_get(coll, idx)
             if not isinstance(idx, int):
                 raise TypeError("Index must be integer")
             # allow read from arrays and strings
-            if isinstance(coll, list):
+            if isinstance(coll, ARRAYS):
                 return coll[idx]
-            if isinstance(coll, str):
+            if isinstance(coll, STRINGS):
                 # return single-character string
                 return coll[idx]
             raise TypeError("Indexing only supported on arrays and strings")
 
+        elif isinstance(node, Slice):
+            # slice read: collection[lo:hi] is a View sharing the collection's storage
+            coll = self.evaluate(node.collection, env)
+            if isinstance(coll, Reference):
+                coll = coll.get()
+            lo, hi = self.evaluate(node.lo, env), self.evaluate(node.hi, env)
+            if isinstance(lo, Reference): lo = lo.get()
+            if isinstance(hi, Reference): hi = hi.get()
+            return slice_view(coll, lo, hi)
+
         elif isinstance(node, IfExpression):    
             cond = self.evaluate(node.condition, env)   # Gets the condition and then evaluates if it's true or not
             branch = node.then_branch if cond else node.else_branch
@@ -331,13 +588,36 @@ class Interpreter:
 
         elif isinstance(node, WhileLoop):
             result = None                           # Loops until val is none and condition is false
+            self.stack.append(node)
+            meter = METERS.meter
             while self.evaluate(node.condition, env):
+                meter.left -= 1                     # one step per iteration (studio6_limits)
+                if meter.left < 0: meter.check()
                 for stmt in node.body: 
                     val = self.evaluate(stmt, env); result = val if val is not None else result
+            self.stack.pop()
+            return result
+
+        elif isinstance(node, ForLoop):
+            # Binds each element with assignment semantics, then runs the body; same value as a while loop
+            result = None
+            iterable = self.evaluate(node.iterable, env)
+            if isinstance(iterable, Reference): iterable = iterable.get()
+            self.stack.append(node)
+            meter = METERS.meter
+            for item in iterate(iterable):
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                env.assign(node.name, item)
+                for stmt in node.body:
+                    val = self.evaluate(stmt, env); result = val if val is not None else result
+            self.stack.pop()
             return result
 
         elif isinstance(node, FunctionDef):
             func_val = FunctionValue(node.params, node.body, env) # Used AI for this part
+            func_val.name, func_val.line = node.name, node.line
+            attach_memo(func_val, node.memo, function_purity(node), env)
             env.define(node.name, func_val)
             return None
 
@@ -349,43 +629,57 @@ class Interpreter:
                 args = [self.evaluate(a, env) for a in node.args]
                 return func.fn(args)
 
-            if not isinstance(func, FunctionValue):
-                raise TypeError("Attempted to call a non-function")
-
-            # Prepare arguments
-            if len(node.args) != len(func.params):  # If the arguments entered are too many or too few characters
-                raise TypeError("Argument count mismatch")
-
-            local_env = Environment(func.env)   # Builds the function it's own environment
-    
-            for (is_ref, param_name), arg_node in zip(func.params, node.args):  # Had to use AI for this part
-                if is_ref:
-                    # ref parameter must be a variable
-                    if not isinstance(arg_node, Var):
-                        raise TypeError(f"ref parameter '{param_name}' must be a variable")
-                    # Bind a Reference into the callee's environment that points to the caller's env variable.
-                    local_env.define(param_name, Reference(env, arg_node.name))
-                else:
-                    # by-value: evaluate now
-                    val = self.evaluate(arg_node, env)
-                    local_env.define(param_name, val)
-
-            # Execute function body
-            result = None
-            try:
-                for stmt in func.body:
-                    self.evaluate(stmt, local_env)
-            except ReturnException as r:
-                result = r.value
+            local_env = self.call_env(func, node.args, env)
+            memo = func.memo
+            if memo is not None:
+                key, result = memo.get([local_env.vars[name] for _, name in func.params])
+                if result is not MISSING: return result
+
+            # Execute function body. A tail call (`return g(...)`) raises TailCallException with g's
+            # new environment, and g's body runs here instead, so tail recursion uses constant stack.
+            # Loops and calls that a return or raise left early are dropped from self.stack here.
+            # Each call and tail call is a step, and the call counts towards meter.depth while it runs.
+            stack = self.stack
+            depth = len(stack)
+            stack.append(func)
+            meter = METERS.meter
+            meter.depth += 1
+            if meter.depth > meter.max_depth: meter.exceeded("depth")
+            while True:
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                try:
+                    result = None
+                    for stmt in func.body:
+                        self.evaluate(stmt, local_env)
+                    break
+                except ReturnException as r:
+                    result = r.value
+                    break
+                except TailCallException as t:
+                    func, local_env = t.func, t.env
+                    del stack[depth + 1:]
+                    stack[depth] = func
+            meter.depth -= 1
+            del stack[depth:]
+            if memo is not None and key is not None: memo.put(key, result)
             return result
 
         elif isinstance(node, Return):
+            if node.tail_call:
+                call = node.value
+                func = self.evaluate(call.func_expr, env)
+                if isinstance(func, BuiltinFunction):
+                    raise ReturnException(func.fn([self.evaluate(a, env) for a in call.args]))
+                raise TailCallException(func, self.call_env(func, call.args, env))
             val = self.evaluate(node.value, env) # Return x
             raise ReturnException(val)
         elif isinstance(node, Raise):
             val = self.evaluate(node.expr, env) # Raise x
             raise ThrownException(val)
         elif isinstance(node, TryBlock):
+            meter = METERS.meter
+            depth, calls = len(self.stack), meter.depth
             try:
                 # run try block
                 result = None
@@ -395,6 +689,8 @@ class Interpreter:
                         result = v
                 return result
             except ThrownException as exc:
+                del self.stack[depth:]              # the calls and loops the raise left
+                meter.depth = calls
                 # create a new environment for catch
                 local_env = Environment(env)
                 local_env.define(node.catch_name, exc.value)
@@ -408,39 +704,1135 @@ class Interpreter:
         else:
             raise TypeError(f"Unknown node type: {type(node)}")
 
+# Child fields of each AST node type, in evaluation order. Used by passes that walk the tree.
+CHILD_FIELDS = {
+    Number: (), String: (), Bool: (), Var: (),
+    ArrayLiteral: ("elements",), BinOp: ("left", "right"), UnaryOp: ("operand",),
+    MapLiteral: ("keys", "values"),         # evaluated pairwise: keys[0], values[0], keys[1], ...
+    FunctionDef: ("body",), Call: ("func_expr", "args"), Assign: ("value",),
+    AssignIndex: ("value", "indices"), Index: ("collection", "index"), Slice: ("collection", "lo", "hi"),
+    IfExpression: ("condition", "then_branch", "else_branch"), WhileLoop: ("condition", "body"),
+    ForLoop: ("iterable", "body"),
+    Return: ("value",), Raise: ("expr",), TryBlock: ("body", "catch_body"),
+}
+
+def child_nodes(node):
+    for field in CHILD_FIELDS[type(node)]:
+        value = getattr(node, field)
+        if isinstance(value, list): yield from value
+        else: yield value
+
+
+def mark_tail_calls(stmts):
+    # Flags each `return f(...)` of a function body as a tail call. Returns inside a try body are
+    # skipped: that try must still be active to catch what f raises. Nested functions mark their own.
+    pending = list(stmts)
+    while pending:
+        node = pending.pop()
+        kind = type(node)
+        if kind is FunctionDef:
+            continue
+        if kind is Return and type(node.value) is Call:
+            node.tail_call = True
+        if kind is TryBlock:
+            pending.extend(node.catch_body)
+            continue
+        pending.extend(child_nodes(node))
+
+
+def mark_global_sites(stmts, scope=None):
+    # Flags Var nodes in function bodies and catch blocks whose name none of the enclosing scopes can
+    # bind at runtime (see Scope.collect), so the tree-walker can read them from the globals directly.
+    # Top-level names are looked up in the global Environment anyway.
+    pending = [(node, scope) for node in stmts]
+    while pending:
+        node, scope = pending.pop()
+        kind = type(node)
+        if kind is Var:
+            if scope is not None and not scope.resolve(node.name)[0]:
+                node.global_site = True
+            continue
+        if kind is FunctionDef:
+            inner = Scope(scope)
+            for _, param_name in node.params: inner.declare(param_name)
+            inner.collect(node.body)
+            pending.extend((stmt, inner) for stmt in node.body)
+            continue
+        if kind is TryBlock:
+            pending.extend((stmt, scope) for stmt in node.body)
+            inner = Scope(scope)
+            inner.declare(node.catch_name)
+            inner.collect(node.catch_body)
+            pending.extend((stmt, inner) for stmt in node.catch_body)
+            continue
+        pending.extend((child, scope) for child in child_nodes(node))
+
+
+
+class CountedLoop:              # `while i < limit { ...; i = i + step; }` as recognized by counted_loop()
+    def __init__(self, name, step, limit, counter_first, body, calls, assigned):
+        self.name, self.step, self.limit = name, step, limit
+        self.counter_first = counter_first     # whether the counter is the left operand of the test
+        self.body = body                       # the statements before the increment
+        self.calls = calls                     # a call in the body or limit could rebind the counter
+        self.assigned = assigned | {name}      # every name the loop may bind or mutate
+        # Without calls, an expression over constants and names the loop never binds has the same
+        # value on every iteration
+        self.invariant = not calls and _invariant(limit, self.assigned)
+
+_PURE_EXPRESSIONS = (Number, String, Bool, Var, BinOp, UnaryOp)
+
+def _invariant(node, assigned):
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        kind = type(node)
+        if kind not in _PURE_EXPRESSIONS or kind is Var and node.name in assigned: return False
+        pending.extend(child_nodes(node))
+    return True
+
+def counted_loop(node):
+    # The counted shape of a WhileLoop, or None: the test compares a variable with a limit, the body
+    # ends with `i = i + k` (or `i = i - k` when the test counts down) and binds i nowhere else
+    cond, body = node.condition, node.body
+    if type(cond) is not BinOp or cond.op[0] not in ("LT", "GT") or not body: return None
+    inc = body[-1]
+    if type(inc) is not Assign or type(inc.value) is not BinOp: return None
+    name, value = inc.name, inc.value
+    left_is_counter = type(value.left) is Var and value.left.name == name
+    if value.op[0] == "PLUS" and left_is_counter and type(value.right) is Number: step = value.right.value
+    elif value.op[0] == "PLUS" and type(value.left) is Number and type(value.right) is Var \
+            and value.right.name == name: step = value.left.value
+    elif value.op[0] == "MINUS" and left_is_counter and type(value.right) is Number: step = -value.right.value
+    else: return None
+    if type(cond.left) is Var and cond.left.name == name: counter_first, limit = True, cond.right
+    elif type(cond.right) is Var and cond.right.name == name: counter_first, limit = False, cond.left
+    else: return None
+    if step == 0 or (step > 0) != ((cond.op[0] == "LT") == counter_first): return None
+    assigned, calls, pending = set(), False, [limit, *body[:-1]]
+    while pending:
+        node = pending.pop()
+        kind = type(node)
+        if kind is Assign or kind is FunctionDef or kind is ForLoop: assigned.add(node.name)
+        elif kind is AssignIndex: assigned.add(node.name)      # a[0] = x changes what a holds
+        elif kind is TryBlock: assigned.add(node.catch_name)
+        elif kind is Call:
+            calls = True
+            assigned.update(arg.name for arg in node.args if type(arg) is Var)     # the callee may mutate it
+        pending.extend(child_nodes(node))
+    if name in assigned: return None
+    # In `f() > i` the call runs before the counter is read and could rebind it
+    if calls and not counter_first and not _invariant(limit, ()): return None
+    return CountedLoop(name, step, limit, counter_first, body[:-1], calls, assigned)
+
+def loop_invariants(loop):
+    # The largest operator subexpressions of a counted loop body that have the same value on every
+    # iteration. Function bodies and catch blocks are skipped: they run in scopes of their own.
+    if loop.calls: return []
+    found, pending = [], list(loop.body)
+    while pending:
+        node = pending.pop()
+        kind = type(node)
+        if (kind is BinOp or kind is UnaryOp) and _invariant(node, loop.assigned):
+            found.append(node)
+            continue
+        if kind is FunctionDef: continue
+        if kind is TryBlock:
+            pending.extend(node.body)
+            continue
+        pending.extend(child_nodes(node))
+    return found
+
+def function_purity(node):
+    # What calls of a FunctionDef depend on besides their arguments: (names it calls, names it assigns,
+    # whether it has a call or loop), or None. The body may only read its params and locals, call free
+    # names and index-assign locals, with no ref params and no nested defs. The callees and the assigned
+    # names (which would update globals of the same name) are checked at run time by Memo.usable().
+    if node.purity is not False: return node.purity
+    node.purity = None
+    if any(is_ref for is_ref, _ in node.params): return None
+    params = {name for _, name in node.params}
+    reads, callees, assigned, loops, pending = set(), set(), set(), False, list(node.body)
+    while pending:
+        child = pending.pop()
+        kind = type(child)
+        if kind is FunctionDef: return None
+        if kind is Var or kind is AssignIndex: reads.add(child.name)
+        elif kind is Assign: assigned.add(child.name)
+        elif kind is ForLoop or kind is WhileLoop:
+            loops = True
+            if kind is ForLoop: assigned.add(child.name)
+        elif kind is TryBlock: assigned.add(child.catch_name)
+        elif kind is Call:
+            if type(child.func_expr) is not Var: return None
+            callees.add(child.func_expr.name)
+            pending.extend(child.args)
+            continue
+        pending.extend(child_nodes(child))
+    local = params | assigned
+    if not reads <= local or callees & local: return None
+    node.purity = (tuple(sorted(callees)), tuple(sorted(assigned - params)), loops or bool(callees))
+    return node.purity
+
+MISSING = object()              # Memo.get: no cached result
+MEMO_RESULTS = {int, str, bool, Rope}   # result types a Memo keeps; arrays and maps could be mutated later
+
+class Memo:
+    # LRU cache of a function's results by argument values, with hit/miss counts. purity is
+    # function_purity() of the definition, or None for `memo def`, whose results are always trusted.
+    def __init__(self, genv, purity):
+        self.genv, self.purity, self.limit = genv, purity, genv.memo_limit
+        self.results = OrderedDict()
+        self.hits = self.misses = 0
+        self.callees = None     # the callee values the cached results were computed with
+
+    def key(self, args):
+        # args as a dict key, or None when one of them is mutable (arrays, maps, slices) or a function
+        for arg in args:
+            if arg.__class__ is not int and arg.__class__ is not str: break
+        else:
+            return tuple(args)
+        key = []
+        for arg in args:
+            if arg.__class__ is int or arg.__class__ is str: key.append(arg)
+            elif arg.__class__ is bool or arg is None: key.append((arg,))     # True == 1 as a dict key
+            elif arg.__class__ is Rope: key.append(str(arg))
+            else: return None
+        return tuple(key)
+
+    def get(self, args):
+        # (key, cached result or MISSING); key is None when this call must not use the cache
+        key = self.key(args)
+        if key is None or self.purity is not None and not self.usable(): return None, MISSING
+        result = self.results.get(key, MISSING)
+        if result is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return key, result
+
+    def put(self, key, result):
+        if result is None or result.__class__ in MEMO_RESULTS:
+            results = self.results
+            results[key] = result
+            if len(results) > self.limit: results.popitem(last=False)
+
+    def usable(self):
+        # Whether calls still depend on nothing but their arguments: no assigned name has become a
+        # global, and every callee, directly or through other pure functions, is a pure builtin, a
+        # pure function or a `memo def`. Results are dropped once any of those callees has been rebound.
+        names, callees, pending = self.genv.vars, [], [self.purity]
+        for called, assigned, _ in pending:     # grows with the purity records of pure callees
+            for name in assigned:
+                if name in names: return False
+            for name in called:
+                value = names.get(name)
+                if value.__class__ is FunctionValue and (value.purity is not None or value.memo is not None):
+                    if value.purity is not None and value.purity not in pending: pending.append(value.purity)
+                elif value.__class__ is not BuiltinFunction or not value.pure:
+                    return False
+                callees.append(value)
+        if callees != self.callees:
+            self.results.clear()
+            self.callees = callees
+        return True
+
+def attach_memo(func_val, explicit, purity, env):
+    # Sets up result caching for a function value being defined in env. A top-level definition with a
+    # purity record is marked pure, and with memoize on it is cached when its body has a call or loop
+    # (a cheaper body costs less than the lookup); `memo def` functions are cached anywhere.
+    genv = env
+    while genv.__class__ is not Environment: genv = genv[0]     # closure-engine frames link outwards
+    while genv.parent is not None: genv = genv.parent
+    if purity is not None and genv is env: func_val.purity = purity
+    if not genv.memo_limit: return
+    if explicit: func_val.memo = Memo(genv, None)
+    elif genv.memoize and func_val.purity is not None and purity[2]: func_val.memo = Memo(genv, purity)
+
+UNBOUND = object()              # marks a frame slot whose variable has not been defined yet
+
+class Scope:                    # Static scope of a function body or catch block, resolved at compile time
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.slots = {}         # name -> index in the frame list; index 0 links to the enclosing frame/env
+
+    def declare(self, name):
+        if name not in self.slots: self.slots[name] = len(self.slots) + 1
+        return self.slots[name]
+
+    def collect(self, stmts):
+        # Every name this scope can bind at runtime: assignments and defs, but not inside
+        # nested function bodies or catch blocks, which get scopes of their own
+        pending = list(stmts)
+        while pending:
+            node = pending.pop()
+            if isinstance(node, (Assign, FunctionDef, ForLoop)):
+                self.declare(node.name)
+            if isinstance(node, FunctionDef):
+                continue
+            if isinstance(node, TryBlock):
+                pending.extend(node.body)
+                continue
+            pending.extend(child_nodes(node))
+
+    def resolve(self, name):
+        # Returns ([(depth, slot), ...] innermost first, depth of the global Environment)
+        candidates, depth, scope = [], 0, self
+        while scope is not None:
+            if name in scope.slots: candidates.append((depth, scope.slots[name]))
+            scope, depth = scope.parent, depth + 1
+        return candidates, depth
+
+def _hop(env, depth):
+    for _ in range(depth): env = env[0]
+    return env
+
+class SlotReference(Reference):   # A `ref` argument that points at a resolved variable in the caller's frame
+    def __init__(self, env, name, lookup, store):
+        self.env, self.name = env, name
+        self.lookup, self.store = lookup, store
+
+    def get(self):
+        return self.lookup(self.env)
+
+    def set(self, value):
+        self.store(self.env, value)
+
+class CompiledFunction:           # Compiled body of a studio6 function plus how to lay out its frame
+    def __init__(self, body, param_slots, size):
+        self.body = body
+        self.param_slots = param_slots
+        self.positional = param_slots == tuple(range(1, len(param_slots) + 1))
+        self.pad = (UNBOUND,) * (size - len(param_slots))
+        self.size = size
+
+
+class TailCall:                 # Callee and frame of a tail call, run by the caller's trampoline in compile_call
+    __slots__ = ("code", "frame", "func")
+    def __init__(self, code, frame, func): self.code, self.frame, self.func = code, frame, func
+
+class Completion:               # A return/raise handed up through statement blocks as a value, not a Python exception
+    __slots__ = ("raised", "value")
+    def __init__(self, raised, value): self.raised, self.value = raised, value
+
+def completes_abruptly(stmts):
+    # Whether a statement list can hand a Completion up: a return/raise in statement position,
+    # looking into if/while/try blocks but not into nested function bodies
+    for node in stmts:
+        kind = type(node)
+        if kind is Return or kind is Raise: return True
+        if kind is IfExpression and (completes_abruptly(node.then_branch) or completes_abruptly(node.else_branch)):
+            return True
+        if (kind is WhileLoop or kind is ForLoop) and completes_abruptly(node.body): return True
+        if kind is TryBlock and (completes_abruptly(node.body) or completes_abruptly(node.catch_body)):
+            return True
+    return False
+
+
+class Compiler:                 # Turns the AST into a tree of pre-bound closures, once. Each closure takes an env.
+    # Inside functions and catch blocks the env is a frame list [parent, slot1, ...] laid out by Scope;
+    # at the top level it is the global Environment.
+    # With completions=True, return/raise in statement position produce Completion records that blocks
+    # pass up to the function body or try that handles them; in expression position (x = if c { return 1; })
+    # they still raise ReturnException/ThrownException. completions=False raises everywhere.
+    def __init__(self, scope=None, completions=True):
+        self.scope = scope
+        self.completions = completions
+        self.hoisted = {}       # loop-invariant node -> its per-loop-entry memo list (compile_counted_while)
+        self.dispatch = {
+            Number: self.compile_constant, String: self.compile_constant, Bool: self.compile_constant,
+            ArrayLiteral: self.compile_array, BinOp: self.compile_binop, UnaryOp: self.compile_unary,
+            MapLiteral: self.compile_map,
+            Assign: self.compile_assign, AssignIndex: self.compile_assign_index, Var: self.compile_var,
+            Index: self.compile_index, Slice: self.compile_slice, IfExpression: self.compile_if,
+            WhileLoop: self.compile_while, FunctionDef: self.compile_function_def, Call: self.compile_call,
+            Return: self.compile_return, Raise: self.compile_raise, TryBlock: self.compile_try,
+            ForLoop: self.compile_for,
+        }
+
+    def compile(self, node):
+        method = self.dispatch.get(type(node))
+        if method is None:
+            raise TypeError(f"Unknown node type: {type(node)}")
+        if node in self.hoisted:
+            return self.compile_hoisted(self.hoisted[node], method(node), node)
+        return method(node)
+
+    def compile_statement(self, node):
+        # A statement directly inside a block: the only place a Completion may be produced
+        if self.completions:
+            kind = type(node)
+            if kind is Return:
+                value = self.compile_return_value(node)
+                return lambda env: Completion(False, value(env))
+            if kind is Raise:
+                expr = self.compile(node.expr)
+                return lambda env: Completion(True, expr(env))
+            if kind is IfExpression: return self.compile_if(node, True)
+            if kind is WhileLoop: return self.compile_while(node, True)
+            if kind is ForLoop: return self.compile_for(node, True)
+            if kind is TryBlock: return self.compile_try(node, True)
+        return self.compile(node)
+
+    def compile_top_level(self, node):
+        # Top-level statements turn a Completion back into the exceptions run() and repl() expect
+        step = self.compile_statement(node)
+        if not self.completions or not completes_abruptly([node]):
+            return step
+        def statement(env):
+            val = step(env)
+            if val.__class__ is Completion:
+                if val.raised: raise ThrownException(val.value)
+                raise ReturnException(val.value)
+            return val
+        return statement
+
+    def compile_block(self, stmts, statements=False):
+        # A block evaluates to its last non-None statement value, like the tree-walker.
+        # statements=True compiles it in statement position, passing any Completion straight up.
+        if statements and self.completions:
+            steps = tuple(self.compile_statement(s) for s in stmts)
+            if len(steps) > 1 and completes_abruptly(stmts):
+                def block(env):
+                    result = None
+                    for step in steps:
+                        val = step(env)
+                        if val is not None:
+                            if val.__class__ is Completion: return val
+                            result = val
+                    return result
+                return block
+        else:
+            steps = tuple(self.compile(s) for s in stmts)
+        if not steps:
+            return lambda env: None
+        if len(steps) == 1:
+            return steps[0]
+        def block(env):
+            result = None
+            for step in steps:
+                val = step(env)
+                if val is not None: result = val
+            return result
+        return block
+
+    def compile_constant(self, node):
+        value = node.value
+        return lambda env: value
+
+    def compile_array(self, node):
+        elements = tuple(self.compile(e) for e in node.elements)
+        return lambda env: [e(env) for e in elements]
+
+    def compile_map(self, node):
+        entries = tuple((self.compile(k), self.compile(v)) for k, v in zip(node.keys, node.values))
+        return lambda env: {map_key(k(env)): v(env) for k, v in entries}
+
+    def compile_binop(self, node):
+        op = node.op[0]
+        left, right = self.compile(node.left), self.compile(node.right)
+        if op == "AND":
+            def binop(env):
+                l = left(env)
+                if isinstance(l, Reference): l = l.get()
+                if not l: return l
+                r = right(env)
+                if isinstance(r, Reference): r = r.get()
+                return r
+            return binop
+        if op == "OR":
+            def binop(env):
+                l = left(env)
+                if isinstance(l, Reference): l = l.get()
+                if l: return l
+                r = right(env)
+                if isinstance(r, Reference): r = r.get()
+                return r
+            return binop
+        if op == "PLUS":
+            def binop(env):
+                l, r = left(env), right(env)
+                if l.__class__ is int and r.__class__ is int: return l + r     # int fast path
+                if isinstance(l, Reference): l = l.get()
+                if isinstance(r, Reference): r = r.get()
+                if isinstance(l, int) and isinstance(r, int): return l + r
+                if isinstance(l, STRINGS) and isinstance(r, STRINGS): return concat_strings(l, r)
+                if isinstance(l, LISTS) and isinstance(r, LISTS): return concat_arrays(l, r)
+                if isinstance(l, View) or isinstance(r, View): return concat_views(l, r)
+                raise TypeError("Unsupported operand types for +")
+            return binop
+        if op == "MINUS":
+            def binop(env):
+                l, r = left(env), right(env)
+                if l.__class__ is int and r.__class__ is int: return l - r     # int fast path
+                if isinstance(l, Reference): l = l.get()
+                if isinstance(r, Reference): r = r.get()
+                if isinstance(l, int) and isinstance(r, int): return l - r
+                raise TypeError("Unsupported operand types for -")
+            return binop
+        if op == "STAR":
+            def binop(env):
+                l, r = left(env), right(env)
+                if l.__class__ is int and r.__class__ is int: return l * r     # int fast path
+                if isinstance(l, Reference): l = l.get()
+                if isinstance(r, Reference): r = r.get()
+                if isinstance(l, int) and isinstance(r, int): return l * r
+                raise TypeError("Unsupported operand types for *")
+            return binop
+        if op == "SLASH":
+            def binop(env):
+                l, r = left(env), right(env)
+                if isinstance(l, Reference): l = l.get()
+                if isinstance(r, Reference): r = r.get()
+                if isinstance(l, int) and isinstance(r, int):
+                    if r == 0: raise ZeroDivisionError("division by zero")
+                    return l // r
+                raise TypeError("Unsupported operand types for /")
+            return binop
+        compare = {"EQ": operator.eq, "LT": operator.lt, "GT": operator.gt}.get(op)
+        if compare is None:
+            def binop(env):                 # unknown operators evaluate both sides to None, like evaluate()
+                left(env); right(env)
+                return None
+            return binop
+        def binop(env):
+            l, r = left(env), right(env)
+            if l.__class__ is int and r.__class__ is int: return compare(l, r)
+            if isinstance(l, Reference): l = l.get()
+            if isinstance(r, Reference): r = r.get()
+            return compare(l, r)
+        return binop
+
+    def compile_unary(self, node):
+        operand = self.compile(node.operand)
+        if node.op[0] == "NOT":
+            return lambda env: not operand(env)
+        if node.op[0] == "MINUS":
+            def negate(env):
+                val = operand(env)
+                if not isinstance(val, int): raise TypeError("Unary - expects number")
+                return -val
+            return negate
+        def unary(env):
+            operand(env)
+            return None
+        return unary
+
+    # Variable access. A name may be bound in several enclosing frames at runtime (Assign only defines
+    # when nothing up the chain holds it yet), so reads try each statically possible slot, innermost
+    # first, before falling back to the global Environment.
+    def compile_lookup(self, name):
+        if self.scope is None:
+            def lookup(env):
+                try: return env.vars[name]
+                except KeyError: return env.get(name)
+            return lookup
+        candidates, hops = self.scope.resolve(name)
+        if hops == 1:
+            def fallback(env):
+                env = env[0]
+                try: return env.vars[name]
+                except KeyError: return env.get(name)
+        else:
+            def fallback(env):
+                env = _hop(env, hops)
+                try: return env.vars[name]
+                except KeyError: return env.get(name)
+        if not candidates:
+            return fallback
+        if len(candidates) == 1 and candidates[0][0] == 0:
+            slot = candidates[0][1]
+            def lookup(env):
+                val = env[slot]
+                if val is UNBOUND: return fallback(env)
+                return val
+            return lookup
+        def lookup(env):
+            for depth, slot in candidates:
+                val = _hop(env, depth)[slot]
+                if val is not UNBOUND: return val
+            return fallback(env)
+        return lookup
+
+    def compile_store(self, name, define_missing=True):
+        # Assign semantics: update the innermost binding, else define in the current scope.
+        # With define_missing=False it behaves like Environment.set and raises NameError instead.
+        if self.scope is None:
+            if define_missing:
+                def store(env, val): env.vars[name] = val
+            else:
+                def store(env, val): env.set(name, val)
+            return store
+        candidates, hops = self.scope.resolve(name)
+        own = candidates[0][1] if candidates and candidates[0][0] == 0 else None
+        outer = tuple(c for c in candidates if c[0] > 0)
+        if own is not None and not outer and hops == 1 and define_missing:
+            def store(env, val):
+                if env[own] is UNBOUND:
+                    genv = env[0]
+                    if name in genv.vars:
+                        genv.vars[name] = val
+                        return
+                env[own] = val
+            return store
+        def store(env, val):
+            if own is not None and env[own] is not UNBOUND:
+                env[own] = val
+                return
+            for depth, slot in outer:
+                frame = _hop(env, depth)
+                if frame[slot] is not UNBOUND:
+                    frame[slot] = val
+                    return
+            genv = _hop(env, hops)
+            if name in genv.vars or not define_missing:
+                genv.set(name, val)
+            else:
+                env[own] = val
+        return store
+
+    def compile_define(self, name):
+        if self.scope is None:
+            def define(env, val): env.vars[name] = val
+        else:
+            slot = self.scope.declare(name)
+            def define(env, val): env[slot] = val
+        return define
+
+    def compile_assign(self, node):
+        value = self.compile(node.value)
+        if self.scope is not None:
+            candidates, hops = self.scope.resolve(node.name)
+            if len(candidates) == 1 and candidates[0][0] == 0 and hops == 1:
+                # Hot path: a function local with no other possible binding but the globals
+                name, slot = node.name, candidates[0][1]
+                def assign(env):
+                    val = value(env)
+                    if env[slot] is UNBOUND:
+                        genv = env[0]
+                        if name in genv.vars:
+                            genv.vars[name] = val
+                            return val
+                    env[slot] = val
+                    return val
+                return assign
+        store = self.compile_store(node.name)
+        def assign(env):
+            val = value(env)
+            store(env, val)
+            return val
+        return assign
+
+    def compile_assign_index(self, node):
+        lookup, value = self.compile_lookup(node.name), self.compile(node.value)
+        if not node.indices:
+            def missing(env):
+                value(env); lookup(env)
+                raise SyntaxError("Missing index for indexed assignment")
+            return missing
+        path = tuple(self.compile(i) for i in node.indices[:-1])
+        final = self.compile(node.indices[-1])
+        def assign_index(env):
+            val = value(env)
+            cur = lookup(env)
+            if isinstance(cur, Reference): cur = cur.get()
+            for index in path:
+                idx = index(env)
+                if isinstance(idx, Reference): idx = idx.get()
+                if cur.__class__ is dict:
+                    cur = map_get(cur, idx)
+                    continue
+                if not isinstance(idx, int):
+                    raise TypeError("Index must be an integer")
+                if not isinstance(cur, ARRAYS):
+                    raise TypeError("Indexed assignment only allowed on arrays (intermediate element not array)")
+                cur = cur[idx]
+            idx = final(env)
+            if isinstance(idx, Reference): idx = idx.get()
+            if cur.__class__ is dict:
+                cur[map_key(idx)] = val
+                return val
+            if not isinstance(idx, int):
+                raise TypeError("Index must be an integer")
+            if not isinstance(cur, ARRAYS):
+                raise TypeError("Indexed assignment only allowed on arrays")
+            cur[idx] = val
+            return val
+        return assign_index
+
+    def compile_var(self, node):
+        if self.scope is not None:
+            candidates, hops = self.scope.resolve(node.name)
+            if len(candidates) == 1 and candidates[0][0] == 0:
+                # Hot path: a local slot, inlined
+                slot, fallback = candidates[0][1], self.compile_lookup(node.name)
+                def var(env):
+                    val = env[slot]
+                    if val is UNBOUND: val = fallback(env)
+                    if isinstance(val, Reference): return val.get()
+                    return val
+                return var
+        lookup = self.compile_lookup(node.name)
+        def var(env):
+            val = lookup(env)
+            if isinstance(val, Reference): return val.get()
+            return val
+        return var
+
+    def compile_index(self, node):
+        collection, index = self.compile(node.collection), self.compile(node.index)
+        def index_read(env):
+            coll = collection(env)
+            if isinstance(coll, Reference): coll = coll.get()
+            idx = index(env)
+            if isinstance(idx, Reference): idx = idx.get()
+            if coll.__class__ is dict:
+                return map_get(coll, idx)
+            if not isinstance(idx, int):
+                raise TypeError("Index must be integer")
+            if isinstance(coll, SEQUENCES):
+                return coll[idx]
+            raise TypeError("Indexing only supported on arrays and strings")
+        return index_read
+
+    def compile_slice(self, node):
+        collection, lo, hi = self.compile(node.collection), self.compile(node.lo), self.compile(node.hi)
+        def slice_read(env):
+            coll = collection(env)
+            if isinstance(coll, Reference): coll = coll.get()
+            start, stop = lo(env), hi(env)
+            if isinstance(start, Reference): start = start.get()
+            if isinstance(stop, Reference): stop = stop.get()
+            return slice_view(coll, start, stop)
+        return slice_read
+
+    def compile_if(self, node, statement=False):
+        condition = self.compile(node.condition)
+        then_branch = self.compile_block(node.then_branch, statement)
+        else_branch = self.compile_block(node.else_branch, statement)
+        return lambda env: then_branch(env) if condition(env) else else_branch(env)
+
+    def compile_tracked(self, node, loop):
+        # While a Sampler is attached (Meter.stack is set), a loop is on the stack for as long as it runs
+        def tracked(env):
+            stack = METERS.meter.stack
+            if stack is None: return loop(env)
+            depth = len(stack)
+            stack.append(node)
+            result = loop(env)
+            del stack[depth:]
+            return result
+        return tracked
+
+    def compile_while(self, node, statement=False):
+        return self.compile_tracked(node, self.compile_while_loop(node, statement))
+
+    def compile_for(self, node, statement=False):
+        return self.compile_tracked(node, self.compile_for_loop(node, statement))
+
+    def compile_while_loop(self, node, statement):
+        loop = counted_loop(node)
+        if loop is not None:
+            return self.compile_counted_while(node, loop, statement)
+        condition = self.compile(node.condition)
+        if statement and self.completions and completes_abruptly(node.body):
+            body = tuple(self.compile_statement(s) for s in node.body)
+            def loop(env):
+                result, meter = None, METERS.meter
+                while condition(env):
+                    meter.left -= 1
+                    if meter.left < 0: meter.check()
+                    for step in body:
+                        val = step(env)
+                        if val is not None:
+                            if val.__class__ is Completion: return val
+                            result = val
+                return result
+            return loop
+        body = tuple(self.compile(s) for s in node.body)
+        def loop(env):
+            result, meter = None, METERS.meter
+            while condition(env):
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                for step in body:
+                    val = step(env)
+                    if val is not None: result = val
+            return result
+        return loop
+
+    def compile_for_loop(self, node, statement):
+        # A Python for loop over iterate(): no per-element test, Index or counter arithmetic
+        iterable, store = self.compile(node.iterable), self.compile_store(node.name)
+        if statement and self.completions and completes_abruptly(node.body):
+            body = tuple(self.compile_statement(s) for s in node.body)
+            def loop(env):
+                result, items, meter = None, iterable(env), METERS.meter
+                if isinstance(items, Reference): items = items.get()
+                for item in iterate(items):
+                    meter.left -= 1
+                    if meter.left < 0: meter.check()
+                    store(env, item)
+                    for step in body:
+                        val = step(env)
+                        if val is not None:
+                            if val.__class__ is Completion: return val
+                            result = val
+                return result
+            return loop
+        body = tuple(self.compile(s) for s in node.body)
+        def loop(env):
+            result, items, meter = None, iterable(env), METERS.meter
+            if isinstance(items, Reference): items = items.get()
+            for item in iterate(items):
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                store(env, item)
+                for step in body:
+                    val = step(env)
+                    if val is not None: result = val
+            return result
+        return loop
+
+    def compile_counted_while(self, node, loop, statement):
+        # `while i < n { ...; i = i + k; }` with the counter in a Python int. It is written to i before
+        # the body runs, so the body and anything it raises see the same i as in the generic loop, and
+        # the loop's value is the last value assigned to i. Without calls in the loop, nothing but the
+        # increment can change i: an invariant limit makes it a range() loop, and invariant
+        # subexpressions of the body are computed once per entry. Otherwise the limit is re-evaluated
+        # each time and a call that rebinds i hands the loop over to the generic one.
+        memos = []
+        for expr in loop_invariants(loop):
+            if expr not in self.hoisted:        # an enclosing loop may have hoisted it already
+                self.hoisted[expr] = memo = []
+                memos.append(memo)
+        checked = statement and self.completions and completes_abruptly(loop.body)
+        compile_step = self.compile_statement if checked else self.compile
+        body = tuple(compile_step(s) for s in loop.body)
+        increment = self.compile(node.body[-1])
+        condition, limit = self.compile(node.condition), self.compile(loop.limit)
+        lookup, store = self.compile_lookup(loop.name), self.compile_store(loop.name)
+        compare = operator.lt if node.condition.op[0] == "LT" else operator.gt
+        step, up, counter_first, guarded = loop.step, loop.step > 0, loop.counter_first, loop.calls
+
+        def resume(env, result):
+            # The generic loop, entered after a test that held
+            meter = METERS.meter
+            while True:
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                for run in body:
+                    val = run(env)
+                    if val is not None:
+                        if val.__class__ is Completion: return val
+                        result = val
+                result = increment(env)
+                if not condition(env): return result
+
+        def fallback(env, cur, stop, result):
+            # A counter or limit that is not an int: finish the test with the generic comparison
+            if isinstance(cur, Reference): cur = cur.get()
+            if isinstance(stop, Reference): stop = stop.get()
+            held = compare(cur, stop) if counter_first else compare(stop, cur)
+            return resume(env, result) if held else result
+
+        if loop.invariant:
+            def loop_(env):
+                if counter_first: cur, stop = lookup(env), limit(env)
+                else: stop, cur = limit(env), lookup(env)
+                for memo in memos: memo.clear()
+                if cur.__class__ is not int or stop.__class__ is not int:
+                    return fallback(env, cur, stop, None)
+                counts, meter = range(cur, stop, step), METERS.meter
+                if checked:
+                    for cur in counts:
+                        meter.left -= 1
+                        if meter.left < 0: meter.check()
+                        store(env, cur)
+                        for run in body:
+                            val = run(env)
+                            if val is not None and val.__class__ is Completion: return val
+                else:
+                    for cur in counts:
+                        meter.left -= 1
+                        if meter.left < 0: meter.check()
+                        store(env, cur)
+                        for run in body: run(env)
+                if not counts: return None
+                cur = counts[-1] + step
+                store(env, cur)
+                return cur
+            return loop_
+
+        def loop_(env):
+            if counter_first: cur, stop = lookup(env), limit(env)
+            else: stop, cur = limit(env), lookup(env)
+            result, meter = None, METERS.meter
+            for memo in memos: memo.clear()
+            while True:
+                if cur.__class__ is not int or stop.__class__ is not int:
+                    return fallback(env, cur, stop, result)
+                if not (cur < stop if up else cur > stop): return result
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                for run in body:
+                    val = run(env)
+                    if val is not None and val.__class__ is Completion: return val
+                if guarded and lookup(env) is not cur:
+                    # A call rebound the counter: from here on the generic loop runs
+                    result = increment(env)
+                    return resume(env, result) if condition(env) else result
+                cur += step
+                store(env, cur)
+                result = cur
+                stop = limit(env)
+        return loop_
+
+    def compile_hoisted(self, memo, expr, node):
+        # A loop-invariant expression: the first value computed after loop entry is reused if it and
+        # every variable it reads are immutable (a == b on lists changes when an element is written)
+        names, pending = set(), [node]
+        while pending:
+            child = pending.pop()
+            if type(child) is Var: names.add(child.name)
+            pending.extend(child_nodes(child))
+        operands = tuple(self.compile_lookup(name) for name in sorted(names))
+        def hoisted(env):
+            if memo: return memo[0]
+            val = expr(env)
+            if val.__class__ is int or val.__class__ is str or val.__class__ is bool:
+                for operand in operands:
+                    cls = operand(env).__class__
+                    if cls is not int and cls is not str and cls is not bool: return val
+                memo.append(val)
+            return val
+        return hoisted
+
+    def compile_function_def(self, node):
+        name, params = node.name, node.params
+        define = self.compile_define(name)
+        scope = Scope(self.scope)
+        param_slots = tuple(scope.declare(param_name) for _, param_name in params)
+        scope.collect(node.body)
+        body = Compiler(scope, self.completions).compile_function_body(node.body)
+        code = CompiledFunction(body, param_slots, len(scope.slots))
+        memo, purity = node.memo, function_purity(node)
+        def function_def(env):
+            func_val = FunctionValue(params, node.body, env)
+            func_val.code, func_val.name, func_val.line = code, name, node.line
+            attach_memo(func_val, memo, purity, env)
+            define(env, func_val)
+            return None
+        return function_def
+
+    def compile_function_body(self, stmts):
+        if self.completions:
+            return self.compile_function_completions(stmts)
+        steps = tuple(self.compile(s) for s in stmts)
+        def body(env):
+            try:
+                for step in steps:
+                    step(env)
+            except ReturnException as r:
+                return r.value
+            return None
+        return body
+
+    def compile_function_completions(self, stmts):
+        # The function boundary: a return Completion becomes the call's value, a raise one becomes a
+        # ThrownException so it can reach a try in any caller. Returns in expression position still raise.
+        # A trailing `return expr;` (the common shape) is evaluated directly, without a Completion.
+        tail = None
+        if stmts and type(stmts[-1]) is Return:
+            stmts, tail = stmts[:-1], self.compile_return_value(stmts[-1])
+        steps = tuple(self.compile_statement(s) for s in stmts)
+        if not completes_abruptly(stmts):
+            def body(env):
+                try:
+                    for step in steps:
+                        step(env)
+                    return tail(env) if tail is not None else None
+                except ReturnException as r:
+                    return r.value
+            return body
+        def body(env):
+            try:
+                for step in steps:
+                    val = step(env)
+                    if val.__class__ is Completion:
+                        if val.raised: raise ThrownException(val.value)
+                        return val.value
+                return tail(env) if tail is not None else None
+            except ReturnException as r:
+                return r.value
+        return body
+
+    def compile_call(self, node, tail=False):
+        # tail=True: `return f(...)`. The call returns a TailCall record to the body it is in, and the
+        # trampoline below runs it, so tail recursion needs no extra Python stack.
+        func_expr = self.compile(node.func_expr)
+        args = tuple(self.compile(a) for a in node.args)
+        # How to bind each argument to a `ref` parameter: (name, lookup, store), or None for non-variables
+        refs = tuple((a.name, self.compile_lookup(a.name), self.compile_store(a.name, define_missing=False))
+                     if isinstance(a, Var) else None for a in node.args)
+        nargs = len(args)
+        def call(env):
+            func = func_expr(env)
+            if isinstance(func, BuiltinFunction):
+                return func.fn([a(env) for a in args])
+            if not isinstance(func, FunctionValue):
+                raise TypeError("Attempted to call a non-function")
+            params = func.params
+            if nargs != len(params):
+                raise TypeError("Argument count mismatch")
+            code = func.code
+            frame = [func.env]
+            for (is_ref, param_name), arg, ref in zip(params, args, refs):
+                if is_ref:
+                    if ref is None:
+                        raise TypeError(f"ref parameter '{param_name}' must be a variable")
+                    frame.append(SlotReference(env, *ref))
+                else:
+                    frame.append(arg(env))
+            memo = None if tail else func.memo
+            if memo is not None:
+                key, result = memo.get(frame[1:])
+                if result is not MISSING: return result
+            if code.positional:
+                frame.extend(code.pad)
+            else:               # repeated parameter names: the last binding wins, as with env.define
+                values, frame = frame[1:], [func.env] + [UNBOUND] * code.size
+                for slot, val in zip(code.param_slots, values): frame[slot] = val
+            if tail:
+                return TailCall(code, frame, func)
+            meter = METERS.meter
+            meter.left -= 1                 # a step, and one more call running (studio6_limits)
+            if meter.left < 0: meter.check()
+            meter.depth += 1
+            if meter.depth > meter.max_depth: meter.exceeded("depth")
+            stack = meter.stack             # set while a Sampler runs; see Interpreter.stack
+            if stack is not None:
+                calls = len(stack)
+                stack.append(func)
+            result = code.body(frame)
+            while result.__class__ is TailCall:
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                if stack is not None:
+                    del stack[calls + 1:]
+                    stack[calls] = result.func
+                result = result.code.body(result.frame)
+            meter.depth -= 1
+            if stack is not None: del stack[calls:]
+            if memo is not None and key is not None: memo.put(key, result)
+            return result
+        return call
+
+    def compile_return_value(self, node):
+        if node.tail_call:
+            return self.compile_call(node.value, tail=True)
+        return self.compile(node.value)
+
+    def compile_return(self, node):
+        value = self.compile_return_value(node)
+        def return_(env):
+            raise ReturnException(value(env))
+        return return_
+
+    def compile_raise(self, node):
+        expr = self.compile(node.expr)
+        def raise_(env):
+            raise ThrownException(expr(env))
+        return raise_
+
+    def compile_try(self, node, statement=False):
+        body = self.compile_block(node.body, statement)
+        scope = Scope(self.scope)
+        scope.declare(node.catch_name)
+        scope.collect(node.catch_body)
+        catch_body = Compiler(scope, self.completions).compile_block(node.catch_body, statement)
+        pad = (UNBOUND,) * (len(scope.slots) - 1)
+        # A raise from inside calls skips their meter.depth decrements and stack truncations; the catch
+        # puts both back
+        if statement and self.completions and completes_abruptly(node.body):
+            def try_block(env):
+                meter = METERS.meter
+                depth, stack = meter.depth, meter.stack
+                calls = 0 if stack is None else len(stack)
+                try:
+                    val = body(env)
+                except ThrownException as exc:      # raised by a callee
+                    meter.depth = depth
+                    if stack is not None: del stack[calls:]
+                    return catch_body([env, exc.value, *pad])
+                if val.__class__ is Completion and val.raised:
+                    return catch_body([env, val.value, *pad])
+                return val
+            return try_block
+        def try_block(env):
+            meter = METERS.meter
+            depth, stack = meter.depth, meter.stack
+            calls = 0 if stack is None else len(stack)
+            try:
+                return body(env)
+            except ThrownException as exc:
+                meter.depth = depth
+                if stack is not None: del stack[calls:]
+                return catch_body([env, exc.value, *pad])
+        return try_block
+
+EOF_TOKEN = ("EOF", "")
+
 class Parser:                   # step 2 - builds the AST tree
-    def __init__(self, tokens): self.tokens, self.pos = tokens, 0
-    def current(self): return self.tokens[self.pos] if self.pos < len(self.tokens) else ("EOF","")  # Gets current token
+    # tokens may be the list from lex() or a lazy stream like tokenize(); they are pulled one at a time
+    def __init__(self, tokens):
+        self.tokens, self.pos = iter(tokens), 0
+        self.tok = next(self.tokens, EOF_TOKEN)     # current token
+        self.lookahead = deque()                    # tokens pulled early by peek()
+    def current(self): return self.tok  # Gets current token
     def peek(self, offset=1):
-        i = self.pos + offset
-        return self.tokens[i] if i < len(self.tokens) else ("EOF","") # Check the next token without consuming. AI recommended this
+        if offset <= 0: return self.tok
+        while len(self.lookahead) < offset: self.lookahead.append(next(self.tokens, EOF_TOKEN))
+        return self.lookahead[offset - 1] # Check the next token without consuming. AI recommended this
     def eat(self, kind):
-        if self.current()[0] == kind: self.pos += 1
-        else: raise SyntaxError(f"Expected {kind}, got {self.current()[0]}") # Consume the current token and move on
+        if self.tok[0] == kind:
+            self.tok = self.lookahead.popleft() if self.lookahead else next(self.tokens, EOF_TOKEN)
+            self.pos += 1
+        else: raise SyntaxError(f"Expected {kind}, got {self.tok[0]}") # Consume the current token and move on
+    def advance(self):  # eat() for when the caller has already checked the token kind
+        self.tok = self.lookahead.popleft() if self.lookahead else next(self.tokens, EOF_TOKEN)
+        self.pos += 1
+    def line(self):     # source line of the current token; tokens from lex() carry no positions
+        return self.tok[2] if len(self.tok) > 2 else None
 
     def parse(self):
-        nodes = []
-        while self.current()[0] != "EOF": # This method stops at the end of the file
-            nodes.append(self.statement())
-            if self.current()[0] == "SEMI": self.eat("SEMI")
-        return nodes
+        return list(self.statements())
+
+    def statements(self):
+        # Top-level statements one at a time, for consumers that do not keep the whole tree
+        while self.tok[0] != "EOF": # This method stops at the end of the file
+            node = self.statement()
+            mark_global_sites([node])
+            yield node
+            if self.tok[0] == "SEMI": self.advance()
 
     def statement(self):
-        tok = self.current()[0]
+        tok = self.tok[0]
 
-        if tok == "DEF":
-            return self.parse_function_def()
+        if tok == "DEF" or tok == "ID" and self.tok[1] == "memo" and self.peek()[0] == "DEF":
+            return self.parse_function_def()    # `memo` is only a keyword right before def
 
         elif tok == "RETURN":
             self.eat("RETURN")
             expr = self.expr()
-            if self.current()[0] == "SEMI": self.eat("SEMI")
+            if self.tok[0] == "SEMI": self.eat("SEMI")
             return Return(expr)
 
         elif tok == "RAISE":
             self.eat("RAISE")
             expr = self.expr()
-            if self.current()[0] == "SEMI": self.eat("SEMI")
+            if self.tok[0] == "SEMI": self.eat("SEMI")
             return Raise(expr)
 
         elif tok == "TRY":
@@ -455,9 +1847,9 @@ class Parser:                   # step 2 - builds the AST tree
 
         self.eat("CATCH")
         self.eat("LPAREN")
-        if self.current()[0] != "ID":
+        if self.tok[0] != "ID":
             raise SyntaxError("Expected identifier in catch(...)")
-        catch_name = self.current()[1]
+        catch_name = self.tok[1]
         self.eat("ID")
         self.eat("RPAREN")
 
@@ -466,145 +1858,218 @@ class Parser:                   # step 2 - builds the AST tree
         return TryBlock(try_body, catch_name, catch_body)
 
     def parse_function_def(self):
+        line = self.line()
+        memo = self.tok[0] == "ID"
+        if memo: self.advance()
         self.eat("DEF")
-        if self.current()[0] != "ID":
+        if self.tok[0] != "ID":
             raise SyntaxError("Expected function name after 'def'")
-        name = self.current()[1]; self.eat("ID")
+        name = self.tok[1]; self.eat("ID")
         params = []
         self.eat("LPAREN")
-        while self.current()[0] != "RPAREN":
+        while self.tok[0] != "RPAREN":
             is_ref = False
-            if self.current()[0] == "REF":
+            if self.tok[0] == "REF":
                 is_ref = True
                 self.eat("REF")
-            if self.current()[0] != "ID":
+            if self.tok[0] != "ID":
                 raise SyntaxError("Expected parameter name")
-            param_name = self.current()[1]; self.eat("ID")
+            param_name = self.tok[1]; self.eat("ID")
             params.append((is_ref, param_name))
-            if self.current()[0] == "COMMA": self.eat("COMMA")
+            if self.tok[0] == "COMMA": self.eat("COMMA")
             else: break
         self.eat("RPAREN")
+        if memo and any(is_ref for is_ref, _ in params):
+            raise SyntaxError("memo functions cannot take ref parameters")
         body = self.parse_block()
-        return FunctionDef(name, params, body)
+        mark_tail_calls(body)
+        node = FunctionDef(name, params, body, memo)
+        node.line = line
+        return node
 
     def assignment(self):
-        if self.current()[0] == "ID":
+        if self.tok[0] == "ID":
             # Peek for simple assignment
             if self.peek()[0] == "ASSIGN":
-                name = self.current()[1]; self.eat("ID")
+                name = self.tok[1]; self.eat("ID")
                 self.eat("ASSIGN")
                 return Assign(name, self.conditional())
             # Peek for indexed assignment (arr[...]=...)
             if self.peek()[0] == "LBRACK":
-                # parse name and a sequence of index expressions
-                name = self.current()[1]; self.eat("ID")
-                indices = []
-                while self.current()[0] == "LBRACK":
-                    self.eat("LBRACK")
-                    indices.append(self.expr())
-                    self.eat("RBRACK")
-                # If followed by ASSIGN, create AssignIndex; otherwise fall back to an expression
-                if self.current()[0] == "ASSIGN":
-                    self.eat("ASSIGN")
-                    return AssignIndex(name, indices, self.conditional())
-                # not an assignment -> build Index/Var chain and return as expression
+                # parse name and a sequence of subscripts
+                name = self.tok[1]; self.eat("ID")
                 node = Var(name)
-                for idx_ast in indices:
-                    node = Index(node, idx_ast)
+                while self.tok[0] == "LBRACK":
+                    node = self.parse_subscript(node)
+                # If followed by ASSIGN, create AssignIndex; otherwise it is an Index/Slice expression
+                if self.tok[0] == "ASSIGN":
+                    self.eat("ASSIGN")
+                    indices = []
+                    while isinstance(node, Index):
+                        indices.append(node.index)
+                        node = node.collection
+                    if not isinstance(node, Var):
+                        raise SyntaxError("Cannot assign to a slice; assign to a variable holding it")
+                    return AssignIndex(name, indices[::-1], self.conditional())
                 return node
         return self.conditional() # Recursive Descent downward
 
     def conditional(self):
-        if self.current()[0] == "IF":
+        if self.tok[0] == "IF":
             self.eat("IF")
             cond = self.logic()
             then_branch = []
-            if self.current()[0] == "LBRACE": then_branch = self.parse_block()
+            if self.tok[0] == "LBRACE": then_branch = self.parse_block()
             else: then_branch = [self.expr()]
-            if self.current()[0] == "ELSE":
+            if self.tok[0] == "ELSE":
                 self.eat("ELSE")
-                else_branch = self.parse_block() if self.current()[0] == "LBRACE" else [self.expr()]
+                else_branch = self.parse_block() if self.tok[0] == "LBRACE" else [self.expr()]
             else: else_branch = []
             return IfExpression(cond, then_branch, else_branch)
-        elif self.current()[0] == "WHILE":
+        elif self.tok[0] == "WHILE":
+            line = self.line()
             self.eat("WHILE")
             cond = self.logic()
             body = self.parse_block()
-            return WhileLoop(cond, body)
+            node = WhileLoop(cond, body)
+            node.line = line
+            return node
+        elif self.tok[0] == "FOR":
+            line = self.line()
+            self.eat("FOR")
+            if self.tok[0] != "ID":
+                raise SyntaxError("Expected loop variable name")
+            name = self.tok[1]; self.eat("ID")
+            self.eat("IN")
+            iterable = self.logic()
+            node = ForLoop(name, iterable, self.parse_block())
+            node.line = line
+            return node
         else: return self.logic() # Recursive descent downward
 
-    def logic(self):
-        node = self.expr() # Recursive descent downward
-        while self.current()[0] in ("EQ","LT","GT","AND","OR"):
-            op = self.current(); self.eat(op[0])
-            node = BinOp(node, op, self.expr())
-        return node
-
-    def expr(self):
-        node = self.term() # Recursive Descent downward
-        while self.current()[0] in ("PLUS","MINUS"):
-            op = self.current(); self.eat(op[0])
-            node = BinOp(node, op, self.term())
-        return node
-
-    def term(self):
-        node = self.factor() # Recursive Descent downward
-        while self.current()[0] in ("STAR","SLASH"):
-            op = self.current(); self.eat(op[0])
-            node = BinOp(node, op, self.factor())
-        return node
-
-    def factor(self): # This is the bottom level of my Recursive Descent
-        tok = self.current()
-        if tok[0] == "NUM": self.eat("NUM"); return Number(tok[1])
-        elif tok[0] == "STRING":
-            self.eat("STRING")
-            return String(tok[1])
-        elif tok[0] == "ID":
-            name = tok[1]; self.eat("ID")
-            node = Var(name)
+    # Binary operators by precedence level, all left-associative. logic() parses from level 1,
+    # expr() from level 2 and term() from level 3, matching the grammar levels they used to be.
+    BINARY_PRECEDENCE = {"EQ": 1, "LT": 1, "GT": 1, "AND": 1, "OR": 1,
+                         "PLUS": 2, "MINUS": 2, "STAR": 3, "SLASH": 3}
+    PREFIX_OPERATORS = {"PLUS": None, "MINUS": ("MINUS", "-"), "NOT": ("NOT", "not")}
+
+    def logic(self): return self.parse_expression(1)
+    def expr(self): return self.parse_expression(2)
+    def term(self): return self.parse_expression(3)
+    def factor(self): return self.parse_expression(4)   # a single operand with its prefix operators
+
+    def parse_expression(self, min_prec):
+        # Operator-precedence parsing with explicit operand/operator stacks: no Python call per
+        # grammar level, and a parenthesised sub-expression saves the current stacks instead of
+        # recursing, so deep nesting cannot hit the recursion limit.
+        precedence, prefix_operators = self.BINARY_PRECEDENCE, self.PREFIX_OPERATORS
+        kind = self.tok[0]
+        if kind not in prefix_operators and kind != "LPAREN":
+            node = self.primary()
+            prec = precedence.get(self.tok[0])
+            if prec is None or prec < min_prec:
+                return node                         # the common case: a lone operand
+            operands, operators, prefixes, saved = [], [], [], []
+        else:
+            operands, operators, prefixes, saved = [], [], [], []
+            node = None
+        while True:
+            if node is None:
+                while self.tok[0] in prefix_operators:
+                    prefixes.append(prefix_operators[self.tok[0]]); self.advance()
+                if self.tok[0] == "LPAREN":
+                    self.advance()
+                    saved.append((operands, operators, prefixes, min_prec))
+                    operands, operators, prefixes, min_prec = [], [], [], 2    # ( expr )
+                    continue
+                node = self.primary()
+            while True:
+                if prefixes:
+                    for op in reversed(prefixes):   # unary + builds no node
+                        if op is not None: node = UnaryOp(op, node)
+                    prefixes = []
+                operands.append(node)
+                prec = precedence.get(self.tok[0])
+                if prec is not None and prec >= min_prec:
+                    while operators and operators[-1][0] >= prec:
+                        op = operators.pop()[1]; right = operands.pop()
+                        operands[-1] = BinOp(operands[-1], op, right)
+                    operators.append((prec, self.tok)); self.advance()
+                    node = None
+                    break                           # on to the next operand
+                while operators:
+                    op = operators.pop()[1]; right = operands.pop()
+                    operands[-1] = BinOp(operands[-1], op, right)
+                node = operands[0]
+                if not saved:
+                    return node
+                self.eat("RPAREN")
+                while self.tok[0] == "LPAREN":      # (f)(x): calls after a parenthesised primary
+                    node = Call(node, self.parse_argument_list())
+                operands, operators, prefixes, min_prec = saved.pop()
+
+    def primary(self): # This is the bottom level of my Recursive Descent
+        tok = self.tok
+        if tok[0] == "ID":
+            self.advance()
+            node = Var(tok[1])
             # allow calls after any primary, and allow indexing
             while True:
-                if self.current()[0] == "LPAREN":
+                if self.tok[0] == "LPAREN":
                     args = self.parse_argument_list()
                     node = Call(node, args)
                     continue
-                if self.current()[0] == "LBRACK":
-                    # parse single index and wrap into Index node
-                    self.eat("LBRACK")
-                    idx = self.expr()
-                    self.eat("RBRACK")
-                    node = Index(node, idx)
+                if self.tok[0] == "LBRACK":
+                    node = self.parse_subscript(node)
                     continue
                 break
             return node
+        elif tok[0] == "NUM": self.advance(); return Number(tok[1])
+        elif tok[0] == "STRING":
+            self.advance()
+            return String(tok[1])
         elif tok[0] == "LBRACK":
             # array literal: [ a, b, c ]
-            self.eat("LBRACK")
+            self.advance()
             elements = []
-            while self.current()[0] != "RBRACK":
+            while self.tok[0] != "RBRACK":
                 elements.append(self.expr())
-                if self.current()[0] == "COMMA": self.eat("COMMA")
+                if self.tok[0] == "COMMA": self.eat("COMMA")
                 else: break
             self.eat("RBRACK")
             return ArrayLiteral(elements)
-        elif tok[0] == "PLUS": self.eat("PLUS"); return self.factor()
-        elif tok[0] == "MINUS": self.eat("MINUS"); return UnaryOp(("MINUS","-"), self.factor())
-        elif tok[0] == "NOT": self.eat("NOT"); return UnaryOp(("NOT","not"), self.factor())
-        elif tok[0] == "LPAREN":
-            self.eat("LPAREN"); node = self.expr(); self.eat("RPAREN")
-            while self.current()[0] == "LPAREN":
-                args = self.parse_argument_list()
-                node = Call(node, args)
-            return node
+        elif tok[0] == "LBRACE":
+            # map literal: { key: value, ... }
+            self.advance()
+            keys, values = [], []
+            while self.tok[0] != "RBRACE":
+                keys.append(self.expr())
+                self.eat("COLON")
+                values.append(self.expr())
+                if self.tok[0] == "COMMA": self.eat("COMMA")
+                else: break
+            self.eat("RBRACE")
+            return MapLiteral(keys, values)
         else: raise SyntaxError(f"Unexpected token {tok}")
 
+    def parse_subscript(self, node):
+        # [index] or [lo:hi] after node; a missing lo is 0 and a missing hi is the end
+        self.eat("LBRACK")
+        lo = Number(0) if self.tok[0] == "COLON" else self.expr()
+        if self.tok[0] == "COLON":
+            self.advance()
+            hi = Number(SLICE_END) if self.tok[0] == "RBRACK" else self.expr()
+            self.eat("RBRACK")
+            return Slice(node, lo, hi)
+        self.eat("RBRACK")
+        return Index(node, lo)
+
     def parse_argument_list(self):
         args = []
         self.eat("LPAREN")
-        while self.current()[0] != "RPAREN":
+        while self.tok[0] != "RPAREN":
             args.append(self.expr())
-            if self.current()[0] == "COMMA": self.eat("COMMA")
+            if self.tok[0] == "COMMA": self.eat("COMMA")
             else: break
         self.eat("RPAREN")
         return args
@@ -612,32 +2077,82 @@ class Parser:                   # step 2 - builds the AST tree
     def parse_block(self):
         self.eat("LBRACE")
         stmts = []
-        while self.current()[0] != "RBRACE":
+        while self.tok[0] != "RBRACE":
             stmts.append(self.statement())
-            if self.current()[0] == "SEMI": self.eat("SEMI")
+            if self.tok[0] == "SEMI": self.eat("SEMI")
         self.eat("RBRACE")
         return stmts
 
-def run(code):
-    tokens = lex(code)
-    parser = Parser(tokens)
-    tree = parser.parse()
-    interp = Interpreter()
+def parse_program(code, optimize=0):
+    # Source text to AST. optimize > 0 rewrites the tree with the studio6_optimizer passes up to that level.
+    tree = Parser(tokenize(code)).parse()     # tokens are consumed lazily by the parser
+    if optimize:
+        from studio6_optimizer import optimize as optimize_tree
+        tree = optimize_tree(tree, optimize)
+    return tree
+
+def compile_program(tree, engine="closure"):
+    # Engine-specific executable form of a parsed program, independent of any Interpreter:
+    # "closure" compiles the tree up front; "tree" walks it with evaluate() (kept for comparison);
+    # "vm" compiles to bytecode for the stack machine in studio6_vm; "flat" encodes it as the arrays
+    # of studio6_flat.FlatProgram.
+    if engine == "closure":
+        compiler = Compiler()
+        return [compiler.compile_top_level(node) for node in tree]
+    if engine == "tree":
+        return list(tree)
+    if engine == "vm":
+        from studio6_vm import compile_statement
+        return [compile_statement(node) for node in tree]
+    if engine == "flat":
+        from studio6_flat import encode
+        return encode(tree)
+    raise ValueError(f"Unknown engine {engine!r}")
+
+def run(code, engine="closure", cache=None, optimize=0, memo_limit=None, profile=None, sample=None, limits=None,
+        interpreter=None, memoize=False):
+    # profile: True prints a studio6_profile report to stderr afterwards, a studio6_profile.Profile
+    # collects one. Either way the program runs on the instrumented tree-walker. sample: a
+    # studio6_profile.Sampler, which samples Interpreter.stack while the program runs; the tree-walker
+    # keeps that stack, and the closure engine keeps it in Meter.stack while one is attached.
+    # limits: a studio6_limits.Limits; going over one raises LimitExceeded, and limits.usage is set after.
+    # interpreter: an Interpreter to run in, with the globals it has (see Interpreter.reset), instead of a new one.
+    # memoize: cache the results of pure functions automatically (see attach_memo); `memo def` always is.
+    if profile:
+        from studio6_profile import Profile, ProfilingInterpreter
+        report, profile = profile is True, Profile() if profile is True else profile
+        interp, engine, cache = ProfilingInterpreter(profile, memo_limit, memoize), "tree", None
+    else:
+        interp = Interpreter(memo_limit, memoize) if interpreter is None else interpreter
+    if sample is not None and engine not in ("tree", "closure"):
+        raise ValueError("sampling needs engine='tree' or engine='closure'")
+    if cache is not None:       # e.g. studio6_cache.ProgramCache: skips lexing/parsing/compiling on a hit
+        steps = interp.bind(cache.load(code, engine, optimize), engine)
+    else:
+        tree = parse_program(code, optimize)
+        steps = interp.prepare(tree, engine)
 
     last_value = None
 
+    if sample is not None: sample.start(interp)
     try:
-        for node in tree:
-            val = interp.evaluate(node)
-            # ignore built-in function definitions
-            if val is not None and not isinstance(val, BuiltinFunction):
-                last_value = val
+        with METERS.meter.limit(limits) as meter:
+            if sample is not None: meter.stack = interp.stack
+            for step in steps:
+                val = step(interp.env)
+                # ignore built-in function definitions
+                if val is not None and not isinstance(val, BuiltinFunction):
+                    last_value = val
     except ThrownException as e:
         raise RuntimeError(f"Uncaught exception: {e.value}")
+    finally:
+        if sample is not None: sample.stop()
 
+    if profile and report: print(profile.report(), file=sys.stderr)
     return last_value
 
-def repl():
+def repl(engine="closure", optimize=0, limits=None):
+    # limits: a studio6_limits.Limits applied to each line separately
     interp = Interpreter()
     while True:
         try:
@@ -650,11 +2165,15 @@ def repl():
                 tokens.insert(-1, ("SEMI",";"))
             parser = Parser(tokens)
             tree = parser.parse()           
+            if optimize:
+                from studio6_optimizer import optimize as optimize_tree
+                tree = optimize_tree(tree, optimize)
             result = None
-            for node in tree:
-                val = interp.evaluate(node)
-                if val is not None:
-                    result = val
+            with METERS.meter.limit(limits):
+                for step in interp.prepare(tree, engine):
+                    val = step(interp.env)
+                    if val is not None:
+                        result = val
             if result is not None:
                 print(result)
         except Exception as e:
@@ -0,0 +1,510 @@
+# Array and string representations for the studio6 language besides plain lists and strs:
+#   IntArray  64-bit signed ints stored unboxed in an array.array; the bulk builtins below work on
+#             whole arrays in C instead of in studio6 loops
+#   Range     what range() returns: the ints are computed on demand until something writes to it
+#   Vector    a persistent balanced tree of chunks, built by `+` on long arrays, so appending to or
+#             concatenating arrays costs O(log n) instead of a full copy
+#   Rope      a long string built by `+`, kept as its pieces and joined once when it is read, so
+#             s = s + t in a loop is linear overall instead of quadratic
+#   View      what a slice a[lo:hi] evaluates to: a window onto an array, IntArray or string that
+#             shares its storage
+# NumPy is used for the bulk operations when it is installed; results are the same without it.
+#   zeros(n)  range(stop) / range(start, stop[, step])  array_from(arr)
+#   sum(arr)  min(arr)  max(arr)  add(a, b)  mul(a, b)  dot(a, b)  sort(arr)
+# add and mul work elementwise on two arrays of the same length, or on an array and an int.
+# Every builtin also accepts a plain array of ints, which is converted first.
+#   join(arr, sep)  the strings in arr with sep between them, in one pass
+# The elements and characters that + and the builtins build are charged to studio6_limits first.
+import operator
+from array import array
+from itertools import chain, islice, repeat
+
+from studio6_limits import METERS
+
+try:
+    import numpy
+except ImportError:             # the array module does everything, only the bulk operations are slower
+    numpy = None
+
+INT64_LIMIT = 2 ** 63           # NumPy int64 arithmetic wraps around here; exact Python ints are used past it
+CHUNK = 32                      # most elements in one Vector leaf
+VECTOR_MIN = 64                 # `+` results shorter than this stay plain lists
+ROPE_MIN = 256                  # `+` results shorter than this stay plain strs
+
+
+class IntArray(array):
+    # Indexes, index assignment and len work as on arrays; storing a value that is not a 64-bit int
+    # raises TypeError/OverflowError
+    def __new__(cls, values=()):
+        return super().__new__(cls, "q", values)
+
+    def __eq__(self, other): return self.tolist() == _value(other)
+    def __lt__(self, other): return self.tolist() < _value(other)
+    def __gt__(self, other): return self.tolist() > _value(other)
+
+    def __str__(self):
+        return str(self.tolist())
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
+class Range:
+    # The ints of range(start, stop, step), computed on demand: len, indexing and for loops take
+    # constant memory at any size. The first index assignment, directly or through a slice, copies
+    # the ints into an IntArray that the Range uses from then on.
+    __slots__ = ("range", "values")
+    __hash__ = None
+
+    def __init__(self, *args):
+        self.range, self.values = range(*args), None
+
+    def ints(self):
+        return self.range if self.values is None else self.values
+
+    def __len__(self):
+        return len(self.ints())
+
+    def __getitem__(self, index):
+        return self.ints()[index]
+
+    def __setitem__(self, index, value):
+        if self.values is None:
+            METERS.meter.allocate(len(self.range))
+            self.values = IntArray(self.range)
+        self.values[index] = value
+
+    def __iter__(self):
+        return iter(self.values) if self.values is not None else self._follow()
+
+    def _follow(self):
+        # Like a list iterator, sees writes made while it runs: once one has copied the ints into
+        # values, the rest are read from there
+        ints = self.range
+        for value in ints:
+            if self.values is not None:
+                index = (value - ints.start) // ints.step
+                yield from map(self.values.__getitem__, range(index, len(self.values)))
+                return
+            yield value
+
+    def __eq__(self, other): return list(self.ints()) == _value(other)
+    def __lt__(self, other): return list(self.ints()) < _value(other)
+    def __gt__(self, other): return list(self.ints()) > _value(other)
+    def __str__(self): return str(list(self.ints()))
+    def __repr__(self): return repr(list(self.ints()))
+
+
+# Vector trees. A leaf is a tuple of up to CHUNK elements; a _Node joins two subtrees and caches their
+# size and height. Trees are never changed once built, so any number of Vectors can share subtrees,
+# and the AVL rule (child heights differ by at most one) keeps every path O(log n) long.
+class _Node:
+    __slots__ = ("left", "right", "size", "height")
+    def __init__(self, left, right):
+        self.left, self.right = left, right
+        self.size = _size(left) + _size(right)
+        self.height = 1 + max(_height(left), _height(right))
+
+def _size(tree):
+    return len(tree) if tree.__class__ is tuple else tree.size
+
+def _height(tree):
+    return 0 if tree.__class__ is tuple else tree.height
+
+def _join(left, right):
+    # left followed by right, in O(height difference). A leaf is pushed down the facing spine of
+    # the other tree, so appending elements one at a time still fills leaves up to CHUNK.
+    if not _size(left): return right
+    if not _size(right): return left
+    hl, hr = _height(left), _height(right)
+    if hl > hr + 1 or hr == 0 < hl:
+        return _balance(left.left, _join(left.right, right))
+    if hr > hl + 1 or hl == 0 < hr:
+        return _balance(_join(left, right.left), right.right)
+    if hl == 0 and len(left) + len(right) <= CHUNK:
+        return left + right
+    return _Node(left, right)
+
+def _balance(left, right):
+    # _Node(left, right), rotated once if a join left the heights two apart
+    hl, hr = _height(left), _height(right)
+    if hl > hr + 1:
+        if _height(left.left) >= _height(left.right):
+            return _Node(left.left, _Node(left.right, right))
+        middle = left.right
+        return _Node(_Node(left.left, middle.left), _Node(middle.right, right))
+    if hr > hl + 1:
+        if _height(right.right) >= _height(right.left):
+            return _Node(_Node(left, right.left), right.right)
+        middle = right.left
+        return _Node(_Node(left, middle.left), _Node(middle.right, right.right))
+    return _Node(left, right)
+
+def _build(values):
+    # A balanced tree holding a list's elements
+    leaves = [tuple(values[i:i + CHUNK]) for i in range(0, len(values), CHUNK)]
+    def build(lo, hi):
+        if hi - lo == 1: return leaves[lo]
+        mid = (lo + hi) // 2
+        return _Node(build(lo, mid), build(mid, hi))
+    return build(0, len(leaves)) if leaves else ()
+
+def _set(tree, index, value):
+    # A copy of the path to index with value stored there; the rest of the tree is shared
+    if tree.__class__ is tuple:
+        return tree[:index] + (value,) + tree[index + 1:]
+    n = _size(tree.left)
+    if index < n:
+        return _Node(_set(tree.left, index, value), tree.right)
+    return _Node(tree.left, _set(tree.right, index - n, value))
+
+def _leaves(tree):
+    stack = [tree]
+    while stack:
+        tree = stack.pop()
+        if tree.__class__ is tuple:
+            yield tree
+        else:
+            stack.append(tree.right)
+            stack.append(tree.left)
+
+
+class Vector:
+    # A studio6 array held as a Vector tree. Variables share the Vector object itself, so a[i] = x,
+    # which swaps in a path-copied root, is seen through every alias of a, while arrays built from a
+    # by + keep the subtrees they share unchanged. Reads, writes, appends and concatenation are O(log n).
+    __slots__ = ("root",)
+    __hash__ = None
+
+    def __init__(self, root=()):
+        self.root = root
+
+    def __len__(self):
+        return _size(self.root)
+
+    def _position(self, index):
+        n = _size(self.root)
+        if index < 0: index += n
+        if not 0 <= index < n:
+            raise IndexError("list index out of range")
+        return index
+
+    def __getitem__(self, index):
+        index, tree = self._position(index), self.root
+        while tree.__class__ is not tuple:
+            n = _size(tree.left)
+            if index < n:
+                tree = tree.left
+            else:
+                index -= n
+                tree = tree.right
+        return tree[index]
+
+    def __setitem__(self, index, value):
+        self.root = _set(self.root, self._position(index), value)
+
+    def __iter__(self):
+        # Like a list iterator, sees writes made while it runs: a[i] = x swaps in a new root, and from
+        # then on the rest of the elements are read by index from the current one
+        root = self.root
+        for index, element in enumerate(chain.from_iterable(_leaves(root))):
+            if self.root is not root:
+                yield from map(self.__getitem__, range(index, len(self)))
+                return
+            yield element
+
+    def tolist(self):
+        return list(chain.from_iterable(_leaves(self.root)))
+
+    def __eq__(self, other): return self.tolist() == _value(other)
+    def __lt__(self, other): return self.tolist() < _value(other)
+    def __gt__(self, other): return self.tolist() > _value(other)
+    def __str__(self): return str(self.tolist())
+    def __repr__(self): return repr(self.tolist())
+
+def concat_arrays(left, right):
+    # `+` on two arrays. Two typed int arrays (IntArray or Range) give an IntArray. Otherwise short
+    # results are plain lists and longer ones Vectors that share the trees of Vector operands, so
+    # acc = acc + [x] in a loop is O(log n) per step.
+    if isinstance(left, (IntArray, Range)) and isinstance(right, (IntArray, Range)):
+        METERS.meter.allocate(len(left) + len(right))
+        result = IntArray(left.ints() if left.__class__ is Range else left)
+        result.extend(right.ints() if right.__class__ is Range else right)
+        return result
+    if isinstance(left, (IntArray, Range)): left = list(left)
+    if isinstance(right, (IntArray, Range)): right = list(right)
+    if left.__class__ is list and right.__class__ is list and len(left) + len(right) < VECTOR_MIN:
+        METERS.meter.allocate(len(left) + len(right))
+        return left + right
+    METERS.meter.allocate(len(left) + len(right))     # charged at full length though Vector operands are shared
+    left = left.root if left.__class__ is Vector else _build(left)
+    right = right.root if right.__class__ is Vector else _build(right)
+    return Vector(_join(left, right))
+
+
+class Rope:
+    # A string held as the pieces that were added to make it: pieces[:count] joined. s + t appends t
+    # to the shared piece list when s is the newest rope over it, so every rope in an s = s + t chain
+    # keeps its own contents while the loop copies nothing. Reads (indexing, comparisons, printing)
+    # join the pieces once and keep the str; len never needs to.
+    __slots__ = ("pieces", "count", "length", "text")
+
+    def __init__(self, pieces, length):
+        self.pieces, self.count, self.length, self.text = pieces, len(pieces), length, None
+
+    def __str__(self):
+        if self.text is None:
+            self.text = "".join(self.pieces[:self.count])
+            self.pieces, self.count = [self.text], 1     # later appends start from the joined text
+        return self.text
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return str(self)[index]
+
+    def __iter__(self):
+        return iter(str(self))
+
+    def __eq__(self, other): return str(self) == _value(other)
+    def __lt__(self, other): return str(self) < _value(other)
+    def __gt__(self, other): return str(self) > _value(other)
+    def __hash__(self): return hash(str(self))
+    def __repr__(self): return repr(str(self))
+
+def concat_strings(left, right):
+    # `+` on two strings (strs or Ropes). Short results are plain strs; longer ones are Ropes that
+    # append to the left operand's pieces, joining only a Rope on the right.
+    length = len(left) + len(right)
+    if right.__class__ is Rope: right = str(right)
+    if left.__class__ is not Rope:
+        if length < ROPE_MIN:
+            METERS.meter.allocate(length)
+            return left + right
+        METERS.meter.allocate(length)              # a new Rope holds both strs
+        return Rope([left, right], length)
+    METERS.meter.allocate(len(right))              # only right is added to the rope's pieces
+    if not right: return left
+    pieces = left.pieces
+    if len(pieces) != left.count:               # a rope built from left already appended here
+        pieces = pieces[:left.count]
+    pieces.append(right)
+    return Rope(pieces, length)
+
+
+class View:
+    # Elements start..stop-1 of base, which is never another View. Reads and writes go to base, so a
+    # slice costs O(1) and writing to it changes the array it was taken from. Operations that need a
+    # value of their own (+, comparisons, printing) work on materialize().
+    __slots__ = ("base", "start", "stop")
+    __hash__ = None
+
+    def __init__(self, base, start, stop):
+        self.base, self.start, self.stop = base, start, stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def _position(self, index):
+        n = self.stop - self.start
+        if index < 0: index += n
+        if not 0 <= index < n:
+            raise IndexError("index out of range")
+        return self.start + index
+
+    def __getitem__(self, index):
+        return self.base[self._position(index)]
+
+    def __setitem__(self, index, value):
+        if isinstance(self.base, str):
+            raise TypeError("Indexed assignment only allowed on arrays")
+        self.base[self._position(index)] = value
+
+    def __iter__(self):
+        return map(self.base.__getitem__, range(self.start, self.stop))
+
+    def materialize(self):
+        # A copy of the elements, of the same type as base
+        base, start, stop = self.base, self.start, self.stop
+        if isinstance(base, Range):
+            if base.values is None:
+                return IntArray(base.range[start:stop])
+            base = base.values
+        if isinstance(base, IntArray):
+            return IntArray(memoryview(base).cast("B")[8 * start:8 * stop].tobytes())
+        if isinstance(base, Vector):
+            return list(islice(base, start, stop))
+        return base[start:stop]
+
+    def __eq__(self, other): return self.materialize() == _value(other)
+    def __lt__(self, other): return self.materialize() < _value(other)
+    def __gt__(self, other): return self.materialize() > _value(other)
+    def __str__(self): return str(self.materialize())
+    def __repr__(self): return repr(self.materialize())
+
+def _value(value):
+    if isinstance(value, View): return value.materialize()
+    if isinstance(value, Vector): return value.tolist()
+    if isinstance(value, Rope): return str(value)
+    if isinstance(value, Range): return list(value.ints())
+    if isinstance(value, IntArray): return value.tolist()
+    return value
+
+def slice_view(value, lo, hi):
+    # value[lo:hi] with Python's rules for negative and out-of-range bounds
+    if not isinstance(lo, int) or not isinstance(hi, int):
+        raise TypeError("Slice bounds must be integers")
+    if isinstance(value, Rope):
+        value = str(value)
+    if isinstance(value, View):
+        start, stop, _ = slice(lo, hi).indices(value.stop - value.start)
+        return View(value.base, value.start + start, value.start + max(start, stop))
+    if isinstance(value, (list, str, IntArray, Vector, Range)):
+        start, stop, _ = slice(lo, hi).indices(len(value))
+        return View(value, start, max(start, stop))
+    raise TypeError("Slicing only supported on arrays and strings")
+
+
+def _expect(name, args, *counts):
+    if len(args) not in counts:
+        expected = " or ".join(map(str, counts))
+        raise TypeError(f"{name} expects {expected} argument{'s' if counts != (1,) else ''}")
+
+def _ints(name, value):
+    # An IntArray for a builtin's array argument; a converted copy is charged like any other array
+    if isinstance(value, View):
+        METERS.meter.allocate(len(value))
+        value = value.materialize()
+    if isinstance(value, IntArray):
+        return value
+    if isinstance(value, Range):
+        METERS.meter.allocate(len(value))
+        return IntArray(value.ints())
+    if isinstance(value, (list, Vector)):
+        METERS.meter.allocate(len(value))
+        try:
+            return IntArray(value)
+        except (TypeError, OverflowError):
+            raise TypeError(f"{name} expects an array of 64-bit integers") from None
+    raise TypeError(f"{name} expects an array")
+
+def _view(values):
+    # The array's buffer as a NumPy vector, without copying
+    return numpy.frombuffer(values, dtype=numpy.int64)
+
+def _magnitude(vector):
+    return max(-int(vector.min()), int(vector.max())) if len(vector) else 0
+
+
+def builtin_zeros(args):
+    _expect("zeros", args, 1)
+    n = args[0]
+    if not isinstance(n, int):
+        raise TypeError("zeros expects an integer length")
+    if n < 0:
+        raise ValueError("zeros expects a non-negative length")
+    METERS.meter.allocate(n)
+    return IntArray(bytes(8 * n))
+
+def builtin_range(args):
+    _expect("range", args, 1, 2, 3)
+    if not all(isinstance(arg, int) for arg in args):
+        raise TypeError("range expects integer arguments")
+    return Range(*args)
+
+def builtin_array_from(args):
+    _expect("array_from", args, 1)
+    values = _ints("array_from", args[0])
+    METERS.meter.allocate(len(values))
+    return IntArray(values) if values is args[0] else values
+
+def builtin_sum(args):
+    _expect("sum", args, 1)
+    values = _ints("sum", args[0])
+    if numpy is not None:
+        vector = _view(values)
+        if _magnitude(vector) * len(vector) < INT64_LIMIT:
+            return int(vector.sum())
+    return sum(values)
+
+def _extreme(name, pick):
+    def builtin(args):
+        _expect(name, args, 1)
+        values = _ints(name, args[0])
+        if not values:
+            raise ValueError(f"{name} of an empty array")
+        if numpy is not None:
+            return int(getattr(_view(values), name)())
+        return pick(values)
+    return builtin
+
+builtin_min = _extreme("min", min)
+builtin_max = _extreme("max", max)
+
+def _elementwise(name, apply, fits):
+    # add/mul: two arrays of the same length, or an array and an int on either side
+    def builtin(args):
+        _expect(name, args, 2)
+        a, b = args
+        if isinstance(a, int) and not isinstance(b, int):
+            a, b = b, a
+        a = _ints(name, a)
+        METERS.meter.allocate(len(a))
+        if isinstance(b, int):
+            if numpy is not None and fits(_magnitude(_view(a)), abs(b)):
+                return IntArray(apply(_view(a), b).tobytes())
+            return IntArray(map(apply, a, repeat(b)))
+        b = _ints(name, b)
+        if len(a) != len(b):
+            raise ValueError(f"{name} expects arrays of the same length")
+        if numpy is not None and fits(_magnitude(_view(a)), _magnitude(_view(b))):
+            return IntArray(apply(_view(a), _view(b)).tobytes())
+        return IntArray(map(apply, a, b))
+    return builtin
+
+builtin_add = _elementwise("add", operator.add, lambda x, y: x + y < INT64_LIMIT)
+builtin_mul = _elementwise("mul", operator.mul, lambda x, y: x * y < INT64_LIMIT)
+
+def builtin_dot(args):
+    _expect("dot", args, 2)
+    a, b = _ints("dot", args[0]), _ints("dot", args[1])
+    if len(a) != len(b):
+        raise ValueError("dot expects arrays of the same length")
+    if numpy is not None:
+        x, y = _view(a), _view(b)
+        if _magnitude(x) * _magnitude(y) * len(x) < INT64_LIMIT:
+            return int(numpy.dot(x, y))
+    return sum(map(operator.mul, a, b))
+
+def builtin_sort(args):
+    # A sorted copy; the argument is left as it is
+    _expect("sort", args, 1)
+    values = _ints("sort", args[0])
+    METERS.meter.allocate(len(values))
+    if numpy is not None:
+        return IntArray(numpy.sort(_view(values)).tobytes())
+    return IntArray(sorted(values))
+
+def builtin_join(args):
+    # The strings in an array joined with sep between them; the result is built in one pass
+    _expect("join", args, 2)
+    values, sep = args
+    if not isinstance(values, (list, Vector, View)) or isinstance(values, View) and isinstance(values.base, str):
+        raise TypeError("join expects an array of strings")
+    if not isinstance(sep, (str, Rope)):
+        raise TypeError("join separator must be a string")
+    pieces = [_value(value) for value in values]
+    if not all(isinstance(piece, str) for piece in pieces):
+        raise TypeError("join expects an array of strings")
+    sep = str(sep)
+    METERS.meter.allocate(sum(map(len, pieces)) + len(sep) * max(len(pieces) - 1, 0))
+    return sep.join(pieces)
+
+
+BUILTINS = {
+    "zeros": builtin_zeros, "range": builtin_range, "array_from": builtin_array_from,
+    "sum": builtin_sum, "min": builtin_min, "max": builtin_max,
+    "add": builtin_add, "mul": builtin_mul, "dot": builtin_dot, "sort": builtin_sort,
+    "join": builtin_join,
+}
@@ -0,0 +1,159 @@
+# Runs many independent studio6 programs on a pool of worker processes, one program per job.
+# Each worker process keeps one Interpreter and an in-memory ProgramCache for its lifetime. Every job
+# starts from Interpreter.reset(), so nothing but the builtins carries over from the job before, and
+# what a job prints is captured on its own. Jobs go to the workers in chunks, so small programs do not
+# each pay for a round trip between processes.
+# Usage: for result in run_many(sources, workers=4): print(result.value, result.output, result.error)
+# stream(sources, ordered=False) yields each JobResult as soon as its job finishes instead.
+# python studio6_batch.py [--workers N] [--engine closure] [--unordered] [--json] [--steps N] program.s6 ...
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+from multiprocessing import Pool
+from time import perf_counter
+
+from studio6 import Interpreter, FunctionValue, SEQUENCES, STRINGS, View, run
+from studio6_cache import ProgramCache
+from studio6_limits import METERS, Limits
+
+CHUNK_MAX = 64          # most jobs sent to a worker at once
+CHUNK_STREAM = 8        # jobs per chunk when the number of sources is not known up front
+RESULT_MAX = 10 ** 7    # elements and characters a job's value may have when no allocation limit is set
+
+
+class JobResult:
+    def __init__(self, index, value, output, error, seconds, usage=None):
+        self.index = index          # position of the source in the input
+        self.value = value          # what run() returned, as plain Python data (see _portable)
+        self.output = output        # everything the job printed
+        self.error = error          # None or "ExceptionType: message"; a raise nothing caught is
+                                    # "RuntimeError: Uncaught exception: <value>"
+        self.seconds = seconds
+        self.usage = usage          # studio6_limits usage when limits were given
+
+    def __repr__(self):
+        outcome = f"error={self.error!r}" if self.error is not None else f"value={self.value!r}"
+        return f"JobResult({self.index}, {outcome}, output={self.output!r})"
+
+
+def _portable(value, meter):
+    # A job's value as data that pickles back to the parent process: strings become strs, arrays
+    # lists, maps dicts and functions a description. Each string, array and map is charged to meter
+    # before it is copied, so a lazy range(10 ** 12) fails with LimitExceeded instead of filling memory.
+    if value is None or value.__class__ in (int, bool):
+        return value
+    if isinstance(value, STRINGS) or isinstance(value, View) and isinstance(value.base, str):
+        meter.allocate(len(value))
+        return str(value)
+    if isinstance(value, SEQUENCES):
+        meter.allocate(len(value))
+        return [_portable(element, meter) for element in value]
+    if value.__class__ is dict:
+        meter.allocate(len(value))
+        return {key: _portable(element, meter) for key, element in value.items()}
+    if isinstance(value, FunctionValue):
+        return f"<function {value.name}>" if value.name else "<function>"
+    return repr(value)
+
+
+class Worker:
+    # What one process keeps from job to job
+    def __init__(self, engine="closure", optimize=0, memo_limit=None, limits=None):
+        self.engine, self.optimize, self.limits = engine, optimize, limits
+        self.interp = Interpreter(memo_limit)
+        self.cache = ProgramCache(directory=None)
+
+    def run(self, job):
+        index, source = job
+        self.interp.reset()
+        if self.limits is not None: self.limits.usage = None
+        output, value, error = io.StringIO(), None, None
+        start = perf_counter()
+        try:
+            with contextlib.redirect_stdout(output):
+                result = run(source, self.engine, self.cache, self.optimize, limits=self.limits,
+                             interpreter=self.interp)
+            # The copy is limited by what is left of the job's allocation limit, or by RESULT_MAX
+            room = RESULT_MAX
+            if self.limits is not None and self.limits.allocation is not None:
+                room = self.limits.allocation - self.limits.usage["allocation"]
+            with METERS.meter.limit(Limits(allocation=room)) as meter:
+                value = _portable(result, meter)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        usage = self.limits.usage if self.limits is not None else None
+        return JobResult(index, value, output.getvalue(), error, perf_counter() - start, usage)
+
+
+_worker = None          # the Worker of this pool process
+
+def _start_worker(*settings):
+    global _worker
+    _worker = Worker(*settings)
+
+def _run_job(job):
+    return _worker.run(job)
+
+
+def stream(sources, workers=None, ordered=True, engine="closure", optimize=0, memo_limit=None, limits=None,
+           chunksize=None):
+    # Yields one JobResult per source: in input order, or with ordered=False as the jobs finish.
+    # workers: number of processes, default one per core; 0 runs the jobs in this process.
+    # limits: a studio6_limits.Limits applied to each job separately.
+    jobs = enumerate(sources)
+    settings = (engine, optimize, memo_limit, limits)
+    if workers == 0:
+        yield from map(Worker(*settings).run, jobs)
+        return
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = (max(1, min(CHUNK_MAX, len(sources) // (4 * workers))) if hasattr(sources, "__len__")
+                     else CHUNK_STREAM)
+    with Pool(workers, _start_worker, settings) as pool:
+        yield from (pool.imap if ordered else pool.imap_unordered)(_run_job, jobs, chunksize)
+
+def run_many(sources, workers=None, engine="closure", optimize=0, memo_limit=None, limits=None):
+    # A JobResult per source, in input order
+    return list(stream(sources, workers, True, engine, optimize, memo_limit, limits))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="studio6_batch.py")
+    parser.add_argument("programs", nargs="+", help="studio6 source files, one job each")
+    parser.add_argument("--workers", type=int, help="processes (default: one per core, 0: no pool)")
+    parser.add_argument("--engine", default="closure")
+    parser.add_argument("--optimize", type=int, default=0)
+    parser.add_argument("--unordered", action="store_true", help="report each job as soon as it finishes")
+    parser.add_argument("--json", action="store_true", help="one JSON object per job")
+    parser.add_argument("--steps", type=int)
+    parser.add_argument("--seconds", type=float)
+    parser.add_argument("--depth", type=int)
+    parser.add_argument("--allocation", type=int)
+    args = parser.parse_args(argv)
+    sources = []
+    for path in args.programs:
+        with open(path) as f:
+            sources.append(f.read())
+    limits = None
+    if (args.steps, args.seconds, args.depth, args.allocation) != (None,) * 4:
+        limits = Limits(args.steps, args.seconds, args.depth, args.allocation)
+    failed = False
+    for result in stream(sources, args.workers, not args.unordered, args.engine, args.optimize, limits=limits):
+        path = args.programs[result.index]
+        failed = failed or result.error is not None
+        if args.json:
+            print(json.dumps({"program": path, "value": result.value, "output": result.output,
+                              "error": result.error, "seconds": result.seconds}))
+            continue
+        print(f"==> {path} <==")
+        sys.stdout.write(result.output)
+        if result.error is not None: print("Error:", result.error)
+        elif result.value is not None: print(result.value)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
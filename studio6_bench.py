@@ -0,0 +1,221 @@
+# Micro-benchmarks for the studio6 interpreter.
+# python studio6_bench.py [calls]
+# Benchmark suite: lexing, parsing and evaluation timed separately on canonical workloads, on every
+# engine, with peak memory and a cross-engine check of the output. Results can be saved as JSON and
+# compared against a saved baseline:
+# python studio6_bench.py suite [--json out.json] [--baseline base.json] [--threshold 0.1] [--scale 1]
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+from studio6 import BuiltinFunction, Compiler, Interpreter, Parser, lex, parse_program
+
+# Programs that make CALLS calls to a small function; each spends most of its time in return/raise
+CONTROL_FLOW = {
+    "return": """
+        def f(x) { if x < 0 { return 0; } return x + 1; }
+        i = 0; while i < CALLS { i = f(i); }
+    """,
+    "loop-return": """
+        def f(x) { while 1 { return x + 1; } }
+        i = 0; while i < CALLS { i = f(i); }
+    """,
+    "raise-catch": """
+        def f(x) { try { raise x; } catch(e) { return e + 1; } }
+        i = 0; while i < CALLS { i = f(i); }
+    """,
+    "raise-caller": """
+        def fail(x) { raise x; }
+        def f(x) { try { fail(x); } catch(e) { return e + 1; } }
+        i = 0; while i < CALLS { i = f(i); }
+    """,
+}
+
+
+def time_program(code, completions, repeat=5):
+    # Best wall time of running an already compiled program with the closure engine
+    tree = parse_program(code)
+    best = float("inf")
+    for _ in range(repeat):
+        compiler = Compiler(completions=completions)
+        steps = [compiler.compile_top_level(node) for node in tree]
+        env = Interpreter().env
+        start = time.perf_counter()
+        for step in steps:
+            step(env)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_control_flow(calls=100000):
+    # Per-call nanoseconds with return/raise as Python exceptions vs as Completion records
+    rows = []
+    for name, template in CONTROL_FLOW.items():
+        code = template.replace("CALLS", str(calls))
+        raising, signalled = time_program(code, False), time_program(code, True)
+        rows.append((name, raising / calls * 1e9, signalled / calls * 1e9))
+    return rows
+
+
+# Suite workloads: (source with SIZE in it, SIZE at scale 1). Memoization is off while they run, so
+# fib measures calls rather than cache hits.
+WORKLOADS = {
+    "fib": ("""
+        def fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); }
+        fib(SIZE);
+    """, 17),
+    "loops": ("""
+        total = 0; i = 0;
+        while i < SIZE { j = 0; while j < SIZE { total = total + i * j - (i + j) / 3; j = j + 1; } i = i + 1; }
+        total;
+    """, 120),
+    "arrays": ("""
+        a = zeros(SIZE); b = []; i = 0;
+        while i < SIZE { a[i] = i * 3 + 1; b = b + [i]; i = i + 1; }
+        s = 0; i = 0;
+        while i < SIZE { s = s + a[i] + b[i]; b[i] = s; i = i + 1; }
+        [s, sum(a), b[SIZE - 1]];
+    """, 4000),
+    "strings": ("""
+        words = ["alpha", "beta", "gamma"]; s = ""; i = 0;
+        while i < SIZE { s = s + words[i - i / 3 * 3] + ","; i = i + 1; }
+        [len(s), s[0:11], len(join([s, s], ";"))];
+    """, 4000),
+    "exceptions": ("""
+        def check(n) { if n - n / 7 * 7 == 0 { raise n; } return n; }
+        caught = 0; total = 0; i = 0;
+        while i < SIZE {
+            try { total = total + check(i); } catch(e) { caught = caught + e; }
+            i = i + 1;
+        }
+        print(caught); total;
+    """, 4000),
+    "closures": ("""
+        def outer(n) {
+            base = n;
+            def middle(m) {
+                def inner(ref acc, k) { acc[0] = acc[0] + base + m + k; return acc[0]; }
+                return inner;
+            }
+            return middle;
+        }
+        acc = [0]; i = 0;
+        while i < SIZE { f = outer(i); g = f(1); g(acc, 2); i = i + 1; }
+        acc[0];
+    """, 2000),
+}
+ENGINES = ("tree", "closure", "vm", "flat")
+
+def workload_source(name, scale=1.0):
+    template, size = WORKLOADS[name]
+    return template.replace("SIZE", str(max(1, int(size * scale))))
+
+def best_per_call(fn, repeat=3, min_time=0.02):
+    # Best seconds per call of fn over `repeat` rounds of enough calls to take min_time
+    number = 1
+    while True:
+        elapsed = _timed(fn, number)
+        if elapsed >= min_time or number >= 1 << 16: break
+        number *= 2
+    return min([elapsed] + [_timed(fn, number) for _ in range(repeat - 1)]) / number
+
+def _timed(fn, number):
+    start = time.perf_counter()
+    for _ in range(number): fn()
+    return time.perf_counter() - start
+
+def peak_bytes(fn):
+    # Peak traced allocation while fn runs
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def evaluator(tree, engine):
+    # A function running the compiled program in a fresh global environment each time; it returns
+    # what the program printed and the value run() would return, as text
+    interp = Interpreter()
+    steps = interp.prepare(tree, engine)
+    def evaluate():
+        interp.env = env = Interpreter(memo_limit=0).env     # the tree-walker reads globals from interp.env
+        last_value, out = None, io.StringIO()
+        with contextlib.redirect_stdout(out):
+            for step in steps:
+                val = step(env)
+                if val is not None and not isinstance(val, BuiltinFunction): last_value = val
+        return out.getvalue(), repr(last_value)
+    return evaluate
+
+def bench_suite(names=None, engines=ENGINES, scale=1.0, repeat=3):
+    # {"results": {"fib/lex": {...}, "fib/eval/vm": {...}, ...}, "mismatches": [...]}. Each result has
+    # seconds per run, ops_per_sec and, for parse and eval, peak_bytes.
+    results, mismatches = {}, []
+    for name in names or WORKLOADS:
+        code = workload_source(name, scale)
+        tokens = lex(code)
+        phases = {"lex": lambda: lex(code), "parse": lambda: Parser(tokens).parse()}
+        outputs = {}
+        for engine in engines:
+            run_program = evaluator(parse_program(code), engine)
+            outputs[engine] = run_program()
+            phases[f"eval/{engine}"] = run_program
+        for phase, fn in phases.items():
+            seconds = best_per_call(fn, repeat)
+            results[f"{name}/{phase}"] = entry = {"seconds": seconds, "ops_per_sec": 1 / seconds}
+            if phase != "lex": entry["peak_bytes"] = peak_bytes(fn)
+        reference = outputs[engines[0]]
+        mismatches += [f"{name}: {engine} gave {output!r}, {engines[0]} gave {reference!r}"
+                       for engine, output in outputs.items() if output != reference]
+    return {"python": sys.version.split()[0], "scale": scale, "results": results, "mismatches": mismatches}
+
+def regressions(current, baseline, threshold=0.1):
+    # (key, baseline seconds, current seconds) for each result over threshold slower than the baseline
+    found = []
+    for key, entry in current["results"].items():
+        before = baseline["results"].get(key)
+        if before is not None and entry["seconds"] > before["seconds"] * (1 + threshold):
+            found.append((key, before["seconds"], entry["seconds"]))
+    return found
+
+def suite_main(argv):
+    parser = argparse.ArgumentParser(prog="studio6_bench.py suite")
+    parser.add_argument("workloads", nargs="*", help=f"any of {', '.join(WORKLOADS)} (default: all)")
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies each workload's size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, 0.1 = 10%%")
+    args = parser.parse_args(argv)
+    current = bench_suite(args.workloads, tuple(args.engines.split(",")), args.scale, args.repeat)
+    print(f"{'benchmark':24}{'ops/sec':>12}{'ms':>10}{'peak KiB':>10}")
+    for key, entry in current["results"].items():
+        peak = f"{entry['peak_bytes'] / 1024:10.0f}" if "peak_bytes" in entry else ""
+        print(f"{key:24}{entry['ops_per_sec']:12.1f}{entry['seconds'] * 1000:10.2f}{peak}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(current, f, indent=1)
+    failed = bool(current["mismatches"])
+    for mismatch in current["mismatches"]:
+        print("MISMATCH", mismatch)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key, before, after in regressions(current, baseline, args.threshold):
+            print(f"REGRESSION {key}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({after / before - 1:+.0%})")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["suite"]:
+        sys.exit(suite_main(sys.argv[2:]))
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{'per call':14}{'exceptions':>12}{'completions':>13}{'saving':>8}")
+    for name, raising, signalled in bench_control_flow(calls):
+        print(f"{name:14}{raising:9.0f} ns{signalled:10.0f} ns{1 - signalled / raising:8.0%}")
@@ -0,0 +1,135 @@
+# Cache of parsed/compiled studio6 programs, keyed by source hash.
+# Two layers: an in-process LRU of ready-to-bind programs, and a directory of pickled entries
+# (the AST, or the compiled form for engine="vm" and engine="flat"), like CPython's .pyc files.
+# Usage: cache = ProgramCache(); run(code, cache=cache)
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import studio6
+
+DEFAULT_DIR = os.environ.get("STUDIO6_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "studio6"))
+SUFFIX = ".s6c"
+PICKLED_ENGINES = ("vm", "flat")     # engines whose compiled program is stored as is
+
+
+def _interpreter_version():
+    # Entries are only valid for the exact lexer/parser/compiler that wrote them
+    digest = hashlib.sha256()
+    for module in ("studio6.py", "studio6_vm.py", "studio6_optimizer.py", "studio6_flat.py"):
+        path = os.path.join(os.path.dirname(os.path.abspath(studio6.__file__)), module)
+        try:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        except OSError:
+            digest.update(module.encode())
+    return digest.hexdigest()[:16]
+
+INTERPRETER_VERSION = _interpreter_version()
+
+
+class ProgramCache:
+    def __init__(self, directory=DEFAULT_DIR, max_bytes=64 * 1024 * 1024, memory_entries=256):
+        # directory=None disables the on-disk layer
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()     # (engine, optimize, source) -> program from studio6.compile_program
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self, code, engine="closure", optimize=0):
+        key = (engine, optimize, code)
+        program = self.memory.get(key)
+        if program is not None:
+            self.memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return program
+
+        program = self.build(code, engine, optimize)
+        self.memory[key] = program
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+        return program
+
+    def build(self, code, engine, optimize=0):
+        # Closure programs hold Python closures, so on disk they are stored as the AST and recompiled
+        form = (engine if engine in PICKLED_ENGINES else "ast") + (f"-O{optimize}" if optimize else "")
+        path = self.path_for(code, form)
+        stored = self.read(path)
+        if stored is not None:
+            self.stats["disk_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            tree = studio6.parse_program(code, optimize)
+            stored = studio6.compile_program(tree, engine) if engine in PICKLED_ENGINES else tree
+            self.write(path, stored)
+        return stored if engine in PICKLED_ENGINES else studio6.compile_program(stored, engine)
+
+    def path_for(self, code, form):
+        if self.directory is None:
+            return None
+        digest = hashlib.sha256(f"{INTERPRETER_VERSION}\0{form}\0".encode() + code.encode()).hexdigest()
+        return os.path.join(self.directory, digest + SUFFIX)
+
+    def read(self, path):
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                version, payload = pickle.load(f)
+        except Exception:       # truncated or corrupt entry: drop it and rebuild
+            self.remove(path)
+            return None
+        if version != INTERPRETER_VERSION:
+            self.remove(path)
+            return None
+        os.utime(path)          # mtime doubles as last-use time for eviction
+        return payload
+
+    def write(self, path, payload):
+        if path is None:
+            return
+        try:
+            data = pickle.dumps((INTERPRETER_VERSION, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        except RecursionError:  # extremely deep trees are simply not persisted
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)   # atomic, so concurrent readers never see half an entry
+        self.evict()
+
+    def evict(self):
+        # Drop least recently used entries until the directory fits in max_bytes
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        self.memory.clear()
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(SUFFIX):
+                    self.remove(os.path.join(self.directory, name))
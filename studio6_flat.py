@@ -0,0 +1,445 @@
+# Flat struct-of-arrays encoding of studio6 programs, and an evaluator that runs from it directly.
+# Node i is kinds[i] plus three int fields a[i], b[i], c[i]: child node indices, pool indices, or
+# offsets into `items`, where a list of nodes is stored as [length, node, node, ...]. Literals, names,
+# operators (as (kind, text), without source positions) and parameter lists live in small
+# deduplicated pools. A node costs 13 bytes instead of a Python object with its own __dict__,
+# so many large programs can stay resident in one process.
+# Usage: run(code, engine="flat"), or program = parse_flat(code); program.save(path); FlatProgram.load(path)
+import pickle
+import sys
+import tracemalloc
+from array import array
+
+from studio6 import (
+    Number, String, Bool, ArrayLiteral, MapLiteral, BinOp, UnaryOp, FunctionDef, Call, FunctionValue,
+    BuiltinFunction, Environment, Assign, AssignIndex, Var, Index, IfExpression, WhileLoop, ForLoop,
+    Return, ReturnException, TailCallException, Reference, Raise, TryBlock, ThrownException,
+    Slice, Parser, tokenize, SEQUENCES, ARRAYS, LISTS, STRINGS, View, concat_arrays, concat_strings,
+    concat_views, slice_view, map_key, map_get, iterate, function_purity, attach_memo, MISSING,
+)
+from studio6_limits import METERS
+
+NODE_TYPES = (Number, String, Bool, ArrayLiteral, BinOp, UnaryOp, FunctionDef, Call, Assign,
+              AssignIndex, Var, Index, IfExpression, WhileLoop, Return, Raise, TryBlock, Slice,
+              MapLiteral, ForLoop)
+(NUMBER, STRING, BOOL, ARRAY, BINOP, UNARY, FUNCTION_DEF, CALL, ASSIGN,
+ ASSIGN_INDEX, VAR, INDEX, IF, WHILE, RETURN, RAISE, TRY, SLICE, MAP, FOR) = range(len(NODE_TYPES))
+KIND = {node_type: kind for kind, node_type in enumerate(NODE_TYPES)}
+FORMAT = "studio6-flat-2"
+
+
+class FlatProgram:
+    def __init__(self):
+        self.kinds = array("B")
+        self.a, self.b, self.c = array("i"), array("i"), array("i")
+        self.items = array("i")         # node lists: [length, node, node, ...]
+        self.top = array("i")           # top-level statements
+        self.consts, self.names, self.ops, self.params = [], [], [], []
+        self.pool_index = {}            # (pool name, key) -> index; only needed while encoding
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def statements(self):
+        return self.top
+
+    def list_at(self, offset):
+        return self.items[offset + 1:offset + 1 + self.items[offset]]
+
+    # Encoding
+    def pool(self, field, key, value):
+        index = self.pool_index.get((field, key))
+        if index is None:
+            pool = getattr(self, field)
+            index = self.pool_index[(field, key)] = len(pool)
+            pool.append(value)
+        return index
+
+    def const(self, value): return self.pool("consts", (type(value), value), value)
+    def name(self, name): return self.pool("names", name, name)
+
+    def add_list(self, indices):
+        offset = len(self.items)
+        self.items.append(len(indices))
+        self.items.extend(indices)
+        return offset
+
+    def add(self, node):
+        # Encodes node and its subtree, returning its index
+        kind = KIND.get(type(node))
+        if kind is None:
+            raise TypeError(f"Unknown node type: {type(node)}")
+        if kind <= BOOL: a, b, c = self.const(node.value), 0, 0
+        elif kind == ARRAY: a, b, c = self.add_block(node.elements), 0, 0
+        elif kind == BINOP: a, b, c = self.pool("ops", node.op[:2], node.op[:2]), self.add(node.left), self.add(node.right)
+        elif kind == UNARY: a, b, c = self.pool("ops", node.op[:2], node.op[:2]), self.add(node.operand), 0
+        elif kind == FUNCTION_DEF:
+            params = tuple(node.params)     # b: the parameter list's pool index << 1 | the memo flag
+            a, b, c = self.name(node.name), self.pool("params", params, params) << 1 | node.memo, self.add_block(node.body)
+        elif kind == CALL: a, b, c = self.add(node.func_expr), self.add_block(node.args), 0
+        elif kind == ASSIGN: a, b, c = self.name(node.name), self.add(node.value), 0
+        elif kind == ASSIGN_INDEX: a, b, c = self.name(node.name), self.add_block(node.indices), self.add(node.value)
+        elif kind == VAR: a, b, c = self.name(node.name), 0, 0
+        elif kind == INDEX: a, b, c = self.add(node.collection), self.add(node.index), 0
+        elif kind == IF:
+            a, b, c = self.add(node.condition), self.add_block(node.then_branch), self.add_block(node.else_branch)
+        elif kind == WHILE: a, b, c = self.add(node.condition), self.add_block(node.body), 0
+        elif kind == RETURN: a, b, c = self.add(node.value), int(node.tail_call), 0
+        elif kind == RAISE: a, b, c = self.add(node.expr), 0, 0
+        elif kind == SLICE: a, b, c = self.add(node.collection), self.add(node.lo), self.add(node.hi)
+        elif kind == MAP: a, b, c = self.add_block(node.keys), self.add_block(node.values), 0
+        elif kind == FOR: a, b, c = self.add(node.iterable), self.add_block(node.body), self.name(node.name)
+        else: a, b, c = self.add_block(node.body), self.name(node.catch_name), self.add_block(node.catch_body)
+        index = len(self.kinds)
+        self.kinds.append(kind)
+        self.a.append(a); self.b.append(b); self.c.append(c)
+        return index
+
+    def add_block(self, nodes):
+        return self.add_list([self.add(node) for node in nodes])
+
+    def add_statements(self, nodes):
+        for node in nodes:
+            self.top.append(self.add(node))
+
+    def finish(self):
+        # Drops the encoding-time pool index; adding nodes afterwards still works but no longer dedupes
+        self.pool_index = {}
+        return self
+
+    # Loader: back to the object tree, for the other engines and the optimizer
+    def decode(self, index=None):
+        if index is None:
+            return [self.decode(i) for i in self.statements()]
+        kind, a, b, c = self.kinds[index], self.a[index], self.b[index], self.c[index]
+        block = lambda offset: [self.decode(i) for i in self.list_at(offset)]
+        if kind == NUMBER: return Number(self.consts[a])
+        if kind == STRING:
+            node = String.__new__(String)       # String() expects quoted source text
+            node.value = self.consts[a]
+            return node
+        if kind == BOOL: return Bool(self.consts[a])
+        if kind == ARRAY: return ArrayLiteral(block(a))
+        if kind == BINOP: return BinOp(self.decode(b), self.ops[a], self.decode(c))
+        if kind == UNARY: return UnaryOp(self.ops[a], self.decode(b))
+        if kind == FUNCTION_DEF: return FunctionDef(self.names[a], list(self.params[b >> 1]), block(c), bool(b & 1))
+        if kind == CALL: return Call(self.decode(a), block(b))
+        if kind == ASSIGN: return Assign(self.names[a], self.decode(b))
+        if kind == ASSIGN_INDEX: return AssignIndex(self.names[a], block(b), self.decode(c))
+        if kind == VAR: return Var(self.names[a])
+        if kind == INDEX: return Index(self.decode(a), self.decode(b))
+        if kind == IF: return IfExpression(self.decode(a), block(b), block(c))
+        if kind == WHILE: return WhileLoop(self.decode(a), block(b))
+        if kind == RETURN:
+            node = Return(self.decode(a))
+            if b: node.tail_call = True
+            return node
+        if kind == RAISE: return Raise(self.decode(a))
+        if kind == SLICE: return Slice(self.decode(a), self.decode(b), self.decode(c))
+        if kind == MAP: return MapLiteral(block(a), block(b))
+        if kind == FOR: return ForLoop(self.names[c], self.decode(a), block(b))
+        return TryBlock(block(a), self.names[b], block(c))
+
+    # Persistence
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump((FORMAT, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            fmt, program = pickle.load(f)
+        if fmt != FORMAT:
+            raise ValueError(f"Not a {FORMAT} file: {path}")
+        return program
+
+    def nbytes(self):
+        # Size of the arrays and pools, excluding the encoding-time pool index
+        total = sum(sys.getsizeof(arr) for arr in (self.kinds, self.a, self.b, self.c, self.items, self.top))
+        for pool in (self.consts, self.names, self.ops, self.params):
+            total += sys.getsizeof(pool) + sum(sys.getsizeof(v) for v in pool)
+        return total
+
+
+def encode(tree):
+    program = FlatProgram()
+    program.add_statements(tree)
+    return program.finish()
+
+def parse_flat(code, optimize=0):
+    # Encodes each top-level statement as soon as it is parsed, so the object tree of the whole
+    # program never exists at once
+    program = FlatProgram()
+    if optimize:
+        from studio6_optimizer import Optimizer
+        optimizer = Optimizer(optimize)
+    for node in Parser(tokenize(code)).statements():
+        program.add_statements(optimizer.optimize([node]) if optimize else [node])
+    return program.finish()
+
+
+class FlatEvaluator:            # Interpreter.evaluate over a FlatProgram: same semantics, node indices for nodes
+    def __init__(self, program):
+        self.program = program
+        self.kinds, self.a, self.b, self.c = program.kinds, program.a, program.b, program.c
+        self.items, self.consts, self.names, self.ops = program.items, program.consts, program.names, program.ops
+        self.dispatch = [getattr(self, "eval_" + node_type.__name__.lower()) for node_type in NODE_TYPES]
+        self.purity = {}                # FunctionDef index -> function_purity() of its decoded node
+
+    def evaluate(self, index, env):
+        return self.dispatch[self.kinds[index]](index, env)
+
+    def nodes(self, offset):
+        return self.items[offset + 1:offset + 1 + self.items[offset]]
+
+    def block(self, offset, env):
+        result = None
+        for stmt in self.nodes(offset):
+            val = self.evaluate(stmt, env)
+            if val is not None: result = val
+        return result
+
+    def eval_number(self, i, env): return self.consts[self.a[i]]
+    eval_string = eval_bool = eval_number
+
+    def eval_arrayliteral(self, i, env):
+        return [self.evaluate(e, env) for e in self.nodes(self.a[i])]
+
+    def eval_mapliteral(self, i, env):
+        return {map_key(self.evaluate(k, env)): self.evaluate(v, env)
+                for k, v in zip(self.nodes(self.a[i]), self.nodes(self.b[i]))}
+
+    def eval_binop(self, i, env):
+        op = self.ops[self.a[i]][0]
+        if op == "AND" or op == "OR":
+            left = self.evaluate(self.b[i], env)
+            if isinstance(left, Reference): left = left.get()
+            if (not left) if op == "AND" else left:
+                return left
+            right = self.evaluate(self.c[i], env)
+            if isinstance(right, Reference): right = right.get()
+            return right
+        left, right = self.evaluate(self.b[i], env), self.evaluate(self.c[i], env)
+        if isinstance(left, Reference): left = left.get()
+        if isinstance(right, Reference): right = right.get()
+        if op == "PLUS":
+            if isinstance(left, int) and isinstance(right, int): return left + right
+            if isinstance(left, STRINGS) and isinstance(right, STRINGS): return concat_strings(left, right)
+            if isinstance(left, LISTS) and isinstance(right, LISTS): return concat_arrays(left, right)
+            if isinstance(left, View) or isinstance(right, View): return concat_views(left, right)
+            raise TypeError("Unsupported operand types for +")
+        if op == "MINUS":
+            if isinstance(left, int) and isinstance(right, int): return left - right
+            raise TypeError("Unsupported operand types for -")
+        if op == "STAR":
+            if isinstance(left, int) and isinstance(right, int): return left * right
+            raise TypeError("Unsupported operand types for *")
+        if op == "SLASH":
+            if isinstance(left, int) and isinstance(right, int):
+                if right == 0: raise ZeroDivisionError("division by zero")
+                return left // right
+            raise TypeError("Unsupported operand types for /")
+        if op == "EQ": return left == right
+        if op == "LT": return left < right
+        if op == "GT": return left > right
+        return None
+
+    def eval_unaryop(self, i, env):
+        val = self.evaluate(self.b[i], env)
+        op = self.ops[self.a[i]][0]
+        if op == "NOT": return not val
+        if op == "MINUS":
+            if not isinstance(val, int): raise TypeError("Unary - expects number")
+            return -val
+        return None
+
+    def eval_assign(self, i, env):
+        val = self.evaluate(self.b[i], env)
+        env.assign(self.names[self.a[i]], val)
+        return val
+
+    def eval_assignindex(self, i, env):
+        val = self.evaluate(self.c[i], env)
+        cur = env.get(self.names[self.a[i]])
+        if isinstance(cur, Reference): cur = cur.get()
+        indices = self.nodes(self.b[i])
+        if not indices:
+            raise SyntaxError("Missing index for indexed assignment")
+        for index in indices[:-1]:
+            idx = self.evaluate(index, env)
+            if isinstance(idx, Reference): idx = idx.get()
+            if cur.__class__ is dict:
+                cur = map_get(cur, idx)
+                continue
+            if not isinstance(idx, int):
+                raise TypeError("Index must be an integer")
+            if not isinstance(cur, ARRAYS):
+                raise TypeError("Indexed assignment only allowed on arrays (intermediate element not array)")
+            cur = cur[idx]
+        idx = self.evaluate(indices[-1], env)
+        if isinstance(idx, Reference): idx = idx.get()
+        if cur.__class__ is dict:
+            cur[map_key(idx)] = val
+            return val
+        if not isinstance(idx, int):
+            raise TypeError("Index must be an integer")
+        if not isinstance(cur, ARRAYS):
+            raise TypeError("Indexed assignment only allowed on arrays")
+        cur[idx] = val
+        return val
+
+    def eval_var(self, i, env):
+        val = env.get(self.names[self.a[i]])
+        if isinstance(val, Reference): return val.get()
+        return val
+
+    def eval_index(self, i, env):
+        coll = self.evaluate(self.a[i], env)
+        if isinstance(coll, Reference): coll = coll.get()
+        idx = self.evaluate(self.b[i], env)
+        if isinstance(idx, Reference): idx = idx.get()
+        if coll.__class__ is dict:
+            return map_get(coll, idx)
+        if not isinstance(idx, int):
+            raise TypeError("Index must be integer")
+        if isinstance(coll, SEQUENCES):
+            return coll[idx]
+        raise TypeError("Indexing only supported on arrays and strings")
+
+    def eval_slice(self, i, env):
+        coll = self.evaluate(self.a[i], env)
+        if isinstance(coll, Reference): coll = coll.get()
+        lo, hi = self.evaluate(self.b[i], env), self.evaluate(self.c[i], env)
+        if isinstance(lo, Reference): lo = lo.get()
+        if isinstance(hi, Reference): hi = hi.get()
+        return slice_view(coll, lo, hi)
+
+    def eval_ifexpression(self, i, env):
+        return self.block(self.b[i] if self.evaluate(self.a[i], env) else self.c[i], env)
+
+    def eval_whileloop(self, i, env):
+        result, condition, body = None, self.a[i], self.b[i]
+        meter = METERS.meter
+        while self.evaluate(condition, env):
+            meter.left -= 1
+            if meter.left < 0: meter.check()
+            val = self.block(body, env)
+            if val is not None: result = val
+        return result
+
+    def eval_forloop(self, i, env):
+        result, name, body = None, self.names[self.c[i]], self.b[i]
+        items = self.evaluate(self.a[i], env)
+        if isinstance(items, Reference): items = items.get()
+        meter = METERS.meter
+        for item in iterate(items):
+            meter.left -= 1
+            if meter.left < 0: meter.check()
+            env.assign(name, item)
+            val = self.block(body, env)
+            if val is not None: result = val
+        return result
+
+    def eval_functiondef(self, i, env):
+        # The function's body is the offset of its statement list
+        func_val = FunctionValue(self.program.params[self.b[i] >> 1], self.c[i], env)
+        purity = self.purity.get(i, MISSING)
+        if purity is MISSING: purity = self.purity[i] = function_purity(self.program.decode(i))
+        attach_memo(func_val, self.b[i] & 1, purity, env)
+        env.define(self.names[self.a[i]], func_val)
+        return None
+
+    def call_env(self, func, args, env):
+        if not isinstance(func, FunctionValue):
+            raise TypeError("Attempted to call a non-function")
+        if len(args) != len(func.params):
+            raise TypeError("Argument count mismatch")
+        local_env = Environment(func.env)
+        for (is_ref, param_name), arg in zip(func.params, args):
+            if is_ref:
+                if self.kinds[arg] != VAR:
+                    raise TypeError(f"ref parameter '{param_name}' must be a variable")
+                local_env.define(param_name, Reference(env, self.names[self.a[arg]]))
+            else:
+                local_env.define(param_name, self.evaluate(arg, env))
+        return local_env
+
+    def eval_call(self, i, env):
+        func = self.evaluate(self.a[i], env)
+        args = self.nodes(self.b[i])
+        if isinstance(func, BuiltinFunction):
+            return func.fn([self.evaluate(arg, env) for arg in args])
+        local_env = self.call_env(func, args, env)
+        memo = func.memo
+        if memo is not None:
+            key, result = memo.get([local_env.vars[name] for _, name in func.params])
+            if result is not MISSING: return result
+        meter = METERS.meter
+        meter.depth += 1
+        if meter.depth > meter.max_depth: meter.exceeded("depth")
+        while True:             # tail calls replace func/local_env, as in Interpreter.evaluate
+            meter.left -= 1
+            if meter.left < 0: meter.check()
+            try:
+                result = None
+                for stmt in self.nodes(func.body):
+                    self.evaluate(stmt, local_env)
+                break
+            except ReturnException as r:
+                result = r.value
+                break
+            except TailCallException as t:
+                func, local_env = t.func, t.env
+        meter.depth -= 1
+        if memo is not None and key is not None: memo.put(key, result)
+        return result
+
+    def eval_return(self, i, env):
+        value = self.a[i]
+        if self.b[i]:           # tail call
+            func = self.evaluate(self.a[value], env)
+            args = self.nodes(self.b[value])
+            if isinstance(func, BuiltinFunction):
+                raise ReturnException(func.fn([self.evaluate(arg, env) for arg in args]))
+            raise TailCallException(func, self.call_env(func, args, env))
+        raise ReturnException(self.evaluate(value, env))
+
+    def eval_raise(self, i, env):
+        raise ThrownException(self.evaluate(self.a[i], env))
+
+    def eval_tryblock(self, i, env):
+        meter = METERS.meter
+        depth = meter.depth
+        try:
+            return self.block(self.a[i], env)
+        except ThrownException as exc:
+            meter.depth = depth
+            local_env = Environment(env)
+            local_env.define(self.names[self.b[i]], exc.value)
+            return self.block(self.c[i], local_env)
+
+
+def measure(code):
+    # Bytes held by the object tree vs the flat encoding of the same program (tracemalloc)
+    def held(build):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            result = build()
+            return result, tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+    tree, tree_bytes = held(lambda: Parser(tokenize(code)).parse())
+    del tree
+    program, flat_bytes = held(lambda: parse_flat(code))
+    return {"nodes": len(program), "tree_bytes": tree_bytes, "flat_bytes": flat_bytes}
+
+
+if __name__ == "__main__":
+    # python studio6_flat.py [lines]: memory of a generated script in both representations
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    code = "\n".join(f"x{i} = (x{i - 1} + {i}) * 2 - f(a[{i % 7}], \"s{i % 13}\");" for i in range(1, lines + 1))
+    stats = measure(code)
+    print(f"{lines} lines, {stats['nodes']} nodes")
+    print(f"object tree   {stats['tree_bytes'] / 2**20:8.1f} MiB  ({stats['tree_bytes'] / stats['nodes']:.0f} B/node)")
+    print(f"flat encoding {stats['flat_bytes'] / 2**20:8.1f} MiB  ({stats['flat_bytes'] / stats['nodes']:.0f} B/node)")
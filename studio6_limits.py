@@ -0,0 +1,96 @@
+# Per-run limits for untrusted studio6 programs: evaluated steps, wall-clock seconds, call depth and
+# allocated array/string size. run(code, limits=Limits(steps=10**6, seconds=2.0)) raises LimitExceeded
+# when the program goes over any of them; the error carries the usage at that point.
+# A step is one loop iteration or one function call (a tail call too). Every engine counts those
+# instead of nodes, so between two steps a program runs at most as many nodes as its source has.
+# The count is Meter.left, decremented in place; the step total and the clock are only looked at when
+# it runs out, every CHECK_EVERY steps, which keeps the accounting cheap enough to leave on.
+# Allocation is the elements and characters of the arrays and strings built by +, zeros, add, mul,
+# sort, join, keys and values, and the int buffers that array builtins copy their arguments into, all
+# charged before they are built. + charges its whole result even where it shares a Vector operand's
+# tree, so doubling an array costs what a copy would. Literals are not charged: their size
+# is fixed by the source, so the step limit bounds them. Slices share storage and cost nothing.
+# LimitExceeded is a Python exception, not a studio6 value, so the program's own try/catch cannot
+# stop it; run() and repl() callers catch it. Each thread has its own Meter, METERS.meter, so runs on
+# different threads are limited separately; the engines look it up once per loop, call or run.
+import sys
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+UNLIMITED = sys.maxsize
+
+
+class LimitExceeded(RuntimeError):
+    def __init__(self, limit, usage):
+        self.limit, self.usage = limit, usage     # "steps", "seconds", "depth" or "allocation"; Meter.usage()
+        super().__init__(f"{limit} limit exceeded: {usage['steps']} steps, {usage['seconds']:.3f} s, "
+                         f"call depth {usage['depth']}, {usage['allocation']} allocated")
+
+
+class Limits:
+    # None leaves that resource unlimited
+    def __init__(self, steps=None, seconds=None, depth=None, allocation=None):
+        self.steps, self.seconds, self.depth, self.allocation = steps, seconds, depth, allocation
+        self.usage = None       # Meter.usage() when the last run under these limits ended
+
+
+class Meter:
+    CHECK_EVERY = 1024          # steps between looks at the step total and the clock
+
+    def __init__(self):
+        self.reset(Limits())
+
+    def reset(self, limits):
+        self.limits = limits
+        self.max_steps = UNLIMITED if limits.steps is None else limits.steps
+        self.max_depth = UNLIMITED if limits.depth is None else limits.depth
+        self.max_allocation = UNLIMITED if limits.allocation is None else limits.allocation
+        self.started = perf_counter()
+        self.deadline = None if limits.seconds is None else self.started + limits.seconds
+        self.counted = 0        # steps taken before the current batch
+        self.batch = self.left = min(self.CHECK_EVERY, self.max_steps)     # left: steps until check()
+        self.depth = 0          # calls running; engines count it up and down around each call
+        self.allocation = 0
+        self.stack = None       # Interpreter.stack for the closure engine to keep while a Sampler runs
+
+    def steps(self):
+        return self.counted + self.batch - self.left
+
+    def usage(self):
+        return {"steps": self.steps(), "seconds": perf_counter() - self.started, "depth": self.depth,
+                "allocation": self.allocation}
+
+    def check(self):
+        # The engines call this when a step takes left below zero
+        steps = self.steps()
+        if steps > self.max_steps: self.exceeded("steps")
+        if self.deadline is not None and perf_counter() > self.deadline: self.exceeded("seconds")
+        self.counted = steps
+        self.batch = self.left = min(self.CHECK_EVERY, self.max_steps - steps)
+
+    def allocate(self, size):
+        self.allocation += size
+        if self.allocation > self.max_allocation: self.exceeded("allocation")
+
+    def exceeded(self, limit):
+        raise LimitExceeded(limit, self.usage())
+
+    @contextmanager
+    def limit(self, limits=None):
+        # Meters the code run inside the with block against limits, then puts the outer run's state back
+        saved = dict(self.__dict__)
+        self.reset(limits or Limits())
+        try:
+            yield self
+        finally:
+            if limits is not None: limits.usage = self.usage()
+            self.__dict__.update(saved)
+
+
+class ThreadMeters(threading.local):
+    def __init__(self):
+        self.meter = Meter()    # limit() resets it in place, so code may hold on to it for a while
+
+
+METERS = ThreadMeters()
@@ -0,0 +1,52 @@
+# Hash maps for the studio6 language. A map literal {key: value, ...} evaluates to a Python dict,
+# so m[key] reads, m[key] = value writes (adding the key when it is new), len and the builtins
+# below are O(1) instead of a scan over parallel arrays. Keys are strings or ints.
+#   has(m, key)  keys(m)  values(m)  delete(m, key)
+# keys and values return arrays in insertion order; delete removes a key and returns its value.
+from studio6_arrays import Rope, View
+from studio6_limits import METERS
+
+
+def map_key(key):
+    # key as stored in a dict: long strings and string slices become strs; other types are refused
+    if key.__class__ is str or key.__class__ is int:
+        return key
+    if isinstance(key, Rope) or isinstance(key, View) and isinstance(key.base, str):
+        return str(key)
+    raise TypeError("Map keys must be strings or integers")
+
+def map_get(mapping, key):
+    try:
+        return mapping[map_key(key)]
+    except KeyError:
+        raise KeyError(f"Key not found: {key!r}") from None
+
+
+def _expect(name, args, count):
+    if len(args) != count:
+        raise TypeError(f"{name} expects {count} argument{'s' if count != 1 else ''}")
+    if args[0].__class__ is not dict:
+        raise TypeError(f"{name} expects a map")
+    return args[0]
+
+def builtin_has(args):
+    return map_key(args[1]) in _expect("has", args, 2)
+
+def builtin_keys(args):
+    mapping = _expect("keys", args, 1)
+    METERS.meter.allocate(len(mapping))
+    return list(mapping)
+
+def builtin_values(args):
+    mapping = _expect("values", args, 1)
+    METERS.meter.allocate(len(mapping))
+    return list(mapping.values())
+
+def builtin_delete(args):
+    mapping = _expect("delete", args, 2)
+    value = map_get(mapping, args[1])
+    del mapping[map_key(args[1])]
+    return value
+
+
+BUILTINS = {"has": builtin_has, "keys": builtin_keys, "values": builtin_values, "delete": builtin_delete}
@@ -0,0 +1,179 @@
+# AST optimizer for the studio6 language: rewrites a parsed program into an equivalent tree that
+# does less work at runtime. It runs between Parser.parse and compilation/evaluation.
+# Levels are cumulative:
+#   1  constant folding, dead-branch pruning, dropping statements after return/raise
+#   2  integer identities (x + 0, x - 0, x * 1, x / 1) where x is known to be an integer
+# Usage: run(code, optimize=2), or print(dump(optimize(parse_program(code), 2)))
+import sys
+
+from studio6 import (
+    Number, String, Bool, ArrayLiteral, MapLiteral, BinOp, UnaryOp, FunctionDef, Call, Assign, AssignIndex,
+    Var, Index, Slice, IfExpression, WhileLoop, ForLoop, Return, Raise, TryBlock, Interpreter, CHILD_FIELDS,
+    parse_program,
+)
+
+MAX_LEVEL = 2
+
+CONSTANTS = (Number, String, Bool)
+# Nodes that may stand in for an `if` in expression position (e.g. x = if 1 { y; })
+EXPRESSIONS = (Number, String, Bool, ArrayLiteral, MapLiteral, BinOp, UnaryOp, Call, Var, Index, Slice,
+               Assign, AssignIndex, IfExpression, WhileLoop, ForLoop)
+BLOCK_FIELDS = {"body", "then_branch", "else_branch", "catch_body"}
+INT_RESULTS = {"MINUS", "STAR", "SLASH"}    # these operators return an int or raise
+
+
+def constant(value):
+    # AST node for a folded value, or None when the value has no literal form
+    if isinstance(value, bool): return Bool(value)
+    if isinstance(value, int): return Number(value)
+    if isinstance(value, str):
+        node = String.__new__(String)       # String() expects quoted source text
+        node.value = value
+        return node
+    return None
+
+def is_number(node, value):
+    return type(node) is Number and node.value == value
+
+def known_int(node):
+    # True only if the node always evaluates to a non-bool int (or raises)
+    if type(node) is Number: return True
+    if isinstance(node, UnaryOp): return node.op[0] == "MINUS"
+    if isinstance(node, BinOp):
+        if node.op[0] in INT_RESULTS: return True
+        # int + str and int + list raise, so one int operand is enough
+        return node.op[0] == "PLUS" and (known_int(node.left) or known_int(node.right))
+    return False
+
+
+class Optimizer:
+    def __init__(self, level=1):
+        if not 0 <= level <= MAX_LEVEL:
+            raise ValueError(f"Optimization level must be between 0 and {MAX_LEVEL}, got {level!r}")
+        self.level = level
+        self.evaluator = Interpreter()      # folds operators with the runtime's own semantics
+        self.dispatch = {BinOp: self.visit_binop, UnaryOp: self.visit_unary, IfExpression: self.visit_if}
+
+    def optimize(self, tree):
+        return self.block(tree) if self.level else tree
+
+    def visit(self, node):
+        method = self.dispatch.get(type(node))
+        if method is not None:
+            return method(node)
+        for field in CHILD_FIELDS[type(node)]:
+            value = getattr(node, field)
+            if field in BLOCK_FIELDS: value = self.block(value)
+            elif isinstance(value, list): value = [self.visit(v) for v in value]
+            else: value = self.visit(value)
+            setattr(node, field, value)
+        return node
+
+    def block(self, stmts):
+        # Statement lists: constant ifs are spliced into the enclosing block (they share its env and
+        # its block value is the last non-None value either way), loops that never run are dropped,
+        # and nothing after a return/raise is kept
+        out = []
+        for stmt in stmts:
+            stmt = self.visit(stmt)
+            if isinstance(stmt, IfExpression) and isinstance(stmt.condition, CONSTANTS):
+                out.extend(stmt.then_branch if stmt.condition.value else stmt.else_branch)
+            elif isinstance(stmt, WhileLoop) and isinstance(stmt.condition, CONSTANTS) and not stmt.condition.value:
+                continue
+            else:
+                out.append(stmt)
+            if out and isinstance(out[-1], (Return, Raise)):
+                break
+        return out
+
+    def fold(self, node):
+        # Evaluate with the interpreter so folding cannot drift from runtime behaviour; anything that
+        # raises (1 / 0, "a" - 1, ...) is left in place to raise at runtime
+        try: value = self.evaluator.evaluate(node)
+        except Exception: return node
+        folded = constant(value)
+        return node if folded is None else folded
+
+    def visit_binop(self, node):
+        node.left, node.right = left, right = self.visit(node.left), self.visit(node.right)
+        op = node.op[0]
+        if isinstance(left, CONSTANTS):
+            if isinstance(right, CONSTANTS):
+                return self.fold(node)
+            if op == "AND": return right if left.value else left     # short-circuit on a known left side
+            if op == "OR": return left if left.value else right
+        if self.level >= 2:
+            if op == "PLUS":
+                if is_number(right, 0) and known_int(left): return left
+                if is_number(left, 0) and known_int(right): return right
+            elif op == "STAR":
+                if is_number(right, 1) and known_int(left): return left
+                if is_number(left, 1) and known_int(right): return right
+            elif op in ("MINUS", "SLASH"):
+                if is_number(right, 0 if op == "MINUS" else 1) and known_int(left): return left
+        return node
+
+    def visit_unary(self, node):
+        node.operand = self.visit(node.operand)
+        if isinstance(node.operand, CONSTANTS):
+            return self.fold(node)
+        return node
+
+    def visit_if(self, node):
+        node.condition = self.visit(node.condition)
+        if isinstance(node.condition, CONSTANTS):
+            # Only the taken branch survives; a single expression can replace the whole `if`
+            taken = self.block(node.then_branch if node.condition.value else node.else_branch)
+            if len(taken) == 1 and isinstance(taken[0], EXPRESSIONS):
+                return taken[0]
+            if node.condition.value: node.then_branch, node.else_branch = taken, []
+            else: node.then_branch, node.else_branch = [], taken
+            return node
+        node.then_branch, node.else_branch = self.block(node.then_branch), self.block(node.else_branch)
+        return node
+
+
+def optimize(tree, level=1):
+    # Rewrites the statements of a parsed program (in place where possible) and returns the new list
+    return Optimizer(level).optimize(tree)
+
+
+def _label(node):
+    kind = type(node).__name__
+    if isinstance(node, (Number, Bool)): return f"{kind} {node.value}"
+    if isinstance(node, String): return f"{kind} {node.value!r}"
+    if isinstance(node, (BinOp, UnaryOp)): return f"{kind} {node.op[1]}"
+    if isinstance(node, (Var, Assign, AssignIndex, ForLoop)): return f"{kind} {node.name}"
+    if isinstance(node, FunctionDef):
+        params = ", ".join(("ref " if is_ref else "") + name for is_ref, name in node.params)
+        return f"{kind} {'memo ' if node.memo else ''}{node.name}({params})"
+    if isinstance(node, TryBlock): return f"{kind} catch({node.catch_name})"
+    return kind
+
+def dump(tree, indent="  "):
+    # Indented text form of a program or node, one node per line; list fields are labelled
+    # (then:, else:, args:, ...) when the node has other children too
+    lines = []
+    def visit(node, depth):
+        lines.append(indent * depth + _label(node))
+        fields = CHILD_FIELDS[type(node)]
+        for field in fields:
+            value = getattr(node, field)
+            if isinstance(value, list):
+                if len(fields) > 1:
+                    lines.append(indent * (depth + 1) + field.replace("_branch", "") + ":")
+                    for child in value: visit(child, depth + 2)
+                else:
+                    for child in value: visit(child, depth + 1)
+            else:
+                visit(value, depth + 1)
+    for node in tree if isinstance(tree, list) else [tree]:
+        visit(node, 0)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python studio6_optimizer.py program.s6 [level]: prints the optimized tree
+    with open(sys.argv[1]) as f:
+        source = f.read()
+    print(dump(optimize(parse_program(source), int(sys.argv[2]) if len(sys.argv) > 2 else MAX_LEVEL)))
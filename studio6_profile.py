@@ -0,0 +1,204 @@
+# Profilers for studio6 programs.
+# Deterministic: ProfilingInterpreter is the tree-walker with every node evaluation timed, and
+# attributes the time to studio6 entities: functions by name, while/for loops by source line, and node
+# types. The plain Interpreter has no hooks, so programs that are not profiled pay nothing for this.
+# Sampling: Sampler reads the functions and loops on Interpreter.stack from a background thread at a
+# fixed rate, so the program runs at nearly full speed; samples go to a file as they are taken. The
+# tree-walker and the closure engine keep that stack; run() refuses to sample the vm and flat engines.
+# Usage: run(code, profile=True) prints a report to stderr; or profile = Profile(); run(code,
+# profile=profile); print(profile.report()); profile.write_collapsed("stacks.txt") for flamegraph.pl
+# run(code, sample=Sampler("samples.txt")) appends one "<main>;f;while line 3 1" line per sample,
+# which flamegraph.pl reads as it is.
+# python studio6_profile.py program.s6 [stacks.txt]
+# python studio6_profile.py --sample program.s6 samples.txt [interval in ms]
+import sys
+import threading
+from time import monotonic, perf_counter
+
+from studio6 import Interpreter, FunctionValue, Call, WhileLoop, ForLoop, run
+
+MAIN = "<main>"
+
+
+def _largest(table, limit):
+    # The entries with the most seconds (the second field of each record)
+    return sorted(table.items(), key=lambda item: -item[1][1])[:limit]
+
+
+class Profile:
+    def __init__(self):
+        self.functions = {}     # name -> [calls, seconds inside, seconds in its own nodes]
+        self.loops = {}         # "while line 3" -> [entries, seconds inside]
+        self.nodes = {}         # node type name -> [evaluations, seconds excluding child nodes]
+        self.stacks = {}        # "<main>;f;while line 3" -> seconds of the nodes evaluated there
+
+    def report(self, limit=15):
+        # Text tables, each sorted by time, largest first
+        lines = [f"{'function':32}{'calls':>10}{'total s':>11}{'own s':>11}"]
+        for name, (calls, total, own) in _largest(self.functions, limit):
+            lines.append(f"{name:32}{calls:10}{total:11.4f}{own:11.4f}")
+        lines.append(f"\n{'loop':32}{'entries':>10}{'total s':>11}")
+        for name, (entries, total) in _largest(self.loops, limit):
+            lines.append(f"{name:32}{entries:10}{total:11.4f}")
+        lines.append(f"\n{'node type':32}{'evals':>10}{'own s':>11}")
+        for name, (count, own) in _largest(self.nodes, limit):
+            lines.append(f"{name:32}{count:10}{own:11.4f}")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        # One "frame;frame;frame microseconds" line per stack, the input format of flamegraph.pl
+        return [f"{stack} {round(seconds * 1e6)}" for stack, seconds in sorted(self.stacks.items())
+                if round(seconds * 1e6)]
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            f.writelines(line + "\n" for line in self.collapsed())
+
+
+class ProfilingInterpreter(Interpreter):
+    def __init__(self, profile, memo_limit=None, memoize=False):
+        super().__init__(memo_limit, memoize)
+        self.profile = profile
+        self.children = [0.0]       # per active evaluation: seconds spent in nested evaluations
+        self.calls = []             # per active Call node: [function record, start, path of caller, caller record]
+        self.function = None        # record of the innermost running function
+        self.path = MAIN            # collapsed stack of the node being evaluated
+        self.pending = None         # function a tail call has switched to, once its body starts
+
+    def evaluate(self, node, env=None):
+        kind = type(node)
+        if self.pending is not None: self.switch()
+        if kind is Call:
+            self.calls.append(None)
+        elif kind is WhileLoop or kind is ForLoop:
+            outer, label = self.path, f"{'while' if kind is WhileLoop else 'for'} line {node.line}"
+            self.path = f"{outer};{label}"
+        children = self.children
+        children.append(0.0)
+        start = perf_counter()
+        try:
+            return Interpreter.evaluate(self, node, env)
+        finally:
+            elapsed = perf_counter() - start
+            own = elapsed - children.pop()
+            children[-1] += elapsed
+            profile = self.profile
+            if kind is Call:    # binding and returning count as the caller's own time, like in cProfile
+                if self.pending is not None: self.switch()     # a tail call to an empty body
+                frame = self.calls.pop()
+                if frame is not None: self.leave(frame)
+            record = profile.nodes.get(kind.__name__)
+            if record is None: record = profile.nodes[kind.__name__] = [0, 0.0]
+            record[0] += 1; record[1] += own
+            profile.stacks[self.path] = profile.stacks.get(self.path, 0.0) + own
+            if self.function is not None: self.function[2] += own
+            if kind is WhileLoop or kind is ForLoop:
+                self.path = outer
+                record = profile.loops.get(label)
+                if record is None: record = profile.loops[label] = [0, 0.0]
+                record[0] += 1; record[1] += elapsed
+
+    def call_env(self, func, arg_nodes, env):
+        local_env = super().call_env(func, arg_nodes, env)
+        if self.calls[-1] is None: self.enter(func)
+        else: self.pending = func       # `return g(...)`: g replaces the running function
+        return local_env
+
+    def enter(self, func, caller_path=None, caller=None):
+        name = func.name or "<function>"
+        record = self.profile.functions.get(name)
+        if record is None: record = self.profile.functions[name] = [0, 0.0, 0.0]
+        record[0] += 1
+        if caller_path is None: caller_path, caller = self.path, self.function
+        self.calls[-1] = [record, perf_counter(), caller_path, caller]
+        self.function, self.path = record, f"{caller_path};{name}"
+
+    def leave(self, frame):
+        record, start, self.path, self.function = frame
+        record[1] += perf_counter() - start
+
+    def switch(self):
+        func, self.pending = self.pending, None
+        frame = self.calls[-1]
+        self.leave(frame)
+        self.enter(func, frame[2], frame[3])
+
+
+def _label(entry):
+    # How an Interpreter.stack entry appears in stacks and tables
+    if entry.__class__ is FunctionValue: return entry.name or "<function>"
+    return f"{'while' if entry.__class__ is WhileLoop else 'for'} line {entry.line}"
+
+class Sampler:
+    FLUSH_EVERY = 1.0           # seconds between writes of the sample file to disk
+
+    def __init__(self, path, interval=0.01):
+        self.path, self.interval = path, interval
+        self.samples = 0
+        self.functions = {}     # name -> [samples running its own code, samples anywhere on the stack]
+        self.lines = {}         # source line of a def or loop -> [samples innermost there, samples inside]
+        self.thread = None
+
+    def start(self, interp):
+        self.interp, self.done = interp, threading.Event()
+        self.file = open(self.path, "a")
+        self.thread = threading.Thread(target=self.loop, name="studio6-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        self.file.close()
+
+    def loop(self):
+        flushed = monotonic()
+        while not self.done.wait(self.interval):
+            self.record(self.interp.stack[:])     # one list copy, so the program is barely paused
+            if monotonic() - flushed >= self.FLUSH_EVERY:
+                self.file.flush()
+                flushed = monotonic()
+
+    def record(self, stack):
+        self.samples += 1
+        self.file.write(";".join([MAIN, *map(_label, stack)]) + " 1\n")
+        functions = [entry for entry in stack if entry.__class__ is FunctionValue]
+        for name in dict.fromkeys([MAIN, *map(_label, functions)]):     # recursion counts once
+            record = self.functions.get(name)
+            if record is None: record = self.functions[name] = [0, 0]
+            record[1] += 1
+        innermost = _label(functions[-1]) if functions else MAIN
+        self.functions[innermost][0] += 1
+        lines = [entry.line for entry in stack if entry.line is not None]
+        for line in set(lines):
+            record = self.lines.get(line)
+            if record is None: record = self.lines[line] = [0, 0]
+            record[1] += 1
+        if lines: self.lines[lines[-1]][0] += 1
+
+    def report(self, limit=15):
+        # Hot functions and lines by the share of samples spent in their own code, largest first
+        total = max(self.samples, 1)
+        lines = [f"{self.samples} samples", f"{'function':32}{'own':>8}{'total':>8}"]
+        for name, (own, inside) in sorted(self.functions.items(), key=lambda item: -item[1][0])[:limit]:
+            lines.append(f"{name:32}{own / total:8.1%}{inside / total:8.1%}")
+        lines.append(f"\n{'line':32}{'own':>8}{'total':>8}")
+        for line, (own, inside) in sorted(self.lines.items(), key=lambda item: -item[1][0])[:limit]:
+            lines.append(f"{line:<32}{own / total:8.1%}{inside / total:8.1%}")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--sample":
+        with open(sys.argv[2]) as f:
+            source = f.read()
+        sampler = Sampler(sys.argv[3], float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.01)
+        run(source, sample=sampler)
+        print(sampler.report())
+    else:
+        with open(sys.argv[1]) as f:
+            source = f.read()
+        profile = Profile()
+        run(source, profile=profile)
+        print(profile.report())
+        if len(sys.argv) > 2:
+            profile.write_collapsed(sys.argv[2])
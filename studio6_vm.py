@@ -0,0 +1,559 @@
+# Bytecode compiler and stack-based virtual machine for the studio6 language.
+# run(code, engine="vm") compiles each top-level statement to a CodeObject and executes it here.
+# Calls push explicit frames instead of recursing in Python, so deep studio6 recursion
+# is bounded by MAX_FRAMES rather than by the Python stack.
+from studio6 import (
+    Number, String, Bool, ArrayLiteral, MapLiteral, BinOp, UnaryOp, FunctionDef, Call, FunctionValue,
+    BuiltinFunction, Environment, Assign, AssignIndex, Var, Index, IfExpression, WhileLoop, ForLoop,
+    Return, ReturnException, Reference, Raise, TryBlock, ThrownException, Slice,
+    SEQUENCES, ARRAYS, LISTS, STRINGS, View, concat_arrays, concat_strings, concat_views, slice_view,
+    map_key, map_get, iterate, function_purity, attach_memo, MISSING,
+)
+from studio6_limits import METERS
+
+MAX_FRAMES = 100000
+DONE = object()         # what FOR_ITER gets from an exhausted iterator
+
+# Opcodes. Every instruction is two slots in CodeObject.ops: [opcode, arg].
+OPNAMES = [
+    "LOAD_CONST", "LOAD_NAME", "LOAD_NAME_RAW", "LOAD_ARG_VAR", "STORE_NAME", "POP", "KEEP", "DEREF",
+    "ADD", "SUB", "MUL", "DIV", "EQ", "LT", "GT", "NOT", "NEG",
+    "JUMP", "POP_JUMP_IF_FALSE", "JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP",
+    "BUILD_LIST", "INDEX", "INDEX_STEP", "STORE_INDEX",
+    "CALL", "DEF_FUNCTION", "RETURN_VALUE", "RAISE_RETURN", "RAISE", "ENTER_CATCH", "LEAVE_CATCH",
+    "TAIL_CALL", "SLICE", "BUILD_MAP", "GET_ITER", "FOR_ITER",
+]
+for _number, _name in enumerate(OPNAMES):
+    globals()[_name] = _number
+
+# Net stack effect of each opcode (CALL, BUILD_LIST and BUILD_MAP depend on their argument)
+STACK_EFFECT = {
+    LOAD_CONST: 1, LOAD_NAME: 1, LOAD_NAME_RAW: 1, LOAD_ARG_VAR: 1, STORE_NAME: 0, POP: -1, KEEP: -1,
+    DEREF: 0, ADD: -1, SUB: -1, MUL: -1, DIV: -1, EQ: -1, LT: -1, GT: -1, NOT: 0, NEG: 0,
+    JUMP: 0, POP_JUMP_IF_FALSE: -1, JUMP_IF_FALSE_OR_POP: -1, JUMP_IF_TRUE_OR_POP: -1,
+    INDEX: -1, INDEX_STEP: -1, STORE_INDEX: -2, DEF_FUNCTION: 1, RETURN_VALUE: -1, RAISE_RETURN: -1,
+    RAISE: -1, ENTER_CATCH: -1, LEAVE_CATCH: 0, SLICE: -2, GET_ITER: 0,
+    FOR_ITER: 1,            # pushes the next element; when there is none it drops the iterator and jumps
+}
+
+BINARY_OPS = {"PLUS": ADD, "MINUS": SUB, "STAR": MUL, "SLASH": DIV, "EQ": EQ, "LT": LT, "GT": GT}
+
+
+class CodeObject:
+    def __init__(self, name, params):
+        self.name, self.params = name, params
+        self.ops = []           # flat [opcode, arg, opcode, arg, ...]
+        self.consts = []
+        self.names = []
+        # exception table: (start, end, handler, stack_depth, scope_level), innermost first
+        self.handlers = []
+        self.memo, self.purity = False, None      # of the FunctionDef, for attach_memo()
+
+    def find_handler(self, offset):
+        for entry in self.handlers:
+            if entry[0] <= offset < entry[1]:
+                return entry
+        return None
+
+
+class BytecodeCompiler:
+    def __init__(self):
+        self.code = None
+        self.depth = 0          # static stack depth, used to record handler depths
+        self.scope_level = 0    # catch scopes entered inside the current function
+        self.in_function = False
+        self.const_map, self.name_map = {}, {}
+        self.dispatch = {
+            Number: self.compile_constant, String: self.compile_constant, Bool: self.compile_constant,
+            ArrayLiteral: self.compile_array, MapLiteral: self.compile_map, BinOp: self.compile_binop, UnaryOp: self.compile_unary,
+            Assign: self.compile_assign, AssignIndex: self.compile_assign_index, Var: self.compile_var,
+            Index: self.compile_index, Slice: self.compile_slice, IfExpression: self.compile_if,
+            WhileLoop: self.compile_while, ForLoop: self.compile_for, FunctionDef: self.compile_function_def, Call: self.compile_call,
+            Return: self.compile_return, Raise: self.compile_raise, TryBlock: self.compile_try,
+        }
+
+    # Entry points
+    def compile_statement(self, node):
+        # A top-level statement becomes a chunk that returns the statement's value
+        self.start(CodeObject("<module>", []), False)
+        self.compile(node)
+        self.emit(RETURN_VALUE)
+        return self.code
+
+    def compile_function(self, node):
+        saved = self.code, self.depth, self.scope_level, self.in_function, self.const_map, self.name_map
+        self.start(CodeObject(node.name, node.params), True)
+        for stmt in node.body:
+            self.compile(stmt)
+            self.emit(POP)
+        self.emit(LOAD_CONST, self.const(None))
+        self.emit(RETURN_VALUE)
+        code = self.code
+        code.memo, code.purity = node.memo, function_purity(node)
+        self.code, self.depth, self.scope_level, self.in_function, self.const_map, self.name_map = saved
+        return code
+
+    def start(self, code, in_function):
+        self.code, self.depth, self.scope_level, self.in_function = code, 0, 0, in_function
+        self.const_map, self.name_map = {}, {}
+
+    # Emission helpers
+    def emit(self, op, arg=0):
+        self.code.ops += (op, arg)
+        effect = STACK_EFFECT.get(op)
+        if effect is None:      # CALL n pops n args and the callee, BUILD_LIST n pops n elements
+            if op == CALL or op == TAIL_CALL: effect = -arg
+            elif op == BUILD_MAP: effect = 1 - 2 * arg     # BUILD_MAP n pops n key/value pairs
+            else: effect = 1 - arg
+        self.depth += effect
+        return len(self.code.ops) - 2
+
+    def here(self):
+        return len(self.code.ops)
+
+    def patch(self, at, target=None):
+        self.code.ops[at + 1] = self.here() if target is None else target
+
+    def const(self, value):
+        consts = self.code.consts
+        key = (type(value), value) if not isinstance(value, CodeObject) else id(value)
+        if key not in self.const_map:
+            self.const_map[key] = len(consts)
+            consts.append(value)
+        return self.const_map[key]
+
+    def name(self, name):
+        if name not in self.name_map:
+            self.name_map[name] = len(self.code.names)
+            self.code.names.append(name)
+        return self.name_map[name]
+
+    # Node compilers: each leaves exactly one value on the stack
+    def compile(self, node):
+        method = self.dispatch.get(type(node))
+        if method is None:
+            raise TypeError(f"Unknown node type: {type(node)}")
+        method(node)
+
+    def compile_block(self, stmts):
+        # Same as the tree-walker: the last non-None statement value
+        if len(stmts) == 1:
+            self.compile(stmts[0])
+            return
+        self.emit(LOAD_CONST, self.const(None))
+        for stmt in stmts:
+            self.compile(stmt)
+            self.emit(KEEP)
+
+    def compile_constant(self, node):
+        self.emit(LOAD_CONST, self.const(node.value))
+
+    def compile_array(self, node):
+        for element in node.elements:
+            self.compile(element)
+        self.emit(BUILD_LIST, len(node.elements))
+
+    def compile_map(self, node):
+        for key, value in zip(node.keys, node.values):
+            self.compile(key)
+            self.compile(value)
+        self.emit(BUILD_MAP, len(node.keys))
+
+    def compile_binop(self, node):
+        op = node.op[0]
+        if op in ("AND", "OR"):
+            self.compile(node.left)
+            self.emit(DEREF)
+            jump = self.emit(JUMP_IF_FALSE_OR_POP if op == "AND" else JUMP_IF_TRUE_OR_POP)
+            self.compile(node.right)
+            self.emit(DEREF)
+            self.patch(jump)
+            return
+        self.compile(node.left)
+        self.compile(node.right)
+        if op not in BINARY_OPS:
+            self.emit(POP); self.emit(POP)
+            self.emit(LOAD_CONST, self.const(None))
+            return
+        self.emit(BINARY_OPS[op])
+
+    def compile_unary(self, node):
+        self.compile(node.operand)
+        if node.op[0] == "NOT": self.emit(NOT)
+        elif node.op[0] == "MINUS": self.emit(NEG)
+        else:
+            self.emit(POP)
+            self.emit(LOAD_CONST, self.const(None))
+
+    def compile_assign(self, node):
+        self.compile(node.value)
+        self.emit(STORE_NAME, self.name(node.name))
+
+    def compile_assign_index(self, node):
+        if not node.indices:
+            raise SyntaxError("Missing index for indexed assignment")
+        self.compile(node.value)
+        self.emit(LOAD_NAME_RAW, self.name(node.name))
+        for index in node.indices[:-1]:
+            self.compile(index)
+            self.emit(INDEX_STEP)
+        self.compile(node.indices[-1])
+        self.emit(STORE_INDEX)
+
+    def compile_var(self, node):
+        self.emit(LOAD_NAME, self.name(node.name))
+
+    def compile_index(self, node):
+        self.compile(node.collection)
+        self.compile(node.index)
+        self.emit(INDEX)
+
+    def compile_slice(self, node):
+        self.compile(node.collection)
+        self.compile(node.lo)
+        self.compile(node.hi)
+        self.emit(SLICE)
+
+    def compile_if(self, node):
+        self.compile(node.condition)
+        to_else = self.emit(POP_JUMP_IF_FALSE)
+        self.compile_block(node.then_branch)
+        to_end = self.emit(JUMP)
+        self.depth -= 1         # the else branch starts from the depth before the then-branch
+        self.patch(to_else)
+        self.compile_block(node.else_branch)
+        self.patch(to_end)
+
+    def compile_while(self, node):
+        self.emit(LOAD_CONST, self.const(None))
+        top = self.here()
+        self.compile(node.condition)
+        to_end = self.emit(POP_JUMP_IF_FALSE)
+        for stmt in node.body:
+            self.compile(stmt)
+            self.emit(KEEP)
+        self.emit(JUMP, top)
+        self.patch(to_end)
+
+    def compile_for(self, node):
+        # Stack during the loop: [iterator, result]; FOR_ITER pushes each element on top
+        self.compile(node.iterable)
+        self.emit(GET_ITER)
+        self.emit(LOAD_CONST, self.const(None))
+        top = self.here()
+        to_end = self.emit(FOR_ITER)
+        self.emit(STORE_NAME, self.name(node.name))
+        self.emit(POP)
+        for stmt in node.body:
+            self.compile(stmt)
+            self.emit(KEEP)
+        self.emit(JUMP, top)
+        self.patch(to_end)
+        self.depth -= 1         # the exit path leaves only the result
+
+    def compile_function_def(self, node):
+        self.emit(DEF_FUNCTION, self.const(self.compile_function(node)))
+
+    def compile_call(self, node, op=CALL):
+        self.compile(node.func_expr)
+        if len(node.args) > 255:
+            raise SyntaxError("Too many arguments in call")
+        for i, arg in enumerate(node.args):
+            if isinstance(arg, Var):
+                # Pushes a Reference if the callee takes this parameter by ref, else the value
+                self.emit(LOAD_ARG_VAR, self.name(arg.name) << 8 | i)
+            else:
+                self.compile(arg)
+        self.emit(op, len(node.args))
+
+    def compile_return(self, node):
+        if node.tail_call and self.in_function:
+            # TAIL_CALL replaces the current frame; only a builtin callee falls through to RETURN_VALUE
+            self.compile_call(node.value, TAIL_CALL)
+        else:
+            self.compile(node.value)
+        # Outside a function a return escapes run() as a ReturnException, as in the tree-walker
+        self.emit(RETURN_VALUE if self.in_function else RAISE_RETURN)
+        self.depth += 1         # keep the "one value per node" invariant for the enclosing block
+
+    def compile_raise(self, node):
+        self.compile(node.expr)
+        self.emit(RAISE)
+        self.depth += 1
+
+    def compile_try(self, node):
+        start, depth = self.here(), self.depth
+        self.compile_block(node.body)
+        end = self.here()
+        to_end = self.emit(JUMP)
+        handler = self.here()
+        self.code.handlers.append((start, end, handler, depth, self.scope_level))  # nested tries were added first
+        self.depth = depth + 1  # the thrown value
+        self.emit(ENTER_CATCH, self.name(node.catch_name))
+        self.scope_level += 1
+        self.compile_block(node.catch_body)
+        self.scope_level -= 1
+        self.emit(LEAVE_CATCH)
+        self.patch(to_end)
+
+
+class VM:
+    def execute(self, code, env):
+        # Backward jumps (one per loop iteration), CALL and TAIL_CALL are steps for studio6_limits;
+        # meter.depth follows the frames pushed and popped
+        ops, consts, names = code.ops, code.consts, code.names
+        stack, envs, frames, meter = [], [env], [], METERS.meter
+        pc = 0
+        while True:
+            op = ops[pc]; arg = ops[pc + 1]
+            pc += 2
+            if op == LOAD_NAME:
+                val = env.get(names[arg])
+                if isinstance(val, Reference): val = val.get()
+                stack.append(val)
+            elif op == LOAD_CONST:
+                stack.append(consts[arg])
+            elif op == STORE_NAME:
+                name = names[arg]
+                try:
+                    env.set(name, stack[-1])
+                except NameError:
+                    env.define(name, stack[-1])
+            elif op == KEEP:
+                val = stack.pop()
+                if val is not None: stack[-1] = val
+            elif op == POP:
+                stack.pop()
+            elif ADD <= op <= GT:
+                r = stack.pop(); l = stack[-1]
+                if isinstance(l, Reference): l = l.get()
+                if isinstance(r, Reference): r = r.get()
+                if op == ADD:
+                    if isinstance(l, int) and isinstance(r, int): stack[-1] = l + r
+                    elif isinstance(l, STRINGS) and isinstance(r, STRINGS): stack[-1] = concat_strings(l, r)
+                    elif isinstance(l, LISTS) and isinstance(r, LISTS): stack[-1] = concat_arrays(l, r)
+                    elif isinstance(l, View) or isinstance(r, View): stack[-1] = concat_views(l, r)
+                    else: raise TypeError("Unsupported operand types for +")
+                elif op == LT: stack[-1] = l < r
+                elif op == SUB:
+                    if isinstance(l, int) and isinstance(r, int): stack[-1] = l - r
+                    else: raise TypeError("Unsupported operand types for -")
+                elif op == MUL:
+                    if isinstance(l, int) and isinstance(r, int): stack[-1] = l * r
+                    else: raise TypeError("Unsupported operand types for *")
+                elif op == DIV:
+                    if isinstance(l, int) and isinstance(r, int):
+                        if r == 0: raise ZeroDivisionError("division by zero")
+                        stack[-1] = l // r
+                    else: raise TypeError("Unsupported operand types for /")
+                elif op == EQ: stack[-1] = l == r
+                else: stack[-1] = l > r
+            elif op == POP_JUMP_IF_FALSE:
+                if not stack.pop(): pc = arg
+            elif op == JUMP:
+                if arg < pc:
+                    meter.left -= 1
+                    if meter.left < 0: meter.check()
+                pc = arg
+            elif op == FOR_ITER:
+                item = next(stack[-2], DONE)
+                if item is DONE:
+                    del stack[-2]
+                    pc = arg
+                else:
+                    stack.append(item)
+            elif op == GET_ITER:
+                items = stack[-1]
+                if isinstance(items, Reference): items = items.get()
+                stack[-1] = iterate(items)
+            elif op == LOAD_ARG_VAR:
+                name = names[arg >> 8]
+                func, i = stack[-1 - (arg & 0xFF)], arg & 0xFF
+                if isinstance(func, FunctionValue) and i < len(func.params) and func.params[i][0]:
+                    stack.append(Reference(env, name))
+                else:
+                    val = env.get(name)
+                    if isinstance(val, Reference): val = val.get()
+                    stack.append(val)
+            elif op == CALL or op == TAIL_CALL:
+                if arg:
+                    args = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    args = []
+                func = stack.pop()
+                if isinstance(func, BuiltinFunction):
+                    stack.append(func.fn(args))
+                    continue
+                if not isinstance(func, FunctionValue):
+                    raise TypeError("Attempted to call a non-function")
+                if arg != len(func.params):
+                    raise TypeError("Argument count mismatch")
+                pending = None          # (memo, key) to store the result under when this frame returns
+                if func.memo is not None and op == CALL:
+                    key, val = func.memo.get(args)
+                    if val is not MISSING:
+                        stack.append(val)
+                        continue
+                    if key is not None: pending = (func.memo, key)
+                meter.left -= 1
+                if meter.left < 0: meter.check()
+                local_env = Environment(func.env)
+                local_vars = local_env.vars
+                for (is_ref, param_name), val in zip(func.params, args):
+                    if is_ref and not isinstance(val, Reference):
+                        raise TypeError(f"ref parameter '{param_name}' must be a variable")
+                    local_vars[param_name] = val
+                if op == CALL:
+                    if len(frames) >= MAX_FRAMES:
+                        raise RecursionError("maximum recursion depth exceeded")
+                    meter.depth += 1
+                    if meter.depth > meter.max_depth: meter.exceeded("depth")
+                    frames.append((code, pc, stack, envs, pending))
+                code = func.code
+                ops, consts, names = code.ops, code.consts, code.names
+                pc, stack, env = 0, [], local_env
+                envs = [env]
+            elif op == RETURN_VALUE:
+                val = stack.pop()
+                if not frames:
+                    return val
+                code, pc, stack, envs, pending = frames.pop()
+                meter.depth -= 1
+                if pending is not None: pending[0].put(pending[1], val)
+                ops, consts, names = code.ops, code.consts, code.names
+                env = envs[-1]
+                stack.append(val)
+            elif op == INDEX:
+                idx = stack.pop(); coll = stack[-1]
+                if isinstance(coll, Reference): coll = coll.get()
+                if isinstance(idx, Reference): idx = idx.get()
+                if coll.__class__ is dict:
+                    stack[-1] = map_get(coll, idx)
+                elif not isinstance(idx, int):
+                    raise TypeError("Index must be integer")
+                elif isinstance(coll, SEQUENCES):
+                    stack[-1] = coll[idx]
+                else:
+                    raise TypeError("Indexing only supported on arrays and strings")
+            elif op == SLICE:
+                hi = stack.pop(); lo = stack.pop(); coll = stack[-1]
+                if isinstance(coll, Reference): coll = coll.get()
+                if isinstance(lo, Reference): lo = lo.get()
+                if isinstance(hi, Reference): hi = hi.get()
+                stack[-1] = slice_view(coll, lo, hi)
+            elif op == LOAD_NAME_RAW:
+                stack.append(env.get(names[arg]))
+            elif op == INDEX_STEP:
+                idx = stack.pop(); cur = stack[-1]
+                if isinstance(cur, Reference): cur = cur.get()
+                if isinstance(idx, Reference): idx = idx.get()
+                if cur.__class__ is dict:
+                    stack[-1] = map_get(cur, idx)
+                    continue
+                if not isinstance(idx, int):
+                    raise TypeError("Index must be an integer")
+                if not isinstance(cur, ARRAYS):
+                    raise TypeError("Indexed assignment only allowed on arrays (intermediate element not array)")
+                stack[-1] = cur[idx]
+            elif op == STORE_INDEX:
+                idx = stack.pop(); cur = stack.pop()
+                if isinstance(cur, Reference): cur = cur.get()
+                if isinstance(idx, Reference): idx = idx.get()
+                if cur.__class__ is dict:
+                    cur[map_key(idx)] = stack[-1]
+                    continue
+                if not isinstance(idx, int):
+                    raise TypeError("Index must be an integer")
+                if not isinstance(cur, ARRAYS):
+                    raise TypeError("Indexed assignment only allowed on arrays")
+                cur[idx] = stack[-1]
+            elif op == BUILD_MAP:
+                items = stack[len(stack) - 2 * arg:]
+                del stack[len(stack) - 2 * arg:]
+                stack.append({map_key(items[k]): items[k + 1] for k in range(0, len(items), 2)})
+            elif op == BUILD_LIST:
+                if arg:
+                    elements = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    elements = []
+                stack.append(elements)
+            elif op == NOT:
+                stack[-1] = not stack[-1]
+            elif op == NEG:
+                val = stack[-1]
+                if not isinstance(val, int): raise TypeError("Unary - expects number")
+                stack[-1] = -val
+            elif op == DEREF:
+                if isinstance(stack[-1], Reference): stack[-1] = stack[-1].get()
+            elif op == JUMP_IF_FALSE_OR_POP:
+                if not stack[-1]: pc = arg
+                else: stack.pop()
+            elif op == JUMP_IF_TRUE_OR_POP:
+                if stack[-1]: pc = arg
+                else: stack.pop()
+            elif op == DEF_FUNCTION:
+                body = consts[arg]
+                func_val = FunctionValue(body.params, body, env)
+                func_val.code = body
+                attach_memo(func_val, body.memo, body.purity, env)
+                env.define(body.name, func_val)
+                stack.append(None)
+            elif op == RAISE:
+                # Unwind through the handler tables of this frame and its callers
+                val = stack.pop()
+                while True:
+                    entry = code.find_handler(pc - 2)
+                    if entry is not None:
+                        _, _, pc, depth, level = entry
+                        del stack[depth:]
+                        del envs[level + 1:]
+                        env = envs[-1]
+                        stack.append(val)
+                        break
+                    if not frames:
+                        raise ThrownException(val)
+                    code, pc, stack, envs, _ = frames.pop()
+                    meter.depth -= 1
+                    ops, consts, names = code.ops, code.consts, code.names
+                    env = envs[-1]
+            elif op == ENTER_CATCH:
+                env = Environment(env)
+                env.define(names[arg], stack.pop())
+                envs.append(env)
+            elif op == LEAVE_CATCH:
+                envs.pop()
+                env = envs[-1]
+            elif op == RAISE_RETURN:
+                raise ReturnException(stack.pop())
+            else:
+                raise RuntimeError(f"Bad opcode {op}")
+
+
+def compile_statement(node):
+    return BytecodeCompiler().compile_statement(node)
+
+def disassemble(code):
+    lines = [f"code {code.name}({', '.join(name for _, name in code.params)})"]
+    for offset in range(0, len(code.ops), 2):
+        op, arg = code.ops[offset], code.ops[offset + 1]
+        detail = ""
+        if op in (LOAD_CONST, DEF_FUNCTION):
+            value = code.consts[arg]
+            detail = f"<code {value.name}>" if isinstance(value, CodeObject) else repr(value)
+        elif op in (LOAD_NAME, LOAD_NAME_RAW, STORE_NAME, ENTER_CATCH):
+            detail = code.names[arg]
+        elif op == LOAD_ARG_VAR:
+            detail = f"{code.names[arg >> 8]} (arg {arg & 0xFF})"
+        elif op in (JUMP, POP_JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, FOR_ITER):
+            detail = f"-> {arg}"
+        elif op in (CALL, TAIL_CALL, BUILD_LIST, BUILD_MAP):
+            detail = str(arg)
+        lines.append(f"{offset:6} {OPNAMES[op]:22} {detail}".rstrip())
+    for start, end, handler, depth, level in code.handlers:
+        lines.append(f"  try [{start}, {end}) -> {handler} depth={depth} scope={level}")
+    for value in code.consts:
+        if isinstance(value, CodeObject):
+            lines.append(disassemble(value))
+    return "\n".join(lines)
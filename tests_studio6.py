@@ -1,7 +1,7 @@
 import io
 import sys
 import pytest
-from studio5 import run
+from studio6 import run, lex, tokenize
 
 
 def test_skip_after_raise():
@@ -111,4 +111,667 @@ def test_index_non_integer_error():
     a[i] = 5;
     """
     with pytest.raises(TypeError):
-        run(code)
\ No newline at end of file
+        run(code)
+
+def test_tree_engine_matches_closure_engine():
+    code = """
+    def fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); }
+    a = [0, 0, 0];
+    i = 0;
+    while i < 3 { a[i] = fib(i + 5); i = i + 1; };
+    total = a[0] + a[1] + a[2];
+    """
+    assert run(code, engine="tree") == run(code) == 26
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        run("1;", engine="nope")
+
+def test_vm_engine_exceptions_and_closures():
+    code = """
+    def thrower(x) { raise x * 2; }
+    def outer() {
+        k = 5;
+        def inner(ref v) { return v + k; }
+        try { thrower(4); } catch(e) { return inner(e); }
+        return 0;
+    }
+    outer();
+    """
+    assert run(code, engine="vm") == run(code) == 13
+
+def test_vm_uncaught_exception():
+    with pytest.raises(RuntimeError) as excinfo:
+        run("def f() { raise 10; } f();", engine="vm")
+    assert str(excinfo.value) == "Uncaught exception: 10"
+
+def test_vm_deep_recursion():
+    code = """
+    def count(n) { if n == 0 { return 0; } return 1 + count(n - 1); }
+    count(20000);
+    """
+    assert run(code, engine="vm") == 20000
+
+def test_scopes_match_tree_walker():
+    code = """
+    def setg() { g = 42; return g; }
+    g = 1;
+    setg();
+    def mk() { h = 1; def bump() { h = h + 1; return h; } bump(); bump(); return h; }
+    def late() { def inner() { return z; } z = 5; return inner(); }
+    def f() {
+        t = 1;
+        try { raise 5; } catch(e) { t = t + e; u = 9; }
+        try { raise 6; } catch(t) { t = t * 10; }
+        return t;
+    }
+    def reader(ref v) { return v + 1; }
+    def wrap() { loc = 10; def nest(ref w) { return reader(w); } return nest(loc); }
+    result = [g, mk(), late(), f(), wrap()];
+    """
+    assert run(code, engine="tree") == run(code) == [42, 3, 5, 6, 11]
+
+def test_program_cache_layers(tmp_path):
+    from studio6_cache import ProgramCache
+    code = "def sq(x) { return x * x; } a = [sq(3), sq(4)]; a[1];"
+    cache = ProgramCache(str(tmp_path))
+    assert run(code, cache=cache) == 16
+    assert run(code, cache=cache) == 16
+    assert cache.stats == {"memory_hits": 1, "disk_hits": 0, "misses": 1}
+
+    fresh = ProgramCache(str(tmp_path))
+    assert run(code, engine="vm", cache=fresh) == 16
+    assert run(code, engine="tree", cache=fresh) == 16
+    assert fresh.stats == {"memory_hits": 0, "disk_hits": 1, "misses": 1}
+
+def test_program_cache_eviction(tmp_path):
+    from studio6_cache import ProgramCache
+    cache = ProgramCache(str(tmp_path), max_bytes=1)
+    run("1 + 2;", cache=cache)
+    run("3 + 4;", cache=cache)
+    assert len(list(tmp_path.iterdir())) <= 1
+
+def test_tokenize_matches_lex():
+    code = """
+    def f(ref a, b) { if a < 2if { return "x\\"y"; } }  # comment
+    try { raise [1, 2][0]; } catch(e) { while e > 0 { e = e - 1; }; }
+    iffy = a == b;
+    """
+    assert [tok[:2] for tok in tokenize(code)] == lex(code)
+
+def test_tokenize_positions():
+    tokens = list(tokenize('x = "a\nb";\n  y'))
+    assert [(kind, line, col) for kind, _, line, col in tokens] == [
+        ("ID", 1, 1), ("ASSIGN", 1, 3), ("STRING", 1, 5), ("SEMI", 2, 3), ("ID", 3, 3), ("EOF", 3, 4)
+    ]
+    with pytest.raises(SyntaxError):
+        list(tokenize("x = $;"))
+
+def test_operator_precedence():
+    assert run("x = 2 + 3 * 4 - 6 / 2;") == 11
+    assert run("x = (2 + 3) * -(4 - 6);") == 10
+    assert run("x = 1 < 2 == 1;") == 1
+    assert run("def f(n) { return n * 2; } x = (f)(3) + -f(1) * 2;") == 2
+
+def test_deeply_nested_parentheses():
+    assert run("x = " + "(" * 5000 + "1" + ")" * 5000 + ";") == 1
+
+def test_optimizer_folds_and_prunes():
+    from studio6 import parse_program
+    from studio6_optimizer import dump
+    code = """
+    def f(n) { return n * (2 + 3); print("unreachable"); }
+    if 1 < 2 { x = f(4) - 0; } else { x = "never"; }
+    while 0 { x = 1; }
+    y = x * 1 + 0;
+    """
+    tree = parse_program(code, optimize=2)
+    text = dump(tree)
+    assert "unreachable" not in text and "never" not in text and "WhileLoop" not in text
+    assert "Number 5" in text
+    assert [type(node).__name__ for node in tree] == ["FunctionDef", "Assign", "Assign"]
+    for engine in ("tree", "closure", "vm"):
+        for level in (0, 1, 2):
+            assert run(code, engine=engine, optimize=level) == 20
+
+def test_optimizer_keeps_runtime_errors():
+    for level in (1, 2):
+        with pytest.raises(ZeroDivisionError):
+            run("x = 7 / (2 - 2);", optimize=level)
+        with pytest.raises(TypeError):
+            run('x = "a" - 1;', optimize=level)
+        assert run('x = "a" + "b";', optimize=level) == "ab"
+        assert run("x = 7 / 2;", optimize=level) == 3
+        # x may hold a string, so x + 0 must still raise
+        with pytest.raises(TypeError):
+            run('x = "s"; y = x + 0;', optimize=level)
+    with pytest.raises(ValueError):
+        run("x = 1;", optimize=3)
+
+def test_completion_records_match_exceptions():
+    from studio6 import Compiler, Interpreter, parse_program
+    code = """
+    def fail(x) { raise x * 2; }
+    def pick(n) { x = if n > 2 { return "big"; } else { n; }; return x; }
+    def first(a) { i = 0; while i < len(a) { if a[i] > 2 { return a[i]; } i = i + 1; } return -1; }
+    def guard(n) { try { if n > 1 { fail(n); } raise n; } catch(e) { return e + 100; } }
+    out = [pick(1), pick(5), first([1, 3, 5]), first([]), guard(1), guard(4)];
+    """
+    results = []
+    for completions in (True, False):
+        interp = Interpreter()
+        compiler = Compiler(completions=completions)
+        for node in parse_program(code):
+            compiler.compile_top_level(node)(interp.env)
+        results.append(interp.env.get("out"))
+    assert results[0] == results[1] == [1, "big", 3, -1, 101, 108]
+    with pytest.raises(RuntimeError, match="Uncaught exception: 8"):
+        run("def fail(x) { raise x * 2; } if 1 { fail(4); }")
+
+def test_control_flow_benchmark():
+    from studio6_bench import bench_control_flow
+    rows = bench_control_flow(calls=50)
+    assert [name for name, _, _ in rows] == ["return", "loop-return", "raise-catch", "raise-caller"]
+    assert all(raising > 0 and signalled > 0 for _, raising, signalled in rows)
+
+def test_tail_calls_run_in_constant_stack():
+    code = """
+    def loop(i, acc) { if i == 0 { return acc; } return loop(i - 1, acc + i); }
+    def even(n) { if n == 0 { return 1; } return odd(n - 1); }
+    def odd(n) { if n == 0 { return 0; } return even(n - 1); }
+    def show(ref v) { return v + 1; }
+    def local(n) { y = n * 2; return show(y); }
+    def fail(n) { raise n; }
+    def guarded(n) { try { return fail(n); } catch(e) { return e + 100; } }
+    [loop(30000, 0), even(30001), local(5), guarded(1), len("abc")];
+    """
+    for engine in ("tree", "closure", "vm"):
+        assert run(code, engine=engine) == [450015000, 0, 11, 101, 3]
+
+def test_flat_encoding_round_trip(tmp_path):
+    from studio6 import parse_program
+    from studio6_flat import FlatProgram, encode, parse_flat
+    from studio6_optimizer import dump
+    code = """
+    def fact(n, acc) { if n < 2 { return acc; } return fact(n - 1, acc * n); }
+    def swap(a, i) { t = a[i]; a[i] = a[i + 1]; a[i + 1] = t; }
+    xs = [3, 1, 2]; swap(xs, 0); msg = "";
+    try { raise "boom"; } catch(e) { msg = e + "!"; }
+    less = 1 < 2;
+    [fact(10, 1), xs, msg, less, -xs[2]];
+    """
+    expected = [3628800, [1, 3, 2], "boom!", True, -2]
+    assert run(code, engine="flat") == run(code, engine="tree") == expected
+    program = parse_flat(code)
+    assert dump(program.decode()) == dump(parse_program(code))
+    assert len(program) == len(encode(parse_program(code)))
+    path = tmp_path / "prog.s6f"
+    program.save(path)
+    loaded = FlatProgram.load(path)
+    assert [node.__class__ for node in loaded.decode()] == [node.__class__ for node in parse_program(code)]
+
+def test_flat_encoding_is_smaller():
+    from studio6_flat import measure
+    code = "\n".join(f"x{i} = (x{i - 1} + {i}) * 2 - f(a[{i % 7}], \"s\");" for i in range(1, 2001))
+    stats = measure(code)
+    assert stats["flat_bytes"] * 3 < stats["tree_bytes"]
+
+def test_binop_quickening_guards_and_deopts():
+    import studio6
+    studio6.QUICKEN_STATS.update(specialized=0, deoptimized=0)
+    code = """
+    def add(a, b) { return a + b; }
+    i = 0; while i < 10 { n = add(i, 1); i = i + 1; }
+    yes = 1 < 2;
+    [n, add("a", "b"), add([1], [2]), add(2, 3), add(yes, 1), 7 / 2];
+    """
+    assert run(code, engine="tree") == [10, "ab", [1, 2], 5, 2, 3]
+    # i < 10, i + 1, 1 < 2, 7 / 2 and each new type pair seen by a + b (bools are not quickened)
+    assert studio6.QUICKEN_STATS == {"specialized": 8, "deoptimized": 4}
+    with pytest.raises(ZeroDivisionError):
+        run("def div(a, b) { return a / b; } div(4, 2); div(1, 0);", engine="tree")
+    with pytest.raises(TypeError):
+        run('def sub(a, b) { return a - b; } sub(4, 2); sub("x", "y");', engine="tree")
+
+def test_inline_caches_follow_global_changes():
+    from studio6 import Parser, tokenize
+    code = """
+    def helper(x) { return x + 1; }
+    total = 0;
+    def bump() { total = total + 1; }
+    def use(n) { return helper(n) + total + len("ab"); }
+    a = use(1);
+    def helper(x) { return x * 10; }
+    bump(); bump();
+    b = use(1);
+    def len(x) { return 100; }
+    c = use(1);
+    d = 0; try { raise 5; } catch(e) { d = helper(e); }
+    [a, b, c, d];
+    """
+    for engine in ("tree", "closure", "vm"):
+        assert run(code, engine=engine) == [4, 14, 112, 50]
+    tree = Parser(tokenize("def f(x) { y = x; return helper(y) + x; } try { 1; } catch(e) { g(e); }")).parse()
+    sites = {}
+    def walk(node):
+        if type(node).__name__ == "Var": sites.setdefault(node.name, set()).add(node.global_site)
+        for field in vars(node).values():
+            for child in field if isinstance(field, list) else [field]:
+                if hasattr(child, "__dict__"): walk(child)
+    for node in tree: walk(node)
+    assert sites == {"x": {False}, "y": {False}, "helper": {True}, "e": {False}, "g": {True}}
+
+def test_counted_loops_keep_loop_semantics():
+    from studio6 import counted_loop, loop_invariants, parse_program
+    from studio6_optimizer import dump
+    code = """
+    def total(n, k) { s = 0; i = 0; while i < n { s = s + k * 2 + i; i = i + 1; } return [s, i]; }
+    def down(n) { i = n; last = while i > 0 { i = i - 3; }; return [i, last]; }
+    def early(n) { i = 0; while i < n { if i > 4 { return i; } i = i + 2; } return -1; }
+    def skip() { c = c + 100; }
+    c = 0; r = while 10 > c { skip(); c = c + 1; };
+    never = while c < 0 { c = c + 1; };
+    [total(5, 3), down(10), early(10), [r, c], never];
+    """
+    for engine in ("tree", "closure", "vm"):
+        assert run(code, engine=engine) == [[40, 5], [-2, -2], 6, [101, 101], None]
+    for engine in ("tree", "closure"):
+        with pytest.raises(TypeError):
+            run('q = "a"; while q < "c" { q = q + 1; }', engine=engine)
+    loop = counted_loop(parse_program("while i < n { s = s + k * 2 + i; i = i + 1; }")[0])
+    assert (loop.name, loop.step, loop.invariant) == ("i", 1, True)
+    assert [dump(node) for node in loop_invariants(loop)] == ["BinOp *\n  Var k\n  Number 2"]
+    assert counted_loop(parse_program("while i < n { i = 0; i = i + 1; }")[0]) is None
+    assert counted_loop(parse_program("while i < n { i = i - 1; }")[0]) is None
+
+def test_typed_int_arrays_and_bulk_builtins():
+    from studio6_arrays import IntArray
+    code = """
+    a = range(6); b = zeros(6); i = 0;
+    while i < len(a) { b[i] = a[i] * a[i]; i = i + 1; }
+    c = array_from([5, 3, 9]);
+    [sum(b), min(c), max(c), add(a, 1), mul(2, a), add(a, b), dot(a, a), sort(c), c, range(2, 10, 3), sum([1, 2])];
+    """
+    expected = [55, 3, 9, [1, 2, 3, 4, 5, 6], [0, 2, 4, 6, 8, 10], [0, 2, 6, 12, 20, 30], 55, [3, 5, 9],
+                [5, 3, 9], [2, 5, 8], 3]
+    for engine in ("tree", "closure", "vm", "flat"):
+        result = run(code, engine=engine)
+        assert [list(v) if isinstance(v, IntArray) else v for v in result] == expected
+        assert isinstance(result[3], IntArray)
+    big = 2 ** 62
+    assert run(f"a = array_from([{big}, {big}]); [sum(a), dot(a, a)];") == [2 * big, 2 * big * big]
+    with pytest.raises(OverflowError):
+        run(f"mul(range(3), {big});")
+    with pytest.raises(ValueError):
+        run("add(range(3), range(4));")
+    with pytest.raises(TypeError):
+        run('a = zeros(2); a[0] = "x";')
+    with pytest.raises(TypeError):
+        run('sum([1, "a"]);')
+
+def test_slices_are_views_sharing_storage():
+    code = """
+    a = [1, 2, 3, 4, 5]; b = a[1:4]; b[0] = 20;
+    s = "hello world"; t = s[6:];
+    def search(a, x) {
+        if len(a) == 0 { return 0 - 1; }
+        m = len(a) / 2;
+        if a[m] == x { return m; }
+        if a[m] < x { found = search(a[m + 1:], x); if found < 0 { return found; } return m + 1 + found; }
+        return search(a[:m], x);
+    }
+    r = range(100); v = r[2:8]; v[0] = 99;
+    same = t == "world";
+    [a, b, len(b), b[-1], a[1:4][1:], a[-2:], a[4:1], b + [6], t, s[:5] + "!", same, search(range(1000), 777), sum(v), r[2]];
+    """
+    expected = [[1, 20, 3, 4, 5], [20, 3, 4], 3, 4, [3, 4], [4, 5], [], [20, 3, 4, 6], "world", "hello!", True,
+                777, 99 + 3 + 4 + 5 + 6 + 7, 99]
+    for engine in ("tree", "closure", "vm", "flat"):
+        assert run(code, engine=engine) == expected
+    with pytest.raises(TypeError):
+        run('s = "abc"; v = s[0:2]; v[0] = "x";')
+    with pytest.raises(TypeError):
+        run('a = [1, 2]; a["x":1];')
+    with pytest.raises(SyntaxError):
+        run("a = [1, 2]; a[0:1] = 5;")
+
+def test_array_concatenation_builds_persistent_vectors():
+    code = """
+    acc = []; i = 0;
+    while i < 200 { acc = acc + [i]; i = i + 1; }
+    b = acc + [200]; b[0] = 99;
+    c = b; c[1] = 98;
+    pre = []; i = 0;
+    while i < 100 { pre = [i] + pre; i = i + 1; }
+    v = pre[90:]; v[0] = 0 - 1;
+    same = acc + [] == acc;
+    [acc[0], acc[1], acc[199], len(b), b[0], b[1], b[-1], same, pre[90], pre[:3], sum(acc)];
+    """
+    expected = [0, 1, 199, 201, 99, 98, 200, True, -1, [99, 98, 97], sum(range(200))]
+    for engine in ("tree", "closure", "vm", "flat"):
+        assert run(code, engine=engine) == expected
+    with pytest.raises(TypeError):
+        run('a = [1]; i = 0; while i < 70 { a = a + [i]; i = i + 1; } a + "x";')
+
+def test_string_concatenation_builds_ropes_and_join(capsys):
+    code = """
+    s = ""; i = 0;
+    while i < 100 { s = s + "abcd"; i = i + 1; }
+    t = s + "!"; u = s + "?";
+    same = t == u; grown = s < t; copy = s + "" == s;
+    print(t[396:]);
+    [len(s), len(t), t[400], u[400], s[0:3], same, grown, copy, join(["a", "b", s[0:2]], ", ")];
+    """
+    expected = [400, 401, "!", "?", "abc", False, True, True, "a, b, ab"]
+    for engine in ("tree", "closure", "vm", "flat"):
+        assert run(code, engine=engine) == expected
+    assert capsys.readouterr().out == "abcd!\n" * 4
+    with pytest.raises(TypeError):
+        run('join([1, 2], ",");')
+
+def test_maps_literals_indexing_and_builtins():
+    code = """
+    m = {"a": 1, "b": 2, 3: "c"};
+    m["d"] = 4; m["a"] = 10;
+    nested = {"in": {"x": [1, 2]}}; nested["in"]["x"][1] = 7;
+    def fill(ref t, k) { t[k] = k * k; }
+    squares = {}; i = 0;
+    while i < 100 { fill(squares, i); i = i + 1; }
+    [m["a"], m[3], len(m), has(m, "b"), has(m, "z"), keys(m), values(m), delete(m, "b"), len(m),
+     nested["in"]["x"], squares[99], len(squares)];
+    """
+    expected = [10, "c", 4, True, False, ["a", "b", 3, "d"], [10, 2, "c", 4], 2, 3, [1, 7], 9801, 100]
+    for engine in ("tree", "closure", "vm", "flat"):
+        assert run(code, engine=engine) == expected
+    with pytest.raises(KeyError):
+        run('m = {"a": 1}; m["b"];')
+    with pytest.raises(TypeError):
+        run('m = {}; m[[1]] = 2;')
+
+def test_for_loops_over_arrays_strings_maps_and_lazy_ranges(capsys):
+    code = """
+    total = 0; for x in [1, 2, 3] { total = total + x; }
+    word = ""; for c in "abc" { word = c + word; }
+    seen = []; m = {"a": 1, "b": 2}; for k in m { seen = seen + [k]; m["z"] = 3; }
+    def first_over(a, n) { for x in a { if x > n { return x; } } return 0 - 1; }
+    def count_to(n) { count = 0; for x in range(1000000000000) { count = count + 1; if count == n { return x; } } }
+    r = range(10, 0, 0 - 3); v = r[1:3]; v[0] = 70;
+    last = for x in range(4) { x * 10; };
+    for c in "hi" { print(c); }
+    [total, x, word, seen, first_over(range(100), 41), first_over([1], 5), count_to(1000), r, last, len(range(5, 5000))];
+    """
+    expected = [6, 3, "cba", ["a", "b"], 42, -1, 999, [10, 70, 4, 1], 30, 4995]
+    for engine in ("tree", "closure", "vm", "flat"):
+        assert run(code, engine=engine) == expected
+        assert capsys.readouterr().out == "h\ni\n"
+    with pytest.raises(TypeError):
+        run("for x in 5 { x; }")
+
+def test_pure_functions_are_memoized_with_bounded_caches(capsys):
+    from studio6 import Interpreter, parse_program
+    code = """
+    def h(n) { return n + 1; }
+    def fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); }
+    def twice(n) { return h(n) * 2; }
+    def shout(n) { print(n); return n; }
+    calls = 0; memo def counted(n) { calls = calls + 1; return n * n; }
+    def bump(a) { a[0] = a[0] + 1; return a[0]; }
+    def sq(n) { return n * n; }
+    box = [0]; i = 0; while i < 6 { sq(i); i = i + 1; }
+    before = twice(1); def h(n) { return n + 10; }
+    [fib(80), before, twice(1), shout(1), shout(1), counted(3) + counted(3), calls, bump(box), bump(box)];
+    """
+    for engine in ("tree", "closure", "vm", "flat"):
+        interp = Interpreter(memo_limit=4, memoize=True)
+        for step in interp.prepare(parse_program(code), engine):
+            result = step(interp.env)
+        assert result == [23416728348467685, 4, 22, 1, 1, 18, 1, 1, 2]
+        assert capsys.readouterr().out == "1\n1\n"
+        stats = interp.memo_stats()
+        assert stats["fib"] == {"hits": 78, "misses": 81, "size": 4}
+        assert stats["counted"] == {"hits": 1, "misses": 1, "size": 1}
+        assert "sq" not in stats        # no call or loop: cheaper to run than to look up
+        assert stats["twice"]["misses"] == 2 and stats["shout"]["misses"] == 0
+    assert run("def f(n) { return n; } f(1);", memo_limit=0) == 1
+    with pytest.raises(SyntaxError):
+        run("memo def f(ref a) { return a; }")
+
+def test_profiler_attributes_time_to_functions_loops_and_node_types(capsys):
+    from studio6_profile import Profile
+    code = """def spin(n) { i = 0; while i < n { i = i + 1; } return i; }
+    def hop(n) { return spin(n); }
+    def count(n, acc) { if n == 0 { return acc; } return count(n - 1, acc + 1); }
+    total = 0;
+    for x in range(3) {
+        total = total + spin(10) + hop(5) + count(4, 0);
+    }
+    total;"""
+    profile = Profile()
+    assert run(code, profile=profile, memo_limit=0) == 57
+    assert {name: record[0] for name, record in profile.functions.items()} == {"spin": 6, "hop": 3, "count": 15}
+    assert {name: record[0] for name, record in profile.loops.items()} == {"while line 1": 6, "for line 5": 1}
+    assert profile.nodes["Call"][0] == 10 and profile.nodes["WhileLoop"][0] == 6
+    spin = profile.functions["spin"]
+    assert spin[1] >= spin[2] > 0
+    stacks = dict(line.rsplit(" ", 1) for line in profile.collapsed())
+    assert "<main>;for line 5;spin;while line 1" in stacks and "<main>;for line 5;hop" in stacks
+    assert all(stack.startswith("<main>") and int(us) > 0 for stack, us in stacks.items())
+    assert run(code, profile=True) == 57
+    report = capsys.readouterr().err
+    assert "spin" in report and "while line 1" in report and "BinOp" in report
+
+def test_sampler_reads_the_call_stack_the_tree_walker_keeps(tmp_path):
+    from studio6 import Interpreter, BuiltinFunction, parse_program
+    from studio6_profile import Sampler
+    interp = Interpreter(memo_limit=0)
+    sampler = Sampler(str(tmp_path / "samples.txt"), interval=60)     # records only what is passed to it
+    seen = []
+    interp.env.define("probe", BuiltinFunction(lambda args: seen.append(interp.stack[:])))
+    code = """def fail(n) { while 1 { raise n; } }
+    def leaf(n) { for x in [1] { probe(); } return n; }
+    def mid(n) { try { fail(n); } catch (e) { probe(); } return leaf(n); }
+    mid(1); probe();"""
+    for step in interp.prepare(parse_program(code), "tree"):
+        step(interp.env)
+    sampler.start(interp)
+    for stack in seen:
+        sampler.record(stack)
+    sampler.stop()
+    assert (tmp_path / "samples.txt").read_text().splitlines() == [
+        "<main>;mid 1", "<main>;leaf;for line 2 1", "<main> 1"]
+    assert sampler.functions == {"<main>": [1, 3], "mid": [1, 1], "leaf": [1, 1]}
+    assert sampler.lines == {3: [1, 1], 2: [1, 1]}
+    busy = "def spin(n) { i = 0; while i < n { i = i + 1; } return i; } spin(50000);"
+    sampler = Sampler(str(tmp_path / "busy.txt"), interval=0.001)
+    assert run(busy, engine="tree", sample=sampler) == 50000
+    assert sampler.samples > 0 and sampler.functions["spin"][1] > 0
+    assert (tmp_path / "busy.txt").read_text().count("\n") == sampler.samples
+
+def test_benchmark_suite_times_phases_and_compares_against_a_baseline():
+    from studio6_bench import bench_suite, regressions
+    current = bench_suite(["fib", "exceptions"], scale=0.3, repeat=1)
+    assert current["mismatches"] == []
+    assert set(current["results"]) == {f"{name}/{phase}" for name in ("fib", "exceptions")
+                                       for phase in ("lex", "parse", "eval/tree", "eval/closure", "eval/vm", "eval/flat")}
+    fib = current["results"]["fib/eval/closure"]
+    assert fib["seconds"] > 0 and fib["ops_per_sec"] == 1 / fib["seconds"] and fib["peak_bytes"] > 0
+    baseline = {"results": {"fib/eval/closure": {"seconds": fib["seconds"] / 2}, "fib/lex": {"seconds": 1.0}}}
+    assert regressions(current, baseline, threshold=0.5) == [("fib/eval/closure", fib["seconds"] / 2, fib["seconds"])]
+    assert regressions(current, baseline, threshold=1.5) == []
+
+def test_limits_stop_runaway_programs_on_every_engine():
+    from studio6_limits import Limits, LimitExceeded
+    runaway = {
+        "steps": ("try { while 1 { } } catch (e) { print(e); }", Limits(steps=500)),
+        "seconds": ("x = 0; while 1 { x = x + 1; }", Limits(seconds=0.05)),
+        "depth": ("def f(n) { return f(n + 1) + 1; } f(0);", Limits(depth=40)),
+        "allocation": ('s = "ab"; while 1 { s = s + s; }', Limits(allocation=10 ** 5)),
+    }
+    for engine in ("tree", "closure", "vm", "flat"):
+        for limit, (code, limits) in runaway.items():
+            with pytest.raises(LimitExceeded) as info:
+                run(code, engine=engine, limits=limits)
+            assert info.value.limit == limit and limits.usage is not None
+        assert runaway["steps"][1].usage["steps"] == 501
+        assert runaway["depth"][1].usage["depth"] == 41
+        assert runaway["allocation"][1].usage["allocation"] > 10 ** 5
+        with pytest.raises(LimitExceeded, match="steps limit"):
+            run("def f(n) { return f(n + 1); } f(0);", engine=engine, limits=Limits(steps=100))
+        with pytest.raises(LimitExceeded, match="allocation limit"):
+            run("a = zeros(1000000000);", engine=engine, limits=Limits(allocation=1000))
+        # A raise out of nested calls gives their depth back when it is caught
+        caught = """def f(n) { if n == 0 { raise 1; } return f(n - 1); }
+        i = 0; while i < 10 { try { f(20); } catch (e) { } i = i + 1; } i;"""
+        limits = Limits(steps=1000, depth=25)
+        assert run(caught, engine=engine, limits=limits) == 10
+        assert limits.usage["steps"] == 220 and limits.usage["depth"] == 0
+
+def test_run_many_runs_jobs_on_a_process_pool_with_fresh_globals():
+    from studio6_batch import run_many, stream
+    from studio6_limits import Limits
+    sources = ['x = 1; print("job", x); x + 1;', "print(x);", 'raise "boom";', "while 1 { }",
+               '[1, "s" + "t", {"k": 2}];']
+    for workers in (0, 2):
+        results = run_many(sources, workers=workers, limits=Limits(steps=1000))
+        assert [result.index for result in results] == [0, 1, 2, 3, 4]
+        assert (results[0].value, results[0].output, results[0].error) == (2, "job 1\n", None)
+        assert results[1].error == "NameError: Undefined variable 'x'"
+        assert results[2].error == "RuntimeError: Uncaught exception: boom"
+        assert results[3].error.startswith("LimitExceeded: steps limit") and results[3].usage["steps"] == 1001
+        assert results[4].value == [1, "st", {"k": 2}] and results[4].output == ""
+    finished = list(stream(sources[:3] * 10, workers=2, ordered=False, chunksize=2))
+    assert sorted(result.index for result in finished) == list(range(30))
+    assert all(result.output == ("job 1\n" if result.index % 3 == 0 else "") for result in finished)
+
+def test_typed_arrays_compare_like_plain_arrays(capsys):
+    code = """a = zeros(3) == [0, 0, 0]; b = [1, 2] == array_from([1, 2]); c = zeros(2) < [0, 1];
+    d = array_from([5]) > range(5, 6); print(a, b, c, d);"""
+    for engine in ("tree", "closure", "vm", "flat"):
+        run(code, engine=engine)
+        assert capsys.readouterr().out == "True True True False\n"
+
+def test_plus_concatenates_typed_arrays_and_ranges():
+    from studio6_arrays import IntArray
+    code = "[zeros(2) + zeros(2), range(3) + [1], array_from([1]) + [4], [9] + range(2), range(2) + array_from([7])];"
+    for engine in ("tree", "closure", "vm", "flat"):
+        result = run(code, engine=engine)
+        assert result == [[0, 0, 0, 0], [0, 1, 2, 1], [1, 4], [9, 0, 1], [0, 1, 7]]
+        assert type(result[0]) is IntArray and type(result[1]) is list and type(result[4]) is IntArray
+        assert len(run("range(50) + range(50) + [1];", engine=engine)) == 101
+
+def test_for_loops_see_writes_made_during_the_loop_at_every_size():
+    for engine in ("tree", "closure", "vm", "flat"):
+        for n in (3, 100):
+            written = f"a = zeros({n}) + [0]; s = 0; for x in a {{ a[{n}] = 5; s = s + x; }} s;"
+            assert run(written, engine=engine) == 5
+            lazy = f"a = range({n}); s = 0; for x in a {{ a[{n - 1}] = 1000; s = s + x; }} s;"
+            assert run(lazy, engine=engine) == sum(range(n - 1)) + 1000
+    assert run("a = range(100) + [1]; b = 0; for x in a { a[0] = 7; b = b + 1; } [b, a[0], len(a)];") == [101, 7, 101]
+
+def test_allocation_limit_charges_conversions_and_shared_concatenations():
+    from studio6_limits import Limits, LimitExceeded
+    for engine in ("tree", "closure", "vm", "flat"):
+        # sum() copies the lazy range into an int buffer first
+        with pytest.raises(LimitExceeded, match="allocation limit"):
+            run("sum(range(5000000));", engine=engine, limits=Limits(allocation=10 ** 5))
+        with pytest.raises(LimitExceeded, match="allocation limit"):
+            run("a = [1, 2, 3, 4, 5, 6, 7, 8]; while 1 { a = a + a; }", engine=engine,
+                limits=Limits(allocation=10 ** 5))
+        limits = Limits(allocation=10 ** 5)
+        assert run("sum(range(1000));", engine=engine, limits=limits) == 499500
+        assert limits.usage["allocation"] == 1000
+
+def test_limited_runs_on_different_threads_are_metered_separately():
+    import threading
+    from studio6_limits import Limits, LimitExceeded
+    outcomes = {}
+    def job(name, code, limits):
+        try:
+            outcomes[name] = run(code, limits=limits), limits and limits.usage["steps"]
+        except LimitExceeded as e:
+            outcomes[name] = e.limit, e.usage["steps"]
+    counting = "def f(n) { return n; } i = 0; while i < 20000 { f(i); i = i + 1; } i;"
+    jobs = [("bounded", "while 1 { }", Limits(steps=200000)), ("counting", counting, Limits(steps=40000)),
+            ("free", counting, None)]
+    threads = [threading.Thread(target=job, args=args) for args in jobs]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert outcomes == {"bounded": ("steps", 200001), "counting": (20000, 40000), "free": (20000, None)}
+
+def test_sampler_reads_the_call_stack_the_closure_engine_keeps_while_sampled(tmp_path):
+    from studio6 import Interpreter, BuiltinFunction
+    from studio6_profile import Sampler, _label
+    interp = Interpreter(memo_limit=0)
+    seen = []
+    interp.env.define("probe", BuiltinFunction(lambda args: seen.append(list(map(_label, interp.stack)))))
+    code = """def fail(n) { while 1 { raise n; } }
+    def leaf(n) { for x in [1] { probe(); } return n; }
+    def mid(n) { try { fail(n); } catch (e) { probe(); } return leaf(n); }
+    def loop(n) { while n > 0 { n = n - 1; } return n; }
+    mid(1); probe(); loop(3); probe();"""
+    sampler = Sampler(str(tmp_path / "samples.txt"), interval=60)     # records only what is passed to it
+    run(code, sample=sampler, interpreter=interp)
+    assert seen == [["mid"], ["leaf", "for line 2"], [], []]
+    assert interp.stack == []
+    run(code, interpreter=interp)          # without a Sampler the closure engine keeps no stack
+    assert seen[4:] == [[], [], [], []]
+    busy = "def spin(n) { i = 0; while i < n { i = i + 1; } return i; } spin(400000);"
+    sampler = Sampler(str(tmp_path / "busy.txt"), interval=0.001)
+    assert run(busy, sample=sampler) == 400000
+    assert sampler.samples > 0 and sampler.functions["spin"][1] > 0
+    with pytest.raises(ValueError, match="sampling needs"):
+        run(busy, engine="vm", sample=Sampler(str(tmp_path / "vm.txt")))
+
+def test_run_many_bounds_the_copy_of_each_result():
+    from studio6_batch import run_many
+    from studio6_limits import Limits
+    sources = ["range(1000000000000);", "x = zeros(60); [x, x];", "range(3);"]
+    unlimited, limited = run_many(sources, workers=0), run_many(sources, workers=0, limits=Limits(allocation=100))
+    assert unlimited[0].error.startswith("LimitExceeded: allocation limit") and unlimited[0].value is None
+    assert limited[0].error.startswith("LimitExceeded: allocation limit")
+    assert len(unlimited[1].value) == 2 and limited[1].error.startswith("LimitExceeded: allocation limit")
+    assert unlimited[2].value == limited[2].value == [0, 1, 2]
+
+def test_memoization_is_opt_in_and_memo_is_a_name_outside_memo_def():
+    from studio6 import Interpreter, parse_program
+    code = """def fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); }
+    memo def square(n) { return n * n; }
+    memo = 5; memos = [memo];
+    [fib(15), square(4), square(4), memo + 1, memos];"""
+    for engine in ("tree", "closure", "vm", "flat"):
+        interp = Interpreter()
+        for step in interp.prepare(parse_program(code), engine):
+            result = step(interp.env)
+        assert result == [610, 16, 16, 6, [5]]
+        assert interp.memo_stats() == {"square": {"hits": 1, "misses": 1, "size": 1}}
+        interp.reset()
+        assert interp.env.memoize is False
+    fib = "def fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); } fib(80);"
+    assert run(fib, memoize=True) == 23416728348467685
+
+def test_counted_loops_recompute_expressions_over_arrays_written_in_the_loop():
+    loop = "i = 0; r = []; while i < 3 { c = a == b; r = r + [c]; a[0] = 5; i = i + 1; }"
+    top = "a = [1]; b = [1]; " + loop + " r;"
+    nested = "def f(a, b) { " + loop + " return r; } f([1], [1]);"
+    passed = "def g(x) { x[0] = 5; return 0; } a = [1]; b = [1]; i = 0; r = []; " \
+             "while i < 3 { c = a == b; r = r + [c]; g(a); i = i + 1; } r;"
+    for engine in ("tree", "closure", "vm", "flat"):
+        for code in (top, nested, passed):
+            assert run(code, engine=engine) == [True, False, False]
+        assert run("a = 2; b = 3; i = 0; s = 0; while i < 4 { s = s + a * b; i = i + 1; } s;",
+                   engine=engine) == 24
+
+def test_nested_arrays_print_as_plain_lists_whatever_their_type(capsys):
+    code = """r = range(3); w = range(2); w[0] = 7; v = [0]; i = 0; while i < 70 { v = v + [i]; i = i + 1; }
+    print([range(3)], [zeros(2)], [r[0:2]], [zeros(3)[1:3]], [w], [v[0:2]], {"k": array_from([4])});"""
+    for engine in ("tree", "closure", "vm", "flat"):
+        run(code, engine=engine)
+        assert capsys.readouterr().out == "[[0, 1, 2]] [[0, 0]] [[0, 1]] [[0, 0]] [[7, 1]] [[0, 0]] {'k': [4]}\n"
+
+def test_allocation_limit_charges_a_new_rope_for_both_strings():
+    from studio6_limits import Limits
+    for engine in ("tree", "closure", "vm", "flat"):
+        limits = Limits(allocation=10 ** 6)
+        run('s = "' + "x" * 300 + '"; t = s + "y"; u = t + "z";', engine=engine,
+            limits=limits)
+        assert limits.usage["allocation"] == 302